@@ -10,6 +10,10 @@
 <input type="submit" name="what" value="Reset Index"
        onclick="return confirm('Rebuilding the index may take a long time. Confirm ?');"><br/>
 
+<p>Browse cache: {{cachestats}}</p>
+<p>Folder art cache: {{artcachestats}}</p>
+<p>Read-ahead: {{readaheadstats}}</p>
+
 </div>
 </div>
 
@@ -13,11 +13,14 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import hashlib
+
 import conftree
 from uprclutils import uplog
 
 class MinimConfig(object):
     def __init__(self, fn = ''):
+        self.fn = fn
         if fn:
             self.conf = conftree.ConfSimple(fn)
         else:
@@ -27,6 +30,19 @@ class MinimConfig(object):
         self.whitespace = ', '
 
 
+    # Return a digest of the configuration file contents. This is used to decide if data derived
+    # from the configuration (e.g. the tags database) can be reused.
+    def gethash(self):
+        md5 = hashlib.md5()
+        if self.fn:
+            try:
+                with open(self.fn, 'rb') as f:
+                    md5.update(f.read())
+            except Exception as ex:
+                uplog(f"MinimConfig: can't read {self.fn}: {ex}")
+        return md5.hexdigest()
+
+
     def getsimplevalue(self, nm):
         s = self.conf.get(nm)
         if s:
@@ -179,13 +195,23 @@ class MinimConfig(object):
         return cdirs
 
     
+    # Comma-separated list of [client@]input:output rules. Returns a list of (client, input, output)
+    # triplets, with an empty client value if none was set. See uprcltranscode for the meaning of
+    # the input and output values.
     def gettranscodingspec(self):
         s = self.conf.get("stream.transcode")
         if not s:
             return None
 
-        specs = self.minimsplitsplit(s)
-        # each spec is a pair of (input,output)
-        # TBD
-        pass
+        specs = []
+        for input, output in self.minimsplitsplit(s):
+            if not input or not output:
+                uplog(f"MinimConfig: bad stream.transcode element [{input}:{output}]")
+                continue
+            client = ''
+            if input.find('@') != -1:
+                client, input = [v.strip() for v in input.split('@', 1)]
+            specs.append((client, input.lower(), output.lower()))
+        #uplog(f"Minim:gettranscodingspec:out: {specs}")
+        return specs
     
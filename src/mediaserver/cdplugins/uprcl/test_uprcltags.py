@@ -0,0 +1,178 @@
+# Copyright (C) 2026 J.F.Dockes
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Check that the statements built by the Tagged browse methods use the indexes created by
+# uprcltagscreate._createindexes().
+#
+# We build a small tags db in memory with uprcltagscreate.recolltosql(), browse the tags tree through
+# a connection which records the executed statements, then look at the EXPLAIN QUERY PLAN output
+# for each of them: the tracks table and the tracks_xx junction tables must never be scanned
+# without an index.
+#
+# Run with: python3 -m unittest test_uprcltags (in the uprcl directory)
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "pycommon"))
+os.environ.setdefault("UPMPD_CONFIG", os.devnull)
+
+# uprcltagscreate needs the recoll module
+try:
+    from recoll import recoll
+except ImportError:
+    raise unittest.SkipTest("the recoll Python module is needed")
+
+import minimconfig
+import uprclinit
+import uprcltags
+import uprcltagscreate
+
+
+# Minimal recoll doc: the tags db creation only uses the fields and the binary url.
+class _Doc(object):
+    def __init__(self, **fields):
+        self._fields = fields
+    def __getitem__(self, nm):
+        return self._fields.get(nm, "")
+    def __setitem__(self, nm, value):
+        self._fields[nm] = value
+    def getbinurl(self):
+        return self._fields["url"].encode("utf-8")
+
+
+def _makedocs():
+    docs = []
+    genres = ("Rock", "Jazz", "Classical")
+    for a in range(4):
+        for b in range(3):
+            folder = f"/music/Artist{a}/Album{b}"
+            docs.append(_Doc(url="file://" + folder, mtype="inode/directory", fmtime="1"))
+            for t in range(5):
+                docs.append(_Doc(url=f"file://{folder}/{t+1:02d} track{t}.flac", mtype="audio/flac",
+                                 title=f"Title {a} {b} {t}", album=f"Album {a} {b}",
+                                 artist=f"Artist {a}", genre=genres[(a + t) % 3],
+                                 tracknumber=str(t + 1), date=str(1990 + b), fmtime="1",
+                                 composer="Bach" if t % 2 else ""))
+    return docs
+
+
+class _RecordingCursor(object):
+    def __init__(self, cursor, stmts):
+        self._cursor = cursor
+        self._stmts = stmts
+    def execute(self, stmt, values=()):
+        self._stmts.append((stmt, tuple(values)))
+        self._cursor.execute(stmt, values)
+        return self
+    def fetchone(self):
+        return self._cursor.fetchone()
+    def fetchall(self):
+        return self._cursor.fetchall()
+    def __iter__(self):
+        return iter(self._cursor)
+
+
+class _RecordingConn(object):
+    def __init__(self, conn):
+        self.conn = conn
+        self.stmts = []
+    def cursor(self):
+        return _RecordingCursor(self.conn.cursor(), self.stmts)
+
+
+# The track entries are built by the folders tree, which we don't need here.
+class _Folders(object):
+    def docentry(self, id, pid, docidx):
+        return {"id": id, "pid": pid, "tt": str(docidx)}
+
+
+class _Tagged(uprcltags.Tagged):
+    def _init_sqconn(self, rcldocs):
+        self._conn = _RecordingConn(uprcltagscreate._connect(":memory:"))
+        uprcltagscreate.recolltosql(self._conn.conn, rcldocs)
+
+
+class QueryPlansTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        uprclinit.g_minimconfig = minimconfig.MinimConfig("")
+        uprclinit._g_trees = {"folders": _Folders()}
+        cls.tagged = _Tagged(_makedocs(), "127.0.0.1:9090", "/uprcl")
+
+    # Browse the objid and return the plans for the executed statements, as (stmt, plan) pairs,
+    # with the plan details joined with " | ".
+    def _plans(self, objid, offset=0, count=0, folder=None):
+        conn = self.tagged._conn
+        conn.stmts.clear()
+        if folder:
+            self.tagged._dobrowse(objid, "children", objid.split("$")[2:], folder)
+        else:
+            self.tagged.browse(objid, "children", offset, count)
+        self.assertTrue(conn.stmts, objid)
+        plans = []
+        for stmt, values in conn.stmts:
+            rows = conn.conn.execute("EXPLAIN QUERY PLAN " + stmt, values).fetchall()
+            plans.append((stmt, " | ".join([r[3] for r in rows])))
+        return plans
+
+    def _checknotrackscan(self, objid, **kw):
+        for stmt, plan in self._plans(objid, **kw):
+            for detail in plan.split(" | "):
+                if detail.startswith("SCAN tracks") and "INDEX" not in detail:
+                    self.fail(f"{objid}: tracks scan in plan [{plan}] for [{stmt}]")
+
+    def _checkuses(self, objid, indexes, **kw):
+        plans = " | ".join([plan for stmt, plan in self._plans(objid, **kw)]) + " "
+        for idx in indexes:
+            self.assertIn(f"INDEX {idx} ", plans, objid)
+
+    def test_tagvalue_selection(self):
+        self._checknotrackscan("0$uprcl$=Artist$1")
+        self._checkuses("0$uprcl$=Artist$1", ("tracks_artists_artist_id", "tracks_docidx"))
+
+    def test_nested_tagvalue_selection(self):
+        self._checknotrackscan("0$uprcl$=Genre$1$=Artist")
+        self._checknotrackscan("0$uprcl$=Genre$1$=Artist$1")
+        self._checkuses("0$uprcl$=Genre$1$=Artist$1", ("tracks_genres_genre_id",))
+
+    def test_selection_albums(self):
+        self._checknotrackscan("0$uprcl$=Genre$1$albums")
+        albid = self.tagged._subtreealbums(" WHERE tracks.docidx = tracks_genres.docidx AND "
+                                           "tracks_genres.genre_id = ?",
+                                           ["tracks", "tracks_genres"], [1])[0]
+        self._checknotrackscan(f"0$uprcl$=Genre$1$albums${albid}")
+        self._checkuses(f"0$uprcl$=Genre$1$albums${albid}", ("tracks_album_id",))
+
+    def test_selection_items(self):
+        self._checknotrackscan("0$uprcl$=Genre$1$items")
+        self._checknotrackscan("0$uprcl$=Genre$1$items", offset=2, count=3)
+
+    def test_album_tracks(self):
+        self._checknotrackscan("0$uprcl$albums$1")
+        self._checkuses("0$uprcl$albums$1", ("tracks_album_id",))
+
+    def test_items_page(self):
+        self._checknotrackscan("0$uprcl$items", offset=10, count=5)
+        self._checkuses("0$uprcl$items", ("tracks_itemsort",), offset=10, count=5)
+
+    def test_folder_restriction(self):
+        self._checknotrackscan("0$uprcl$items", folder="/music/Artist1/")
+        self._checkuses("0$uprcl$items", ("tracks_path",), folder="/music/Artist1/")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -114,34 +114,50 @@ def browse(a):
 
     entries = []
     nocache = "1"
+    # The results are cached, except for the tag view "hide contents" entries, which depend on the
+    # time of the previous requests (see Tagged.browseFolder()), and the wait/error entries.
+    cacheable = not (objid.endswith("$hchide") or objid.endswith("$hctags"))
+    cachekey = (objid, bflg, offset, count)
     try:
         if not uprclinit.initdone():
             # initdone() acquires the readlock
             entries = [waitentry(objid + 'notready', objid, uprclinit.getHttphp()),]
+            cacheable = False
         else:
             initstatus, initmessage = uprclinit.initstatus()
             if not initstatus:
                 entries = [waitentry(objid + 'notready', objid, uprclinit.getHttphp(),
                                      "Uprcl init error: " + initmessage),]
+                cacheable = False
             else:
+                if cacheable:
+                    result = uprclinit.getBrowseCache().get(cachekey)
+                    if result is not None:
+                        return result
                 if not idpath:
                     entries = _rootentries()
                 else:
                     if len(rootmap) == 0:
                         _rootentries()
                     entries = _browsedispatch(objid, bflg, offset, count)
+
+        total = -1
+        resoffs = 0
+        if type(entries) == type(()):
+            resoffs = entries[0]
+            total = entries[1]
+            entries = entries[2]
+        #msgproc.log("%s" % entries)
+        encoded = json.dumps(entries)
+        result = {"entries" : encoded, "nocache" : nocache, "offset" : str(resoffs),
+                  "total" : str(total)}
+        # Store while we hold the lock, so that the trees can't have changed.
+        if cacheable:
+            uprclinit.getBrowseCache().put(cachekey, result, len(encoded))
     finally:
         uprclinit.g_dblock.release_read()
 
-    total = -1
-    resoffs = 0
-    if type(entries) == type(()):
-        resoffs = entries[0]
-        total = entries[1]
-        entries = entries[2]
-    #msgproc.log("%s" % entries)
-    encoded = json.dumps(entries)
-    return {"entries" : encoded, "nocache" : nocache, "offset" : str(resoffs), "total" : str(total)}
+    return result
 
 
 @dispatcher.record('search')
@@ -154,6 +170,13 @@ def search(a):
     upnps = a['origsearch']
     nocache = "1"
 
+    offset = 0
+    if 'offset' in a:
+        offset = int(a['offset'])
+    count = 0
+    if 'count' in a:
+        count = int(a['count'])
+
     try:
         if not uprclinit.initdone():
             entries = [waitentry(objid + 'notready', objid, uprclinit.getHttphp()),]
@@ -163,15 +186,24 @@ def search(a):
                 entries = [waitentry(objid + 'notready', objid, uprclinit.getHttphp(),
                                      "Uprcl init error: " + initmessage),]
             else:
+                # The sorted results are cached by uprclsearch, which only builds the entries for
+                # the requested slice
                 entries = uprclsearch.search(
                     uprclinit.getTree('folders'), uprclinit.getRclConfdir(), objid,
                     upnps, uprclinit.getObjPrefix(), uprclinit.getHttphp(),
-                    uprclinit.getPathPrefix())
+                    uprclinit.getPathPrefix(), offset, count)
     finally:
         uprclinit.g_dblock.release_read()
 
+    total = -1
+    resoffs = 0
+    if type(entries) == type(()):
+        resoffs = entries[0]
+        total = entries[1]
+        entries = entries[2]
     encoded = json.dumps(entries)
-    return {"entries" : encoded, "nocache":nocache}
+    return {"entries" : encoded, "nocache" : nocache, "offset" : str(resoffs),
+            "total" : str(total)}
 
 
 uprclinit.uprcl_init()
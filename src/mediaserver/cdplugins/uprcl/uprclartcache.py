@@ -0,0 +1,244 @@
+# Copyright (C) 2026 J.F.Dockes
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Disk cache for the embedded cover art images.
+#
+# Extracting an embedded image means parsing the audio file with mutagen, which is slow, and
+# control points showing an album grid ask for many images, often repeatedly. So we extract each
+# image once and keep it in the "artcache" subdirectory of the uprcl cache directory:
+#
+#  - keys/xx/<keyhash> files are keyed by a hash of the audio file path, mtime and size, so that
+#    they become unused when the file changes. They contain the image hash and MIME type.
+#  - img/xx/<imghash>[-<size>] files hold the image data (possibly downscaled to size pixels). They
+#    are named after the hash of the original image data, so that the many tracks of an album
+#    with the same embedded image share a single copy. The hash is also used for the HTTP ETag.
+#
+# Downscaling is only performed if PIL is available, and for the sizes listed in the
+# uprclembedartsizes configuration variable. Other requested sizes get the original image.
+#
+# Files are created under temporary names and renamed, so that concurrent requests for the same
+# image are safe.
+#
+# The cache size is bounded by uprclembedartcachemb (0 for no limit). The files mtimes are updated when they are
+# used, and the least recently used files are removed first when the cache is trimmed, which we do
+# each time that about a tenth of the maximum size was written. A key file may then point to a
+# removed image, which is just extracted again.
+
+import hashlib
+import os
+import tempfile
+import threading
+import time
+
+from upmplgutils import uplog, getOptionValue
+from uprclutils import embedded_open
+import uprclinit
+
+try:
+    from PIL import Image
+    _has_pil = True
+except:
+    _has_pil = False
+
+_sizes = None
+
+def _allowedsizes():
+    global _sizes
+    if _sizes is None:
+        try:
+            _sizes = [int(s) for s in getOptionValue("uprclembedartsizes", "150 300 600").split()]
+        except Exception as ex:
+            uplog(f"uprclartcache: bad uprclembedartsizes value: {ex}")
+            _sizes = []
+    return _sizes
+
+
+_maxbytes = None
+
+def _getmaxbytes():
+    global _maxbytes
+    if _maxbytes is None:
+        try:
+            _maxbytes = int(float(getOptionValue("uprclembedartcachemb", 100)) * 1024 * 1024)
+        except Exception as ex:
+            uplog(f"uprclartcache: bad uprclembedartcachemb value: {ex}")
+            _maxbytes = 100 * 1024 * 1024
+    return _maxbytes
+
+
+def _topdir():
+    return os.path.join(uprclinit.getRclConfdir(), "artcache")
+
+
+def _cachepath(sub, nm):
+    return os.path.join(_topdir(), sub, nm[:2], nm)
+
+
+# Bytes written since the last trim, and lock for updating it and for running a single trim.
+_written = 0
+_writtenlock = threading.Lock()
+_trimlock = threading.Lock()
+
+# Account for newly written data, and trim the cache if enough was written since the last time.
+def _addwritten(size):
+    global _written
+    maxbytes = _getmaxbytes()
+    if not maxbytes:
+        return
+    with _writtenlock:
+        _written += size
+        if _written < maxbytes // 10:
+            return
+        _written = 0
+    if _trimlock.acquire(blocking=False):
+        try:
+            _trimcache(maxbytes)
+        finally:
+            _trimlock.release()
+
+
+# Remove the least recently used files to bring the cache size under the limit. Temporary files
+# from the writes in progress are skipped, except if they are old (remains of a crash).
+def _trimcache(maxbytes):
+    files = []
+    total = 0
+    for sub in ("keys", "img"):
+        for dirpath, dirnames, filenames in os.walk(os.path.join(_topdir(), sub)):
+            for fn in filenames:
+                path = os.path.join(dirpath, fn)
+                try:
+                    st = os.stat(path)
+                except Exception:
+                    continue
+                if fn.startswith("tmp") and st.st_mtime > time.time() - 86400:
+                    continue
+                files.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+    if total <= maxbytes:
+        return
+    files.sort()
+    for mtime, size, path in files:
+        if total <= maxbytes:
+            break
+        try:
+            os.unlink(path)
+            total -= size
+        except Exception as ex:
+            uplog(f"uprclartcache: can't remove {path}: {ex}")
+
+
+# Update the file mtime, which we use for deciding what to remove from the cache.
+def _touch(path):
+    try:
+        os.utime(path)
+    except Exception:
+        pass
+
+
+# Atomically create a cache file with the given data
+def _writefile(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmppath, path)
+    except:
+        os.unlink(tmppath)
+        raise
+    _addwritten(len(data))
+
+
+# MIME type of a downscaled image: PNG images stay PNG, the others are encoded as JPEG.
+def _scaledmtype(mtype):
+    return "image/png" if mtype == "image/png" else "image/jpeg"
+
+
+def _downscale(srcpath, dstpath, mtype, size):
+    img = Image.open(srcpath)
+    img.thumbnail((size, size))
+    fmt = "PNG" if _scaledmtype(mtype) == "image/png" else "JPEG"
+    if fmt == "JPEG" and img.mode not in ("RGB", "L"):
+        img = img.convert("RGB")
+    os.makedirs(os.path.dirname(dstpath), exist_ok=True)
+    fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(dstpath))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            img.save(f, fmt)
+        os.replace(tmppath, dstpath)
+    except:
+        os.unlink(tmppath)
+        raise
+    _addwritten(os.path.getsize(dstpath))
+
+
+# Extract the image embedded in the audio file to the cache. Returns the image hash and MIME type.
+def _extract(path, keypath):
+    mtype, isize, imgf = embedded_open(path)
+    data = imgf.read()
+    imghash = hashlib.sha1(data).hexdigest()
+    imgpath = _cachepath("img", imghash)
+    if os.path.exists(imgpath):
+        _touch(imgpath)
+    else:
+        _writefile(imgpath, data)
+    _writefile(keypath, f"{imghash} {mtype}\n".encode('ascii'))
+    return imghash, mtype
+
+
+# Return the image file path, MIME type and ETag for the image embedded in the audio file, possibly
+# downscaled to size (a string from the request, possibly empty). Raises an exception if there is
+# no image.
+def embeddedart(path, size=None):
+    st = os.stat(path)
+    bpath = path if isinstance(path, bytes) else path.encode('utf-8', errors='surrogateescape')
+    key = hashlib.sha1(bpath + f":{st.st_mtime_ns}:{st.st_size}".encode('ascii')).hexdigest()
+    keypath = _cachepath("keys", key)
+    try:
+        with open(keypath, "r") as f:
+            imghash, mtype = f.read().split()
+        _touch(keypath)
+    except Exception:
+        # Not in cache: extract the image
+        imghash, mtype = _extract(path, keypath)
+
+    imgpath = _cachepath("img", imghash)
+    etag = imghash
+    try:
+        size = int(size) if size else 0
+    except:
+        size = 0
+    if size and _has_pil and size in _allowedsizes():
+        spath = imgpath + f"-{size}"
+        if os.path.exists(spath):
+            _touch(spath)
+            return spath, _scaledmtype(mtype), f'"{etag}-{size}"'
+    else:
+        spath = None
+    # The image may have been removed by a trim
+    if os.path.exists(imgpath):
+        _touch(imgpath)
+    else:
+        imghash, mtype = _extract(path, keypath)
+    if spath:
+        try:
+            _downscale(imgpath, spath, mtype, size)
+        except Exception as ex:
+            uplog(f"uprclartcache: can't downscale {imgpath}: {ex}")
+            return imgpath, mtype, f'"{etag}"'
+        imgpath = spath
+        mtype = _scaledmtype(mtype)
+        etag += f"-{size}"
+    return imgpath, mtype, f'"{etag}"'
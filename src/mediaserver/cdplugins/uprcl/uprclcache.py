@@ -0,0 +1,115 @@
+# Copyright (C) 2026 J.F.Dockes
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Cache for the browse results.
+#
+# Control Points re-browse the same containers all the time (back navigation, re-entering album
+# lists, paging...). The data only changes when the index is updated, so we keep the recent results,
+# in their final JSON-encoded form, in an LRU cache. The cache is cleared when the trees are
+# replaced after an index update (see uprclinit._update_index()), so an entry is always valid.
+#
+# The size is bounded both by the number of entries and the total size of the encoded data.
+
+import os
+import threading
+from collections import OrderedDict
+
+
+class BrowseCache(object):
+    def __init__(self, maxentries=1000, maxbytes=10*1024*1024):
+        self._maxentries = maxentries
+        self._maxbytes = maxbytes
+        self._lock = threading.Lock()
+        self._clear()
+        self.hits = 0
+        self.misses = 0
+
+    def _clear(self):
+        self._entries = OrderedDict()
+        self._bytes = 0
+
+    # Forget everything. Called when the trees change.
+    def clear(self):
+        with self._lock:
+            self._clear()
+
+    # Return the cached value for key, or None.
+    def get(self, key):
+        if self._maxentries <= 0:
+            return None
+        with self._lock:
+            try:
+                value, size = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    # Store a value. size is the number of bytes we charge it for (typically the length of the
+    # encoded data).
+    def put(self, key, value, size):
+        if self._maxentries <= 0 or size > self._maxbytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._bytes -= self._entries[key][1]
+            self._entries[key] = (value, size)
+            self._entries.move_to_end(key)
+            self._bytes += size
+            while len(self._entries) > self._maxentries or self._bytes > self._maxbytes:
+                okey, (ovalue, osize) = self._entries.popitem(last=False)
+                self._bytes -= osize
+
+    # Return a dict of statistics values, for display
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self._bytes,
+                    "hits": self.hits, "misses": self.misses}
+
+
+# Cache for the folder art file names (as found by a directory listing), used when the art was not
+# resolved during the tree build (e.g. for search results).
+#
+# The entries are validated against the directory mtime, so that we see new or removed image files
+# (which change the directory mtime).
+class FolderArtCache(BrowseCache):
+    # scanfunc(folder) returns the value to cache for a folder.
+    def __init__(self, scanfunc, maxentries=50000, maxbytes=5*1024*1024):
+        super().__init__(maxentries=maxentries, maxbytes=maxbytes)
+        self._scanfunc = scanfunc
+
+    # Return the value for folder, listing the folder if it is not in the cache, or was modified
+    # since we listed it.
+    def lookup(self, folder):
+        try:
+            mtime = os.stat(folder).st_mtime_ns
+        except:
+            return None
+        with self._lock:
+            try:
+                entmtime, value = self._entries[folder][0]
+            except KeyError:
+                entmtime = None
+            if entmtime == mtime:
+                self._entries.move_to_end(folder)
+                self.hits += 1
+                return value
+            self.misses += 1
+        value = self._scanfunc(folder)
+        # The size is a rough estimate of the memory used by the entry
+        self.put(folder, (mtime, value), len(folder) + (len(value) if value else 0) + 200)
+        return value
@@ -22,11 +22,12 @@
 #
 # The _rcldocs list has one entry for each document in the index (mime:* search)
 #
-# The _dirvec list has one entry for each directory. Directories are
-# created as needed by splitting the paths/urls from _rcldocs (and
-# possibly adding some for groupings defined by the Group
-# tag). Directories have no direct relation with the index objects,
-# they are identified by their _dirvec index
+# The directory tree is first built as the _dirvec list, which has one
+# entry for each directory. Directories are created as needed by
+# splitting the paths/urls from _rcldocs (and possibly adding some for
+# groupings defined by the Group tag). Directories have no direct
+# relation with the index objects, they are identified by their
+# _dirvec index
 #
 # Obect ids inside the section:
 #    Container: $d<diridx> where <diridx> indexes into _dirvec
@@ -36,6 +37,9 @@
 #   objid paths as objids. E.g. 0$folders$f1589$f1593$f1604$*i11609
 #   Must make pwd and any walk up the tree much easier.
 #
+# When the tree is complete, _dirvec is converted to a compact
+# representation, see _freeze() below, and discarded.
+#
 # Each _dirvec entry is a Python dict, mapping the directory entries'
 # names to a pair (diridx,docidx), where:
 #
@@ -66,6 +70,28 @@
 # configuration. The entries are paths instead of simple names, and
 # the docidx is 0. The diridx points to a dirvec entry.
 #
+# The compact representation, which is what we use after the build, uses
+# a few arrays of integers instead of the dicts and tuples, which use
+# a lot of memory for big collections. The diridx values are the same.
+#
+#  - _names is the list of all the distinct entry names, which are
+#    stored only once. The other structures use indexes into it.
+#  - For each directory (indexed by diridx): _dirparent is the index of
+#    the parent directory (the ".." entry), _dirname the index of its
+#    name in _names (-1 for the root), _dirdotdoc is the docidx for the
+#    "." entry, or -2 if there is none, _dirstart and _dircount define
+#    the directory children slots. _dirparent and _dirname allow
+#    computing a directory path by walking up the tree.
+#  - For each child slot: _childname (index into _names), _childdir
+#    and _childdoc (the former (diridx, docidx) pair). The slots for a
+#    directory are contiguous and in the original insertion order.
+#  - _childbyname has the same layout as the child slots and holds, for
+#    each directory, its slot indexes sorted by name, for finding a
+#    child by name with a binary search.
+#
+# The playlists children are added after the conversion (they are
+# appended at the end of the slot arrays).
+#
 # We also build an _xid2idx xdocid->objidx map to allow a Recoll
 # item search result to be connected back to the folders tree.
 # I'm not sure that this is at all useful (bogus objids for items in
@@ -78,10 +104,12 @@ import os
 import shlex
 import sys
 import time
+from array import array
+from collections import OrderedDict
 from timeit import default_timer as timer
 
 from upmplgutils import uplog, direntry, getOptionValue
-from uprclutils import audiomtypes, rcldoctoentry, cmpentries
+from uprclutils import audiomtypes, rcldoctoentry, entrysortkey
 import uprclutils
 from recoll import recoll
 try:
@@ -93,6 +121,7 @@ uprclutils.sethasresultstore(_has_resultstore)
 
 from recoll import rclconfig
 import uprclinit
+import uprcltranscode
 
 # All Doc fields which we may want to access (reserve slots in the
 # resultstore). We use an inclusion list, and end up with a smaller
@@ -103,10 +132,18 @@ import uprclinit
 #
 _otherneededfields = [
     'albumartist', 'allartists', 'comment', 'composer', 'conductor',
-    'contentgroup', 'date', 'dmtime', 'discnumber', 'embdimg', 'filename',
+    'contentgroup', 'date', 'dmtime', 'discnumber', 'embdimg', 'filename', 'fmtime',
     'genre', 'group', 'label', 'lyricist', 'orchestra', 'performer',
 ]
 
+# Maximum number of entry templates kept by Folders.docentry()
+_entrycachesize = 100000
+
+# Sort key for entry names in the compact tree. Playlist entries names can be bytes, which can't
+# be compared with str.
+def _namekey(nm):
+    return (isinstance(nm, bytes), nm)
+
 class Folders(object):
 
     # Initialize (read recoll data and build tree).
@@ -120,6 +157,10 @@ class Folders(object):
         # url entries. Uses docidx values starting at len(_rcldocs),
         # with actual index value - len(_rcldocs)
         self._moredocs = []
+        # docidx -> entry template, see docentry()
+        self._entrycache = OrderedDict()
+        # Parsed playlists: path -> (mtime, entries), see playlistentries()
+        self._plcache = {}
         self._fetchalldocs(confdir)
         self._rcl2folders(confdir)
         self._enabletags = uprclinit.g_minimconfig.getboolvalue("showExtras", True)
@@ -152,23 +193,31 @@ class Folders(object):
         return myidx
     
 
-    # Find the doc index for a filesystem path.
-    # We use a temporary doc to call _stat()
+    # Find the doc index for a filesystem path (bytes), or -1.
+    def _docidxforpath(self, path):
+        return self._pathidx.get(path, -1)
+
+
+    # Find the doc index for a playlist entry
     def statpath(self, plpath, path):
         if not os.path.isabs(path):
             path = os.path.join(os.path.dirname(plpath), path)
-        doc = recoll.Doc()
-        if _has_resultstore:
-            doc["url"] = b'file://' + path
-        else:
-            doc.setbinurl(bytearray(b'file://' + path))
-        fathidx, docidx = self._stat(doc)
-        if docidx >= 0 and docidx < len(self._rcldocs):
+        docidx = self._docidxforpath(path)
+        if docidx >= 0:
             return docidx
         uplog("No track found for playlist %s entry %s" % (plpath, path))
         return None
 
 
+    # Return the recoll doc for a filesystem path (bytes), or None. This is used by the HTTP
+    # server to find the MIME type of a track.
+    def docforpath(self, path):
+        docidx = self._docidxforpath(path)
+        if docidx >= 0:
+            return self._rcldocs[docidx]
+        return None
+
+
     # Create bogus doc for external (http) url. This is for playlists.
     def docforurl(self, url):
         doc = recoll.Doc()
@@ -182,19 +231,47 @@ class Folders(object):
         return doc
     
 
-    # Initialize all playlists after the tree is otherwise complete
+    # Return the entries of a playlist as a list of (url, docidx) pairs, docidx being None for the
+    # actual URLs (usually http). The entries for which we have no doc are skipped. The parsed
+    # playlists are cached and only read again if the file was modified.
+    def playlistentries(self, plpath):
+        try:
+            mtime = os.stat(plpath).st_mtime_ns
+        except Exception as ex:
+            uplog("M3u open failed: %s %s" % (plpath,ex))
+            return []
+        cached = self._plcache.get(plpath)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        try:
+            m3u = uprclutils.M3u(plpath)
+        except Exception as ex:
+            uplog("M3u open failed: %s %s" % (plpath,ex))
+            return []
+        entries = []
+        for url in m3u:
+            if m3u.urlRE.match(url):
+                entries.append((url, None))
+            else:
+                docidx = self.statpath(plpath, url)
+                if docidx is not None:
+                    entries.append((url, docidx))
+        self._plcache[plpath] = (mtime, entries)
+        return entries
+
+
+    # Initialize all playlists after the tree is otherwise complete (and
+    # converted to the compact form).
     def _initplaylists(self):
         for diridx in self._playlists:
-            pldocidx = self._dirvec[diridx]["."][1]
+            pldocidx = self._dirdotdoc[diridx]
             pldoc = self._rcldocs[pldocidx]
             plpath = uprclutils.docpath(pldoc)
-            try:
-                m3u = uprclutils.M3u(plpath)
-            except Exception as ex:
-                uplog("M3u open failed: %s %s" % (plpath,ex))
-                continue
-            for url in m3u:
-                if m3u.urlRE.match(url):
+            # name->docidx. A name appearing several times keeps its first position and its last
+            # docidx.
+            entries = {}
+            for url, docidx in self.playlistentries(plpath):
+                if docidx is None:
                     # Actual URL (usually http). Create bogus doc
                     doc = self.docforurl(url)
                     self._moredocs.append(doc)
@@ -204,35 +281,57 @@ class Folders(object):
                         # Temp workaround for recoll 1.28.2 not
                         # setting values in meta
                         tt = doc["text"]
-                    self._dirvec[diridx][tt] = (-1, docidx)
+                    entries[tt] = docidx
                 else:
-                    docidx = self.statpath(plpath, url)
-                    if docidx:
-                        elt = os.path.split(url)[1]
-                        self._dirvec[diridx][elt] = (-1, docidx)
+                    elt = os.path.split(url)[1]
+                    entries[elt] = docidx
+            self._addchildren(diridx, [(nm, -1, docidx) for nm, docidx in entries.items()])
+        self._playlists = set(self._playlists)
+
+
+    # Build the topdirs trie, used by _pathbeyondtopdirs(). Each node is
+    # a dict mapping path elements to the child nodes. The node for a
+    # topdir also has a None key, with a (rank in topdirs, diridx) value.
+    def _buildtopdirtrie(self):
+        self._topdirtrie = {}
+        for rank in range(len(self._topdirs)):
+            rtpath, diridx = self._topdirs[rank]
+            node = self._topdirtrie
+            for elt in rtpath.split('/'):
+                node = node.setdefault(elt, {})
+            if None not in node:
+                node[None] = (rank, diridx)
 
 
     # The root entry (diridx 0) is special because its keys are the
     # topdirs paths, not simple names. We look with what topdir path
     # this doc belongs to, then return the appropriate diridx and the
-    # split remainder of the path
+    # split remainder of the path.
+    #
+    # The topdirs are looked up by walking the path elements down the
+    # topdirs trie. If topdirs are nested, the first one in the
+    # configuration wins.
     def _pathbeyondtopdirs(self, doc):
         url = uprclutils.docpath(doc).decode('utf-8', errors='replace')
         # Determine the root entry (topdirs element). Special because
         # its path is not a simple name. Fathidx is its index in _dirvec
-        firstdiridx = -1
-        for rtpath,idx in self._dirvec[0].items():
-            #uplog("type(url) %s type(rtpath) %s rtpath %s url %s" %
-            # (type(url),type(rtpath),rtpath, url))
-            if url.startswith(rtpath):
-                firstdiridx = idx[0]
+        elts = url.split('/')
+        node = self._topdirtrie
+        found = None
+        for i in range(len(elts)):
+            node = node.get(elts[i])
+            if node is None:
                 break
-        if firstdiridx == -1:
+            if None in node and (found is None or node[None][0] < found[0]):
+                found = (node[None][0], node[None][1], i + 1)
+        if found is None:
             # uplog("No parent in topdirs: %s" % url)
             return None,None
+        firstdiridx = found[1]
+        rtpathlen = len('/'.join(elts[:found[2]]))
 
         # Compute rest of path. If there is none, we're not interested.
-        url1 = url[len(rtpath):]
+        url1 = url[rtpathlen:]
         if len(url1) == 0:
             return None,None
 
@@ -253,13 +352,6 @@ class Folders(object):
     # Main folders build method: walk the recoll docs array and split
     # the URLs paths to build the [folders] data structure
     def _rcl2folders(self, confdir):
-        self._dirvec = []
-        self._xid2idx = {}
-        # This is used to store the diridx for the playlists during
-        # the initial walk, for initialization when the tree is
-        # complete.
-        self._playlists = []
-
         start = timer()
 
         rclconf = rclconfig.RclConfig(confdir)
@@ -267,15 +359,163 @@ class Folders(object):
                    shlex.split(rclconf.getConfParam('topdirs'))]
         topdirs = [d.rstrip('/') for d in topdirs]
 
+        self._builddirvec(topdirs)
+        self._freeze()
+        self._initplaylists()
+        self._initart()
+        self._initsortranks()
+                    
+        end = timer()
+        uplog("_rcl2folders took %.2f Seconds" % (end - start))
+
+
+    # Resolve the art for all the docs and directories, so that browsing does not need to access
+    # the file system. We list each directory only once (see uprclutils._dirlisting()).
+    #  - _docart has one entry per _rcldocs doc: None if there is no art, True if the art is the
+    #    embedded image (the uri is computed from the doc when needed), else the uri.
+    #  - _dirart has one entry per directory: the art uri or None (see _arturifordir()).
+    def _initart(self):
+        start = timer()
+        dircache = {}
+        # Share the uri strings: all the tracks in a folder usually have the same art
+        uris = {}
+        self._docart = []
+        for doc in self._rcldocs:
+            arturi = None
+            if doc["mtype"] in audiomtypes:
+                arturi = uprclutils.docarturi(doc, self._httphp, self._pprefix, dircache=dircache)
+            if arturi and arturi.endswith("?embed=1"):
+                arturi = True
+            elif arturi:
+                arturi = uris.setdefault(arturi, arturi)
+            self._docart.append(arturi)
+
+        self._dirart = []
+        for diridx in range(len(self._dirparent)):
+            arturi = None
+            # Look at the "." entry first, then the children (this is the _dirvec order).
+            docidxs = [self._dirdotdoc[diridx],] + \
+                [self._childdoc[slot] for slot in self._children(diridx)]
+            for docidx in docidxs:
+                if docidx >= 0 and docidx < len(self._rcldocs):
+                    # We used to only look for art for direct children tracks, but we now also
+                    # look at subdirs. This will yield an image from the first subdir which has an
+                    # image file in it, so somewhat random, but nice anyway.
+                    arturi = uprclutils.docarturi(self._rcldocs[docidx], self._httphp,
+                                                  self._pprefix, preferfolder=True,
+                                                  dircache=dircache)
+                    if arturi:
+                        arturi = uris.setdefault(arturi, arturi)
+                        break
+            self._dirart.append(arturi)
+        uplog(f"_initart: {len(dircache)} directories listed in {timer() - start:.2f} Seconds")
+
+
+    # Sort all the tracks according to uprclutils.entrysortkey() and itemsortkey(), and store the
+    # rank of each doc in the _entryrank and _itemrank arrays. Equal keys get the same rank, so
+    # that sorting a list of docidxs by rank (with a stable sort) gives the same result as sorting
+    # the entries by key. Non-track docs come last.
+    def _initsortranks(self):
+        start = timer()
+        entrykeys = []
+        itemkeys = []
+        for doc in self._rcldocs:
+            if doc["mtype"] in audiomtypes and doc["mtype"] != 'inode/directory':
+                ekey, ikey = uprclutils.docsortkeys(doc)
+            else:
+                ekey, ikey = (2,), (chr(0x10ffff),)
+            entrykeys.append(ekey)
+            itemkeys.append(ikey)
+        self._entryrank = self._ranks(entrykeys)
+        self._itemrank = self._ranks(itemkeys)
+        uplog(f"_initsortranks took {timer() - start:.2f} Seconds")
+
+    def _ranks(self, keys):
+        order = sorted(range(len(keys)), key=keys.__getitem__)
+        ranks = array('l', bytes(len(keys) * array('l').itemsize))
+        rank = 0
+        prevkey = None
+        for pos, docidx in enumerate(order):
+            if pos == 0 or keys[docidx] != prevkey:
+                rank = pos
+                prevkey = keys[docidx]
+            ranks[docidx] = rank
+        return ranks
+
+    # Return the docidxs sorted like the entries would be by uprclutils.entrysortkey() or, if
+    # items is set, itemsortkey().
+    def sorteddocidxs(self, docidxs, items=False):
+        ranks = self._itemrank if items else self._entryrank
+        return sorted(docidxs, key=ranks.__getitem__)
+
+
+    # Return the browse entry for a doc: this is the rcldoctoentry() output (adjusted for the
+    # transcoding, see uprcltranscode.fixentry()), which only depends on the doc except for the id
+    # and pid values. We build it once for each doc (the tree is rebuilt on each index update) and
+    # keep it as a template, which we copy for each use. The number of templates is bounded, the
+    # oldest are dropped first.
+    def docentry(self, id, pid, docidx):
+        try:
+            tmpl = self._entrycache[docidx]
+        except KeyError:
+            if docidx >= len(self._rcldocs):
+                doc = self._docforidx(docidx)
+                return uprcltranscode.fixentry(
+                    rcldoctoentry(id, pid, self._httphp, self._pprefix, doc), doc)
+            doc = self._rcldocs[docidx]
+            tmpl = uprcltranscode.fixentry(
+                rcldoctoentry("", "", self._httphp, self._pprefix, doc,
+                              arturi=self.docarturi(docidx)), doc)
+            if len(self._entrycache) >= _entrycachesize:
+                try:
+                    self._entrycache.popitem(last=False)
+                except:
+                    pass
+            self._entrycache[docidx] = tmpl
+        if not tmpl:
+            return {}
+        e = tmpl.copy()
+        e['id'] = id
+        e['pid'] = pid
+        return e
+
+
+    # Return the art uri for a doc index, as rcldoctoentry() wants it: the uri, an empty string if
+    # the doc has no art, or None if we don't know (playlist url entries).
+    def docarturi(self, docidx):
+        if docidx < 0 or docidx >= len(self._docart):
+            return None
+        arturi = self._docart[docidx]
+        if arturi is True:
+            return uprclutils.embdimgurl(self._rcldocs[docidx], self._httphp,
+                                         self._pprefix.encode('utf-8'))
+        return arturi if arturi else ""
+
+
+    # Build the _dirvec dicts tree (without the playlists contents)
+    def _builddirvec(self, topdirs):
+        self._dirvec = []
+        self._xid2idx = {}
+        # This is used to store the diridx for the playlists during
+        # the initial walk, for initialization when the tree is
+        # complete.
+        self._playlists = []
+        # Filesystem path (bytes) -> docidx for the docs in the tree. This is used for finding the
+        # playlist entries and the docs for the streamed files without walking the tree.
+        self._pathidx = {}
+
         # Create the 1st entry. This is special because it holds the
         # recoll topdirs, which are paths instead of simple names. There
         # does not seem any need to build the tree between a topdir and /
         self._dirvec.append({})
         self._dirvec[0][".."] = (0, -1)
+        self._topdirs = []
         for d in topdirs:
             self._dirvec.append({})
             self._dirvec[0][d] = (len(self._dirvec)-1, -1)
             self._dirvec[-1][".."] = (0, -1)
+            self._topdirs.append((d, len(self._dirvec)-1))
+        self._buildtopdirtrie()
 
         # Walk the doc list and update the directory tree according to the
         # url: create intermediary directories if needed, create leaf
@@ -334,15 +574,96 @@ class Folders(object):
                             fathidx = self._createpldir(fathidx, docidx,doc,elt)
                         else:
                             self._dirvec[fathidx][elt] = (-1, docidx)
+            self._pathidx[uprclutils.docpath(doc)] = docidx
 
         if False:
             for ent in self._dirvec:
                 uplog("%s" % ent)
 
-        self._initplaylists()
-                    
-        end = timer()
-        uplog("_rcl2folders took %.2f Seconds" % (end - start))
+
+    # Convert the _dirvec dicts to the compact arrays representation, and get rid of _dirvec.
+    def _freeze(self):
+        ndirs = len(self._dirvec)
+        self._names = []
+        nameidx = {}
+        self._dirparent = array('i', [0]) * ndirs
+        self._dirname = array('i', [-1]) * ndirs
+        self._dirdotdoc = array('i', [-2]) * ndirs
+        self._dirstart = array('i', [0]) * ndirs
+        self._dircount = array('i', [0]) * ndirs
+        self._childname = array('i')
+        self._childdir = array('i')
+        self._childdoc = array('i')
+        self._childbyname = array('i')
+        for diridx in range(ndirs):
+            children = []
+            for nm, ids in self._dirvec[diridx].items():
+                if nm == "..":
+                    self._dirparent[diridx] = ids[0]
+                elif nm == ".":
+                    self._dirdotdoc[diridx] = ids[1]
+                else:
+                    children.append((nm, ids[0], ids[1]))
+            # Free the memory as we go
+            self._dirvec[diridx] = None
+            self._addchildren(diridx, children, nameidx)
+        del self._dirvec
+
+
+    # Set the children for a directory, appending their slots at the end of the arrays.
+    # children is a list of (name, diridx, docidx) tuples
+    def _addchildren(self, diridx, children, nameidx=None):
+        start = len(self._childname)
+        for nm, cdiridx, cdocidx in children:
+            if nameidx is not None:
+                try:
+                    nmidx = nameidx[nm]
+                except KeyError:
+                    nmidx = len(self._names)
+                    nameidx[nm] = nmidx
+                    self._names.append(nm)
+            else:
+                nmidx = len(self._names)
+                self._names.append(nm)
+            self._childname.append(nmidx)
+            if cdiridx >= 0 and self._dirname[cdiridx] == -1:
+                self._dirname[cdiridx] = nmidx
+            self._childdir.append(cdiridx)
+            self._childdoc.append(cdocidx)
+        self._dirstart[diridx] = start
+        self._dircount[diridx] = len(children)
+        byname = sorted(range(len(children)), key=lambda i: _namekey(children[i][0]))
+        self._childbyname.extend([start + i for i in byname])
+
+
+    # Return the range of child slots for directory
+    def _children(self, diridx):
+        start = self._dirstart[diridx]
+        return range(start, start + self._dircount[diridx])
+
+
+    # Return the slot for the named child of directory, or -1
+    def _childslot(self, diridx, nm):
+        key = _namekey(nm)
+        lo = self._dirstart[diridx]
+        hi = lo + self._dircount[diridx]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            slot = self._childbyname[mid]
+            mkey = _namekey(self._names[self._childname[slot]])
+            if mkey < key:
+                lo = mid + 1
+            elif mkey > key:
+                hi = mid
+            else:
+                return slot
+        return -1
+
+
+    # Test if a directory should be skipped when listing its parent: this is the case for the empty
+    # topdirs (the other directories have at least a "." entry).
+    def _isemptydir(self, diridx):
+        return self._dircount[diridx] == 0 and self._dirdotdoc[diridx] == -2
 
 
     # Fetch all the docs by querying Recoll with [mime:*], which is guaranteed to match every doc
@@ -434,7 +755,7 @@ class Folders(object):
             if  idx >= len(self._rcldocs):
                 raise Exception(f"folders:browse: bad pid exceeds rcldocs size [{pid}]")
         else:
-            if  idx >= len(self._dirvec):
+            if  idx >= len(self._dirparent):
                 raise Exception(f"folders:browse: bad pid exceeds dirvec size [{pid}]")
 
         return (isitem, idx, pathremain)
@@ -451,7 +772,7 @@ class Folders(object):
             return self._moredocs[docidx - len(self._rcldocs)]        
 
     # Look all non-directory docs inside directory, and return the
-    # cover art we find. 
+    # cover art we find. This is computed for all directories by _initart().
     #
     # TBD In the case where this is a Group directory, we'd
     # need to go look into the file system for a group.xxx image.  As
@@ -465,35 +786,15 @@ class Folders(object):
     # path. Currently this works if one of the subdirs has an audio
     # file with an external cover.
     def _arturifordir(self, diridx):
-        for nm,ids in self._dirvec[diridx].items():
-            docidx = ids[1]
-            if docidx >= 0 and docidx < len(self._rcldocs):
-                doc = self._rcldocs[docidx]
-                # We used to only look for art for direct children
-                # tracks, but we now also look at subdirs. This will
-                # yield an image from the first subdir which has an
-                # image file in it, so somewhat random, but nice
-                # anyway. The condition is kept around to show how to
-                # change our minds or make it optional.
-                if True or doc["mtype"] != 'inode/directory':
-                    arturi = uprclutils.docarturi(doc,self._httphp,self._pprefix,preferfolder=True)
-                    if arturi:
-                        return arturi
+        return self._dirart[diridx]
 
     def _browsemeta(self, pid, isitem, idx):
         docidx = -1
         if isitem:
             docidx = idx
-        else:
-            try:
-                ids = self._dirvec[idx]
-                docidx = ids[1]
-            except:
-                pass
         if docidx != -1:
-            doc = self._docforidx(docidx)
             id = self._idprefix + '$i' + str(docidx)
-            e = rcldoctoentry(id, pid, self._httphp, self._pprefix, doc)
+            e = self.docentry(id, pid, docidx)
             return [e,]
 
     # Folder hierarchy browse method.
@@ -513,7 +814,7 @@ class Folders(object):
         # If there is only one entry in root, skip it. This means that 0
         # and 1 point to the same dir, but this does not seem to be an
         # issue
-        if not isitem and idx == 0 and len(self._dirvec[0]) == 2:
+        if not isitem and idx == 0 and self._dircount[0] == 1:
             idx = 1
 
         if flag == "meta":
@@ -521,19 +822,18 @@ class Folders(object):
                 raise Exception(f"uprclfolders:browse: browsemeta on non-item pid [{pid}]")
             return self._browsemeta(pid, isitem, idx)
 
-        #uplog(f"Folders browse: idx [{idx}] content: [{self._dirvec[idx]}]")
         entries = []
+        docidxs = []
         showtopart = True
         # The basename call is just for diridx==0 (topdirs). Remove it if
         # this proves a performance issue
-        for nm,ids in self._dirvec[idx].items():
-            if nm == ".." or nm == ".":
-                continue
-            thisdiridx = ids[0]
-            thisdocidx = ids[1]
+        for slot in self._children(idx):
+            nm = self._names[self._childname[slot]]
+            thisdiridx = self._childdir[slot]
+            thisdocidx = self._childdoc[slot]
             if thisdiridx >= 0:
                 # Skip empty directories
-                if len(self._dirvec[thisdiridx]) == 1:
+                if self._isemptydir(thisdiridx):
                     continue
                 # If there are directories, don't show art for the Tags top entries, this would
                 # show one of the subdir's art and looks weird
@@ -546,15 +846,17 @@ class Folders(object):
                 if thisdocidx == -1:
                     uplog("folders:docidx -1 for non-dir entry %s"%nm)
                     continue
-                doc = self._docforidx(thisdocidx)
-
-                id = self._idprefix + '$i' + str(thisdocidx)
-                e = rcldoctoentry(id, pid, self._httphp, self._pprefix, doc)
-                if e:
-                    entries.append(e)
+                docidxs.append(thisdocidx)
 
+        # Containers come first. The tracks are sorted using the precomputed ranks.
         if idx not in self._playlists:
-            entries.sort(key=cmpentries)
+            entries.sort(key=entrysortkey)
+            docidxs = self.sorteddocidxs(docidxs)
+        for docidx in docidxs:
+            id = self._idprefix + '$i' + str(docidx)
+            e = self.docentry(id, pid, docidx)
+            if e:
+                entries.append(e)
 
         # Add "Browse subtree by tags" entry
         if not self._notagview and pid != self._idprefix and self._enabletags:
@@ -584,18 +886,13 @@ class Folders(object):
     
         lpath = []
         while True:
-            fathidx = self._dirvec[diridx][".."][0]
-            found = False
-            for nm, ids in self._dirvec[fathidx].items():
-                if ids[0] == diridx:
-                    lpath.append(nm)
-                    found = True
-                    break
-            # End for
-            if not found:
+            fathidx = self._dirparent[diridx]
+            nmidx = self._dirname[diridx]
+            if nmidx < 0:
                 uplog("uprclfolders: pwd failed for %s \
                 (father not found), returning /" % objid)
                 return "/"
+            lpath.append(self._names[nmidx])
             if len(lpath) > 200:
                 uplog("uprclfolders: pwd failed for %s \
                 (looping), returning /" % objid)
@@ -636,11 +933,11 @@ class Folders(object):
             return -1,-1
         docidx = -1
         for elt in pathl:
-            if not elt in self._dirvec[fathidx]:
-                #uplog("_stat: element %s has no entry in %s" %
-                #      (elt, self._dirvec[fathidx]))
+            slot = self._childslot(fathidx, elt) if fathidx >= 0 else -1
+            if slot < 0:
+                #uplog("_stat: element %s has no entry in %s" % (elt, fathidx))
                 return -1,-1
-            fathidx, docidx = self._dirvec[fathidx][elt]
+            fathidx, docidx = self._childdir[slot], self._childdoc[slot]
 
         return fathidx, docidx
         
@@ -663,3 +960,123 @@ class Folders(object):
             id = self._idprefix + '$xdocid' + doc.xdocid
         #uplog(f"objidfordoc: returning {id}")
         return id
+
+
+    # Same as objidfordoc() for one of our docs, identified by its index. Items get their actual
+    # tree id in this case.
+    def objidfordocidx(self, docidx):
+        doc = self._rcldocs[docidx]
+        if doc["mtype"] == 'inode/directory':
+            return self._objidforpath(doc)
+        return self._idprefix + '$i' + str(docidx)
+
+    # Return the index of a doc (e.g. from a recoll search) in our docs array, or -1 if it is not
+    # in the tree.
+    def docidxfordoc(self, doc):
+        return self._docidxforpath(uprclutils.docpath(doc))
+
+    # Sort key for one of our docs, consistent with uprclutils.entrysortkey() for the entries: a
+    # directory gets the container key, and a track its rank, which is cheaper to compare than
+    # the full key (the first element is different, so the two kinds of keys can be mixed).
+    def docsortkey(self, docidx):
+        doc = self._rcldocs[docidx]
+        if doc["mtype"] == 'inode/directory':
+            tt = doc["title"]
+            if not tt:
+                path = doc["url"]
+                tt = os.path.basename(path[path.find('//')+2:])
+            return (0, tt.lower())
+        return (1, self._entryrank[docidx])
+
+
+# Memory benchmark for the folders tree: build a synthetic tree with nfiles tracks (10 per album
+# directory, 10 albums per artist directory), and compare the memory used by the _dirvec dicts and
+# by the compact arrays which replace them.
+def _membench(nfiles):
+    import tracemalloc
+    topdir = "/bench/music"
+    docs = []
+    for i in range(nfiles):
+        path = f"{topdir}/artist{i//100:05d}/album{(i//10)%10:02d}/{i%10:02d} track.flac"
+        doc = recoll.Doc()
+        if _has_resultstore:
+            doc["url"] = 'file://' + path
+        else:
+            doc.setbinurl(bytearray(b'file://' + path.encode('utf-8')))
+        doc.mtype = "audio/flac"
+        docs.append(doc)
+    folders = Folders.__new__(Folders)
+    folders._rcldocs = docs
+    folders._moredocs = []
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    folders._builddirvec([topdir])
+    dictmem = tracemalloc.get_traced_memory()[0] - base
+    folders._freeze()
+    arraymem = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+    print(f"{nfiles} files, {len(folders._dirparent)} directories")
+    print(f"dicts:  {dictmem/(1024*1024):.1f} MB")
+    print(f"arrays: {arraymem/(1024*1024):.1f} MB")
+
+
+# Speed benchmark for the browse entries: build nfiles entries (all in one directory, as for a big
+# album or items listing) with rcldoctoentry(), then with docentry() on a cold and on a warm cache,
+# then sort them.
+def _entrybench(nfiles):
+    docs = []
+    for i in range(nfiles):
+        path = f"/bench/music/album/{i:05d} track.flac"
+        doc = recoll.Doc()
+        if _has_resultstore:
+            doc["url"] = 'file://' + path
+        else:
+            doc.setbinurl(bytearray(b'file://' + path.encode('utf-8')))
+        doc.mtype = "audio/flac"
+        doc.title = f"Title {i}"
+        doc.artist = "Some Artist"
+        doc.album = "Some Album"
+        doc.tracknumber = str(i)
+        doc.date = "2001"
+        docs.append(doc)
+    folders = Folders.__new__(Folders)
+    folders._httphp = "127.0.0.1:9090"
+    folders._pprefix = "/uprcl"
+    folders._rcldocs = docs
+    folders._moredocs = []
+    folders._entrycache = OrderedDict()
+    folders._builddirvec(["/bench/music"])
+    folders._freeze()
+    folders._playlists = set()
+    folders._initart()
+    folders._initsortranks()
+    pid = "0$uprcl$folders$d2"
+    def run(what, func):
+        start = timer()
+        for docidx in range(nfiles):
+            func(docidx)
+        secs = timer() - start
+        print(f"{what}: {nfiles/secs:.0f} entries/S")
+    run("rcldoctoentry", lambda docidx: rcldoctoentry(
+        f"{pid}$i{docidx}", pid, folders._httphp, folders._pprefix, docs[docidx],
+        arturi=folders.docarturi(docidx)))
+    run("docentry, cold", lambda docidx: folders.docentry(f"{pid}$i{docidx}", pid, docidx))
+    run("docentry, warm", lambda docidx: folders.docentry(f"{pid}$i{docidx}", pid, docidx))
+    # Sorting the listing: by computing the keys from the entries, or with the precomputed ranks
+    entries = [folders.docentry(f"{pid}$i{docidx}", pid, docidx) for docidx in range(nfiles)]
+    docidxs = list(reversed(range(nfiles)))
+    start = timer()
+    sorted(entries, key=uprclutils.itemsortkey)
+    sorted(entries, key=entrysortkey)
+    print(f"sorting entries by keys: {timer() - start:.3f} S")
+    start = timer()
+    folders.sorteddocidxs(docidxs, items=True)
+    folders.sorteddocidxs(docidxs)
+    print(f"sorting docidxs by ranks: {timer() - start:.3f} S")
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == "entrybench":
+        _entrybench(int(sys.argv[2]) if len(sys.argv) > 2 else 10000)
+    else:
+        _membench(int(sys.argv[1]) if len(sys.argv) > 1 else 200000)
@@ -0,0 +1,128 @@
+# Copyright (C) 2026 J.F.Dockes
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Optional SQLite FTS5 index for the UPnP searches.
+#
+# When uprclftssearch is set, we create a full text table in the tags db, with one row for each
+# audio file and directory from the recoll docs, each album (not the discs of merged albums), and
+# each artist. uprclsearch then runs the searches which it can translate (see
+# uprclsearch._upnpsearchtofts()) against it instead of querying recoll, which avoids opening the
+# Xapian index for each search, and lets us use prefix matching.
+#
+# The table columns are:
+#  - kind: 't' for a file, 'd' for a directory, 'a' for an album, 'r' for an artist. This is
+#    indexed so that the upnp:class conditions can be part of the MATCH expression.
+#  - ref: the docidx for files and directories, the album_id or artist_id for the others.
+#  - path: the file, directory or album folder path, for restricting a search to a directory.
+#  - title, filename, album, artist, composer, genre: the searched fields.
+#
+# The index is entirely rebuilt with the tags db, including on incremental updates: it is quick
+# to create compared to the rest, and the docidx values change anyway.
+
+import sqlite3
+from timeit import default_timer as timer
+
+from upmplgutils import uplog, getOptionValue
+from conftree import valToBool
+from uprclutils import audiomtypes
+
+_tbname = "ftsindex"
+
+_enabled = None
+
+def _hasfts5():
+    try:
+        conn = sqlite3.connect(":memory:")
+        conn.execute("CREATE VIRTUAL TABLE t USING fts5(c)")
+        conn.close()
+        return True
+    except Exception:
+        return False
+
+
+# Return True if the FTS search is configured and supported by our sqlite library
+def enabled():
+    global _enabled
+    if _enabled is None:
+        _enabled = valToBool(getOptionValue("uprclftssearch", False))
+        if _enabled and not _hasfts5():
+            uplog("uprclfts: uprclftssearch is set but sqlite has no FTS5 support")
+            _enabled = False
+    return _enabled
+
+
+def _createtable(c):
+    c.execute(f"DROP TABLE IF EXISTS {_tbname}")
+    # The prefix indexes make the search-as-you-type queries fast for short words.
+    c.execute(f'''CREATE VIRTUAL TABLE {_tbname} USING fts5(kind, ref UNINDEXED, path UNINDEXED,
+    title, filename, album, artist, composer, genre,
+    tokenize = "unicode61 remove_diacritics 2", prefix = "1 2 3")''')
+
+
+# (Re)create the index from the recoll docs and the tags db albums and artists. Called at the
+# end of the tags db creation or update.
+def createindex(conn, rcldocs):
+    start = timer()
+    c = conn.cursor()
+    _createtable(c)
+    rows = []
+    for docidx in range(len(rcldocs)):
+        doc = rcldocs[docidx]
+        if doc["mtype"] not in audiomtypes:
+            continue
+        kind = 'd' if doc["mtype"] == 'inode/directory' else 't'
+        artists = " ".join(set([a for a in (doc["artist"], doc["albumartist"]) if a]))
+        rows.append((kind, docidx, doc["url"][7:], doc["title"], doc["filename"], doc["album"],
+                     artists, doc["composer"], doc["genre"]))
+    stmt = f'''INSERT INTO {_tbname}(kind, ref, path, title, filename, album, artist, composer, genre)
+    VALUES(?,?,?,?,?,?,?,?,?)'''
+    c.executemany(stmt, rows)
+    c.execute(f'''INSERT INTO {_tbname}(kind, ref, path, title, album, artist)
+    SELECT 'a', album_id, albfolder, albtitle, albtitle, artist.value
+    FROM albums LEFT JOIN artist ON artist.artist_id = albums.artist_id
+    WHERE albtdisc is NULL''')
+    c.execute(f'''INSERT INTO {_tbname}(kind, ref, path, title)
+    SELECT 'r', artist_id, '', value FROM artist''')
+    # Merge the index segments: we never modify the table after this
+    c.execute(f"INSERT INTO {_tbname}({_tbname}) VALUES('optimize')")
+    uplog(f"uprclfts: indexed {len(rows)} docs in {timer()-start:.1f} Seconds")
+
+
+# Return True if the db has an index (the option may have been set after it was created).
+def hasindex(conn):
+    c = conn.cursor()
+    c.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = ?", (_tbname,))
+    return c.fetchone() is not None
+
+
+# Run a search, returning a list of (kind, ref, title) tuples. matchexp is an FTS5 query
+# expression, or None to return everything. If filterdir is set, the results are restricted to the
+# files and folders inside it. This raises an exception if the expression is not valid.
+def search(conn, matchexp, filterdir=None):
+    where = []
+    values = []
+    if matchexp:
+        where.append(f"{_tbname} MATCH ?")
+        values.append(matchexp)
+    if filterdir:
+        filterdir = filterdir.rstrip("/") + "/"
+        where.append("substr(path, 1, ?) = ?")
+        values += [len(filterdir), filterdir]
+    stmt = f"SELECT kind, ref, title FROM {_tbname}"
+    if where:
+        stmt += " WHERE " + " AND ".join(where)
+    c = conn.cursor()
+    c.execute(stmt, values)
+    return c.fetchall()
@@ -17,15 +17,18 @@
 
 from __future__ import print_function
 
+import mimetypes
 import os
+import sys
 import time
 import bottle
-import mutagen
 import re
 
 from upmplgutils import uplog
-from uprclutils import embedded_open
+import uprclartcache
 import uprclinit
+import uprclreadahead
+import uprcltranscode
 
 # Checking for numeric HOST header
 _hostre = re.compile('''[0-9]+\.[0-9]+\.[0-9]+\.[0-9]+:[0-9]+|\[[0-9A-Fa-f:]+\]:[0-9]+''')
@@ -67,8 +70,22 @@ def main():
         else:
             reloadsecs = ''
 
+    cs = uprclinit.getBrowseCache().stats()
+    cachestats = f"{cs['entries']} entries, {cs['bytes']//1024} KB, " \
+        f"{cs['hits']} hits, {cs['misses']} misses"
+    cs = uprclinit.getFolderArtCache().stats()
+    artcachestats = f"{cs['entries']} entries, {cs['hits']} hits, {cs['misses']} misses"
+
+    cs = uprclreadahead.stats()
+    if cs['enabled']:
+        readaheadstats = f"{cs['tracks']} tracks served, {cs['hits']} prefetched " \
+            f"({100*cs['hitratio']:.0f}%), {cs['prefetchedbytes']//(1024*1024)} MB read ahead"
+    else:
+        readaheadstats = "disabled"
+
     return {'title':status, 'status':status, 'reloadsecs':reloadsecs,
-            'friendlyname':uprclinit.getFriendlyname()}
+            'friendlyname':uprclinit.getFriendlyname(), 'cachestats':cachestats,
+            'artcachestats':artcachestats, 'readaheadstats':readaheadstats}
 
 
 @bottle.route('/static/<filepath:path>')
@@ -97,13 +114,15 @@ class Streamer(object):
             i = filepath.rfind('.')
             filepath = filepath[:i]
             apath = os.path.join(self.root,filepath)
-            ctype, size, f = embedded_open(apath)
-            fs = os.stat(apath)
-            lm = time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime(fs.st_mtime))
-            bottle.response.set_header("Last-Modified", lm)
-            bottle.response.set_header("Content-type", ctype)
-            bottle.response.set_header("Content-Length", size)
-            return f
+            # The image is extracted once and then served from the art cache
+            try:
+                imgpath, ctype, etag = uprclartcache.embeddedart(
+                    apath, bottle.request.query.get('size'))
+            except Exception as ex:
+                uplog(f"uprcl: no embedded image for {apath}: {ex}")
+                return bottle.HTTPResponse(status=404)
+            return _streamfile(imgpath, ctype, etag=etag,
+                               extraheaders={"Cache-Control": "max-age=86400"})
         # Binary paths: transmitted as follows (See bottle._handle())
         #   binarypath->binarypath.decode('latin1')->urlquote()->NETWORK->
         #   urlunquote()->encode('latin1').decode('utf-8', 'ignore')
@@ -122,15 +141,186 @@ class Streamer(object):
                 uplog("uprcl: no such file: %s" % fullpath)
                 return bottle.HTTPResponse(status=404)
         uplog("Streaming: %s " % fullpath)
-        mutf = mutagen.File(fullpath)
-            
-        if mutf:
-            return bottle.static_file(fullpath, root=root,
-                                      mimetype=mutf.mime[0])
-        else:
-            return bottle.static_file(fullpath, root=root)
+        doc = _docforpath(fullpath)
+        # Only the first request for a track starts the read-ahead, not the HEAD requests or the
+        # range requests for the rest of the data.
+        if bottle.request.method != 'HEAD' and _fromstart(bottle.request.environ):
+            uprclreadahead.trackstarted(fullpath, doc)
+        tc = uprcltranscode.transcoding(fullpath, doc, bottle.request.environ.get('REMOTE_ADDR'))
+        if tc:
+            return _streamtranscoded(fullpath, tc)
+        return _streamfile(fullpath, _mimetypeforpath(fullpath, doc))
     
 
+_rangefromstartre = re.compile(r'\s*bytes\s*=\s*0+\s*-')
+
+# Check if a request is for the beginning of the file: no Range header, or a first range starting
+# at 0.
+def _fromstart(environ):
+    rng = environ.get('HTTP_RANGE')
+    return not rng or _rangefromstartre.match(rng) is not None
+
+
+# Get the recoll doc for a track (the tracks are in the folders tree).
+def _docforpath(path):
+    bpath = path if isinstance(path, bytes) else path.encode('utf-8', errors='surrogateescape')
+    try:
+        return uprclinit.getTree('folders').docforpath(bpath)
+    except Exception as ex:
+        # No trees yet ?
+        uplog(f"Streamer: no doc for {path}: {ex}")
+    return None
+
+
+# Get the MIME type for a file from the recoll data, or guess it from the file name. This avoids
+# parsing the file (and this is what we announced in the container listing anyway).
+def _mimetypeforpath(path, doc):
+    mtype = doc["mtype"] if doc else None
+    if not mtype:
+        bpath = path if isinstance(path, bytes) else path.encode('utf-8', errors='surrogateescape')
+        mtype, encoding = mimetypes.guess_type(bpath.decode('utf-8', errors='replace'))
+    return mtype if mtype else 'application/octet-stream'
+
+
+# Stream a transcoded file: from the transcoding cache if it is there (with Range support), else
+# from the transcoder output as it is produced. The size is unknown in this case, so the response
+# is chunked and ranges are ignored.
+def _streamtranscoded(path, tc):
+    cpath = uprcltranscode.cachedpath(path, tc)
+    if cpath:
+        return _streamfile(cpath, tc.mtype)
+    headers = {"Content-Type": tc.mtype, "Accept-Ranges": "none"}
+    if bottle.request.method == 'HEAD':
+        return bottle.HTTPResponse('', **headers)
+    return bottle.HTTPResponse(uprcltranscode.stream(path, tc), **headers)
+
+
+_httpdatefmt = "%a, %d %b %Y %H:%M:%S GMT"
+
+# Maximum number of ranges (after merging) that we serve as a multipart/byteranges response. We send
+# the whole file for requests with more.
+_maxranges = 16
+
+# Sort the (start, end) ranges and merge the overlapping or adjacent ones, so that a request with
+# many small or overlapping ranges does not result in as many reads.
+def _mergeranges(ranges):
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(end, merged[-1][1]))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+# Stream a file, handling conditional requests (If-None-Match, If-Modified-Since, If-Range) and
+# single or multiple byte ranges. The ETag is computed from the file mtime, size and inode if it is
+# not set by the caller.
+#
+# The data for a full file or a single range is sent by returning the file object positioned at
+# the range start, with a Content-Length header. bottle then hands it to the server through
+# wsgi.file_wrapper, and waitress sends the data from the file in its I/O thread, without
+# going through a Python loop in our thread (which is what bottle.static_file does for ranges).
+# Multiple ranges need a multipart/byteranges body, built by a generator. The ranges are merged
+# and their number is limited (see _mergeranges()).
+def _streamfile(path, mtype, etag=None, extraheaders={}):
+    try:
+        f = open(path, 'rb')
+        st = os.fstat(f.fileno())
+    except Exception as ex:
+        uplog(f"Streamer: can't open {path}: {ex}")
+        return bottle.HTTPResponse(status=404)
+
+    size = st.st_size
+    lm = time.strftime(_httpdatefmt, time.gmtime(st.st_mtime))
+    if not etag:
+        etag = f'"{st.st_mtime_ns:x}-{size:x}-{st.st_ino:x}"'
+    headers = {"Content-Type": mtype, "Last-Modified": lm, "ETag": etag,
+               "Accept-Ranges": "bytes"}
+    headers.update(extraheaders)
+    environ = bottle.request.environ
+
+    inm = environ.get('HTTP_IF_NONE_MATCH')
+    ims = environ.get('HTTP_IF_MODIFIED_SINCE')
+    if inm:
+        notmodified = etag in [t.strip() for t in inm.split(',')] or inm.strip() == '*'
+    elif ims:
+        ims = bottle.parse_date(ims.split(";")[0].strip())
+        notmodified = ims is not None and ims >= int(st.st_mtime)
+    else:
+        notmodified = False
+    if notmodified:
+        f.close()
+        headers["Date"] = time.strftime(_httpdatefmt, time.gmtime())
+        return bottle.HTTPResponse(status=304, **headers)
+
+    ranges = None
+    if 'HTTP_RANGE' in environ:
+        # If-Range: only honour the Range header if the file did not change
+        ifrange = environ.get('HTTP_IF_RANGE')
+        if not ifrange or ifrange.strip() in (etag, lm):
+            ranges = list(bottle.parse_range_header(environ['HTTP_RANGE'], size))
+            if not ranges:
+                f.close()
+                headers["Content-Range"] = f"bytes */{size}"
+                return bottle.HTTPResponse(status=416, **headers)
+            if len(ranges) > 1:
+                ranges = _mergeranges(ranges)
+                if len(ranges) > _maxranges:
+                    uplog(f"Streamer: {len(ranges)} ranges requested, sending the whole file")
+                    ranges = None
+
+    if bottle.request.method == 'HEAD':
+        f.close()
+        f = ''
+
+    if not ranges:
+        headers["Content-Length"] = str(size)
+        return bottle.HTTPResponse(f, **headers)
+
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        headers["Content-Range"] = f"bytes {start}-{end-1}/{size}"
+        headers["Content-Length"] = str(end - start)
+        if f:
+            f.seek(start)
+        return bottle.HTTPResponse(f, status=206, **headers)
+
+    # Multiple ranges. We need the body length in advance.
+    boundary = "uprclbyteranges%x" % int(time.time()*1000000)
+    parts = []
+    clen = 0
+    for start, end in ranges:
+        head = (f"--{boundary}\r\nContent-Type: {mtype}\r\n"
+                f"Content-Range: bytes {start}-{end-1}/{size}\r\n\r\n").encode('ascii')
+        parts.append((head, start, end))
+        clen += len(head) + (end - start) + 2
+    tail = f"--{boundary}--\r\n".encode('ascii')
+    clen += len(tail)
+    headers["Content-Type"] = f"multipart/byteranges; boundary={boundary}"
+    headers["Content-Length"] = str(clen)
+    body = _multirangeiter(f, parts, tail) if f else ''
+    return bottle.HTTPResponse(body, status=206, **headers)
+
+
+def _multirangeiter(f, parts, tail, maxread=1024*1024):
+    try:
+        for head, start, end in parts:
+            yield head
+            f.seek(start)
+            remain = end - start
+            while remain > 0:
+                data = f.read(min(maxread, remain))
+                if not data:
+                    break
+                remain -= len(data)
+                yield data
+            yield b"\r\n"
+        yield tail
+    finally:
+        f.close()
+
+
 # Bottle handle both the streaming and control requests.
 def runbottle(host='0.0.0.0', port=9278, pthstr='', pathprefix=''):
     global datadir
@@ -161,3 +351,57 @@ def runbottle(host='0.0.0.0', port=9278, pthstr='', pathprefix=''):
         bottle.route(rt, 'GET', streamer)
 
     bottle.run(server='waitress', host=host, port=port)
+
+
+# Streaming throughput benchmark: nclients threads repeatedly fetch the url for the given
+# duration, each request asking for a random range of rangesize bytes (or the whole file if
+# rangesize is 0). Prints the aggregate throughput and request rate.
+# Usage: python3 uprclhttp.py <url> [nclients] [rangesize] [seconds]
+def _benchstreaming(url, nclients=4, rangesize=1024*1024, seconds=10):
+    import random
+    import threading
+    import urllib.request
+    req = urllib.request.Request(url, method='HEAD')
+    with urllib.request.urlopen(req) as r:
+        size = int(r.headers['Content-Length'])
+    deadline = time.time() + seconds
+    totals = []
+    lock = threading.Lock()
+
+    def client():
+        nbytes = 0
+        nreqs = 0
+        while time.time() < deadline:
+            req = urllib.request.Request(url)
+            if rangesize and rangesize < size:
+                start = random.randrange(0, size - rangesize)
+                req.add_header('Range', f"bytes={start}-{start+rangesize-1}")
+            with urllib.request.urlopen(req) as r:
+                while True:
+                    data = r.read(256*1024)
+                    if not data:
+                        break
+                    nbytes += len(data)
+            nreqs += 1
+        with lock:
+            totals.append((nbytes, nreqs))
+
+    threads = [threading.Thread(target=client) for i in range(nclients)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+    nbytes = sum([t[0] for t in totals])
+    nreqs = sum([t[1] for t in totals])
+    print(f"{nclients} clients, {nreqs} requests in {elapsed:.1f} S: "
+          f"{nbytes/elapsed/(1024*1024):.1f} MB/S, {nreqs/elapsed:.1f} requests/S")
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print("Usage: uprclhttp.py <url> [nclients] [rangesize] [seconds]", file=sys.stderr)
+        sys.exit(1)
+    args = [int(a) for a in sys.argv[2:]]
+    _benchstreaming(sys.argv[1], *args)
@@ -17,6 +17,7 @@ from __future__ import print_function
 
 import conftree
 import copy
+import hashlib
 import locale
 import os
 import shutil
@@ -88,6 +89,11 @@ def _initconfdir(confdir, topdirs):
         f.write(b"skippedNames+ = " + exclpats.encode("utf-8") + b"\n")
     else:
         f.write(b"skippedNames+ = \n")
+    # In monitor mode, process the change events every few seconds instead of the default 30, so
+    # that new files appear quickly. Only set if the monitor is enabled, so that the recoll
+    # configuration does not change for the other users.
+    if conftree.valToBool(getOptionValue("uprclmonitor")):
+        f.write(b"monixinterval = 5\n")
     if userconfdata:
         f.write(userconfdata)
     f.close()
@@ -127,7 +133,63 @@ def indexerdone():
 
 def indexerstatus():
     return _lastidxstatus
-    
+
+
+# Monitor mode (uprclmonitor): a recollindex -m process watches the topdirs for changes and updates
+# the index in real time. It is started without an initial indexing pass, as it only runs after an
+# index update (by runindexer(), or by the monitor itself before it was stopped). It holds the
+# Xapian index write lock while it runs, so it must be stopped when we need to write to the index
+# (rebuild, or album and artist docs update, see uprcltagscreate.updaterecolldocs()). uprclinit
+# watches the index generation to know when to update the trees.
+_monproc = None
+
+def startmonitor(confdir):
+    global _monproc
+    if monitorrunning():
+        return
+    uplog("uprclindex: starting the index monitor")
+    # -n: no initial indexing pass, -D: stay in the foreground, -x: don't depend on an X11 session,
+    # -w 0: start immediately
+    _monproc = subprocess.Popen(["recollindex", "-c", confdir, "-m", "-n", "-D", "-x", "-w", "0"])
+
+def stopmonitor():
+    global _monproc
+    if _monproc is None:
+        return
+    uplog("uprclindex: stopping the index monitor")
+    # recollindex flushes the index and exits on SIGTERM
+    _monproc.terminate()
+    try:
+        _monproc.wait(timeout=60)
+    except subprocess.TimeoutExpired:
+        _monproc.kill()
+        _monproc.wait()
+    _monproc = None
+
+def monitorrunning():
+    return _monproc is not None and _monproc.poll() is None
+
+
+# Compute a value which changes whenever the Xapian index is modified. We use the names, sizes and
+# modification times of the index files: any indexer update which actually changed something will
+# have rewritten some of them. The lock file is touched by every indexer run and is ignored. An
+# empty string is returned if there is no index yet.
+def indexgeneration(confdir):
+    dbdir = os.path.join(confdir, "xapiandb")
+    try:
+        names = sorted(os.listdir(dbdir))
+    except Exception:
+        return ""
+    md5 = hashlib.md5()
+    for nm in names:
+        if nm == "flintlock":
+            continue
+        try:
+            st = os.stat(os.path.join(dbdir, nm))
+        except Exception:
+            continue
+        md5.update(f"{nm}:{st.st_size}:{st.st_mtime_ns}\n".encode('utf-8'))
+    return md5.hexdigest()
 
 
 # Only used for testing
@@ -28,8 +28,11 @@ from uprclfolders import Folders
 from uprcluntagged import Untagged
 from uprclplaylists import Playlists
 from uprcltags import Tagged
+import uprcltagscreate
 import uprclsearch
 import uprclindex
+import uprclutils
+from uprclcache import BrowseCache
 from uprclhttp import runbottle
 import minimconfig
 
@@ -54,11 +57,31 @@ g_initstatus = False
 # Possible error message if not ok
 g_initmessage = ""
 
+### Index monitor (uprclmonitor)
+_g_monitor = False
+# Seconds between the checks for index changes made by the monitor
+_g_monitorpollsecs = 5
+# Index generation (see uprclindex.indexgeneration()) used by the last update
+_g_idxgeneration = None
+
 ### Data created during initialisation
 _g_trees = {}
 _g_trees_order = ['folders', 'playlists', 'tags', 'untagged']
 
+# The lock protects the _g_trees swap at the end of an update: browse and search operations hold
+# the read lock while they run, so that the trees they use stay consistent.
 g_dblock = ReadWriteLock()
+# Protects the g_initrunning test and set when starting an update
+_g_initlock = threading.Lock()
+
+# Browse results cache. Cleared when the trees change. Size set from the configuration in
+# uprcl_init()
+g_browsecache = BrowseCache()
+
+# Search results cache: the sorted result references for the recent searches (see
+# uprclsearch.search()), so that the following pages are served without running the search
+# again. Cleared when the trees change.
+g_searchcache = BrowseCache(maxentries=50)
 
 
 def getObjPrefix():
@@ -82,15 +105,26 @@ def getTree(treename):
 def getTreesOrder():
     return _g_trees_order
 
+def getBrowseCache():
+    return g_browsecache
+
+def getSearchCache():
+    return g_searchcache
+
+def getFolderArtCache():
+    return uprclutils.g_folderartcache
+
 def _reset_index():
     _update_index(True)
 
+# Return True if the trees can be used, which is the case if a previous update produced them, even
+# if a new one is running. This acquires the read lock in all cases, the caller must release it.
 def initdone():
     g_dblock.acquire_read()
-    if g_initrunning:
-        return False
-    else:
+    if _g_trees or not g_initrunning:
         return True
+    else:
+        return False
 
 def initstatus():
     return (g_initstatus, g_initmessage)
@@ -99,32 +133,37 @@ def updaterunning():
     return g_initrunning
 
     
-# Create or update Recoll index, then read and process the data. This runs in a separate thread, and
-# signals startup/completion by setting/unsetting the g_initrunning flag.
+# Create or update Recoll index, then read and process the data. This runs in a separate thread
+# started by start_index_update(), which sets the g_initrunning flag. The flag is reset when we are
+# done.
+#
+# The new trees are built while the previous ones (if any) keep being used for browsing and
+# searching. They are then swapped in under the write lock, which makes sure that no operation is
+# using the old ones at this point. The old trees go away when the last reference is dropped.
 #
-# While this is running, or after a failure any access to the root container from a Control Point
-# will display either an "Initializing" or error message.
+# During the initial update or after a failure with no previous data, any access to the root
+# container from a Control Point will display either an "Initializing" or error message.
 def _update_index(rebuild=False):
     uplog("Creating/updating index in %s for %s" % (_g_rclconfdir, g_rcltopdirs))
 
-    # We take the writer lock, making sure that no browse/search thread are active, then set the
-    # busy flag and release the lock. This allows future browse operations to signal the condition
-    # to the user instead of blocking (if we kept the write lock).
-    global g_initrunning, _g_trees, g_initstatus, g_initmessage
-    g_dblock.acquire_write()
-    g_initrunning = "Rebuilding" if rebuild else "Updating"
-    g_dblock.release_write()
-    uplog("_update_index: initrunning set")
-
+    global g_initrunning, _g_trees, g_initstatus, g_initmessage, _g_idxgeneration
     try:
         start = timer()
-        uprclindex.runindexer(_g_rclconfdir, g_rcltopdirs, rebuild=rebuild)
-        # Wait for indexer
-        while not uprclindex.indexerdone():
-            time.sleep(.5)
-        fin = timer()
-        uplog("Indexing took %.2f Seconds" % (fin - start))
-
+        if rebuild:
+            uprclindex.stopmonitor()
+        if uprclindex.monitorrunning():
+            # The monitor keeps the index up to date (and holds the write lock).
+            uplog("Index monitor running, not running the indexer")
+        else:
+            uprclindex.runindexer(_g_rclconfdir, g_rcltopdirs, rebuild=rebuild)
+            # Wait for indexer
+            while not uprclindex.indexerdone():
+                time.sleep(.5)
+            fin = timer()
+            uplog("Indexing took %.2f Seconds" % (fin - start))
+
+        # Changes made by the monitor after this point will trigger another update
+        _g_idxgeneration = uprclindex.indexgeneration(_g_rclconfdir)
         folders = Folders(_g_rclconfdir, _g_httphp, _g_pathprefix)
         untagged = Untagged(folders.rcldocs(), _g_httphp, _g_pathprefix)
         playlists = Playlists(folders.rcldocs(), _g_httphp, _g_pathprefix)
@@ -134,18 +173,60 @@ def _update_index(rebuild=False):
         newtrees['untagged'] = untagged
         newtrees['playlists'] = playlists
         newtrees['tags'] = tagged
-        _g_trees = newtrees
-        g_initstatus = True
+        g_dblock.acquire_write()
+        try:
+            _g_trees = newtrees
+            g_browsecache.clear()
+            g_searchcache.clear()
+            g_initstatus = True
+        finally:
+            g_dblock.release_write()
         uplog("Init done")
+        # Update the album and artist docs in the recoll index, used for searching. This is done
+        # after the swap as it can take some time, but still here, so that no other update can
+        # write to the recoll index at the same time. Our own changes must not trigger another
+        # update: the monitor is stopped if we wrote, so we can read the generation again.
+        try:
+            if uprcltagscreate.updaterecolldocs():
+                _g_idxgeneration = uprclindex.indexgeneration(_g_rclconfdir)
+        except Exception as ex:
+            uplog(f"Updating the recoll album and artist docs failed: {ex}")
     except Exception as ex:
         traceback.print_exc()
-        g_initstatus = False
         g_initmessage = str(ex)
         uplog(f"Initialisation failed with: {g_initmessage}")
+        # Keep serving the previous data if we have some
+        if not _g_trees:
+            g_initstatus = False
     finally:
-        g_dblock.acquire_write()
-        g_initrunning = ""
-        g_dblock.release_write()
+        # (Re)start the monitor if it is enabled: it is started after the first update, and may
+        # have been stopped for writing to the index.
+        if _g_monitor:
+            try:
+                uprclindex.startmonitor(_g_rclconfdir)
+            except Exception as ex:
+                uplog(f"Can't start the index monitor: {ex}")
+        with _g_initlock:
+            g_initrunning = ""
+
+
+# Monitor mode: recollindex -m updates the index when files change (see uprclindex.startmonitor()),
+# and we update the trees when it did. The monitor commits a batch of changes after each processing
+# of its event queue. We wait for the index generation to be stable during a polling interval before
+# starting an update, so that a burst of changes, like copying an album, results in a single update.
+# The update is incremental for the tags db, and the current trees stay in use until the new ones
+# are ready. If the update fails because the monitor modified the index while we were reading it,
+# the generation changed, and we will just try again.
+def _monitorloop():
+    prevgen = None
+    while True:
+        time.sleep(_g_monitorpollsecs)
+        gen = uprclindex.indexgeneration(_g_rclconfdir)
+        if _g_idxgeneration is not None and gen != _g_idxgeneration and gen == prevgen and \
+           not g_initrunning:
+            uplog("Index monitor: the index changed, updating")
+            start_index_update()
+        prevgen = gen
 
 
 # This is called from uprcl-app when starting up, before doing anything else. We read configuration
@@ -187,6 +268,10 @@ def uprcl_init():
         _g_httphp = ip + ":" + port
     uplog("uprcl: serving files on %s" % _g_httphp)
 
+    global g_browsecache
+    cachemb = getOptionValue("uprclbrowsecachemb", 10)
+    g_browsecache = BrowseCache(maxbytes=int(float(cachemb)*1024*1024))
+
     global _g_rclconfdir
     _g_rclconfdir = getOptionValue("uprclconfdir")
     _g_rclconfdir = getcachedir("uprcl", forcedpath=_g_rclconfdir)
@@ -234,8 +319,17 @@ def uprcl_init():
     # Turn g_rcltopdirs back into a string, that's how it's used by runindexer
     g_rcltopdirs = conftree.stringsToString(goodpthlist)
 
+    global _g_monitor
+    _g_monitor = conftree.valToBool(getOptionValue("uprclmonitor"))
+
     start_index_update()
 
+    if _g_monitor:
+        # The monitor process is started at the end of the first update.
+        monthread = threading.Thread(target=_monitorloop)
+        monthread.daemon = True
+        monthread.start()
+
     # Start the bottle app. It's both the control/config interface and the file streamer
     httpthread = threading.Thread(target=runbottle,
                                   kwargs = {'host':host ,
@@ -248,22 +342,17 @@ def uprcl_init():
     uplog("Init started")
 
 
-# This is called from the Bottle Web UI interface for requesting an index update or rebuild
+# This is called at startup and from the Bottle Web UI interface for requesting an index update or
+# rebuild. Nothing is done if an update is already running.
 def start_index_update(rebuild=False):
-    try:
-        # initdone() acquires the reader lock
-        if not initdone():
+    global g_initrunning
+    with _g_initlock:
+        if g_initrunning:
             return
-        targ = _reset_index if rebuild else _update_index
-        idxthread = threading.Thread(target=targ)
-        idxthread.daemon = True
-    finally:
-        # We need to release the reader lock before starting the index
-        # update operation (which needs a writer lock), so there is a
-        # small window for mischief. I would be concerned if this was
-        # a highly concurrent or critical app, but here, not so
-        # much...
-        g_dblock.release_read()
+        g_initrunning = "Rebuilding" if rebuild else "Updating"
+    targ = _reset_index if rebuild else _update_index
+    idxthread = threading.Thread(target=targ)
+    idxthread.daemon = True
     idxthread.start()
 
 
@@ -24,7 +24,7 @@
 import os, sys, subprocess
 
 from upmplgutils import uplog, direntry, getOptionValue, getConfigObject
-from uprclutils import rcldoctoentry, cmpentries
+from uprclutils import rcldoctoentry
 import uprclutils
 import uprclinit
 from recoll import recoll
@@ -41,10 +41,14 @@ class Playlists(object):
         self.recoll2playlists()
         self._radios = []
         radiolistid = self._idprefix + '$p' + str(len(self._pldocsidx))
+        # The radio definitions are read once for each index update (reading them runs a script for
+        # each radio to resolve its stream URL).
         if not conftree.valToBool(getOptionValue("uprclnoradioconf")):
-            radios = upradioconf.UpmpdcliRadios(getConfigObject())
-            for radio in radios:
+            for radio in upradioconf.UpmpdcliRadios(getConfigObject()):
                 self._radios.append(upradioconf.radioToEntry(radiolistid, None, radio))
+        # The root listing: the playlists, then the special entry for our radio list (its id is 1
+        # beyond the valid playlist ids).
+        self._rootentries = [self._idxtoentry(i) for i in range(1, len(self._pldocsidx) + 1)]
 
     # Return entry to be created in the top-level directory ([playlists]).
     def rootentries(self, pid):
@@ -106,26 +110,16 @@ class Playlists(object):
         plpath = uprclutils.docpath(pldoc)
         folders = uprclinit.getTree('folders')
         #uplog("playlists: plpath %s" % plpath)
+        pid = self._idprefix + "$p" + str(idx)
         entries = []
-        try:
-            m3u = uprclutils.M3u(plpath)
-        except Exception as ex:
-            uplog("M3u open failed: %s %s" % (plpath,ex))
-            return entries
-        cnt = 1
-        for url in m3u:
-            if m3u.urlRE.match(url):
+        for url, docidx in folders.playlistentries(plpath):
+            id = pid +  "$e" + str(len(entries))
+            if docidx is None:
                 # Actual URL (usually http). Create bogus doc
                 doc = folders.docforurl(url)
+                e = rcldoctoentry(id, pid, self._httphp, self._pprefix, doc)
             else:
-                docidx = folders.statpath(plpath, url)
-                if not docidx:
-                    continue
-                doc = self._rcldocs[docidx]
-                        
-            pid = self._idprefix + "$p" + str(idx)
-            id = pid +  "$e" + str(len(entries))
-            e = rcldoctoentry(id, pid, self._httphp, self._pprefix, doc)
+                e = folders.docentry(id, pid, docidx)
             if e:
                 entries.append(e)
         #uplog(f"playlistatidx: idx {idx} -> {entries}")
@@ -157,18 +151,13 @@ class Playlists(object):
             return []
 
         # Browsing children
-        entries = []
         if idx0 == 0:
             # Browsing root. Return contents
-            # Regular playlist entries, from our doc list.
-            for i in range(len(self._pldocsidx))[1:]:
-                entries.append(self._idxtoentry(i))
-            # Special entry for our radio list. The id is 1 beyond valid playlist ids
-            entries.append(self._idxtoentry(len(self._pldocsidx)))
+            entries = self._rootentries
         elif idx0 == len(self._pldocsidx):
             # Browsing the radio list
             entries = self._radios
         else:
             entries = self._playlistatidx(idx0)
 
-        return entries
+        return uprclutils.pagedentries(entries, offset, count)
@@ -0,0 +1,165 @@
+# Copyright (C) 2026 J.F.Dockes
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Album-aware read-ahead for the streamer.
+#
+# When the media is on a spun-down disk or a network share, each track change stalls while the disk
+# wakes up or the remote read starts. If uprclreadaheadmb is set, when the streamer starts serving a
+# track, a background thread reads the next tracks of the same album (in the album listing order,
+# see uprcltags.Tagged.nexttrackpaths()), up to uprclreadaheadmb bytes, so that their data is in the
+# system page cache when the renderer requests them.
+#
+# We don't know what the renderer will play next (it may be playing a playlist or a search result
+# list), so this is only a guess, and we count how often the requested tracks were in the last
+# prefetched ones (the hit ratio, shown on the status page) to check that it is useful.
+
+from collections import OrderedDict
+import os
+import queue
+import threading
+
+from upmplgutils import uplog, getOptionValue
+import uprclinit
+import uprcltagscreate
+
+# Number of following tracks which we prefetch (inside the byte budget)
+_maxtracks = 3
+# Number of prefetched paths which we remember for the hit ratio
+_maxremembered = 100
+# Number of recently started tracks which we remember, for ignoring repeated requests
+_maxrecent = 8
+_chunksize = 1024 * 1024
+
+_budget = None
+_queue = None
+_lock = threading.Lock()
+_recent = OrderedDict()
+_prefetched = OrderedDict()
+_stats = {"tracks": 0, "hits": 0, "prefetchedbytes": 0}
+
+
+def _bpath(path):
+    return path if isinstance(path, bytes) else path.encode('utf-8', errors='surrogateescape')
+
+
+# Return the byte budget, 0 if the read-ahead is disabled. Start the worker thread on the first call
+# if it is enabled.
+def _getbudget():
+    global _budget, _queue
+    if _budget is None:
+        try:
+            _budget = int(float(getOptionValue("uprclreadaheadmb", 0)) * 1024 * 1024)
+        except Exception as ex:
+            uplog(f"uprclreadahead: bad uprclreadaheadmb value: {ex}")
+            _budget = 0
+        if _budget > 0:
+            _queue = queue.Queue(maxsize=4)
+            worker = threading.Thread(target=_worker)
+            worker.daemon = True
+            worker.start()
+    return _budget
+
+
+# Called by the streamer for the first request of a track (not for HEAD or continuation range
+# requests). Some renderers request the beginning of a track several times (e.g. for probing the
+# format, or when a CP sets the next track), so a recently started track only counts once.
+def trackstarted(path, doc):
+    if not _getbudget():
+        return
+    bpath = _bpath(path)
+    with _lock:
+        if bpath in _recent:
+            _recent.move_to_end(bpath)
+            return
+        _recent[bpath] = True
+        if len(_recent) > _maxrecent:
+            _recent.popitem(last=False)
+        _stats["tracks"] += 1
+        if bpath in _prefetched:
+            _stats["hits"] += 1
+    if doc is None:
+        return
+    try:
+        _queue.put_nowait(doc)
+    except queue.Full:
+        pass
+
+
+# The worker uses its own tags db connection, the one from the Tagged object belongs to the browse
+# thread. The connection is reopened when the trees change, as the db file may have been replaced.
+def _worker():
+    conn = None
+    conntags = None
+    while True:
+        doc = _queue.get()
+        try:
+            folders = uprclinit.getTree('folders')
+            docidx = folders.docidxfordoc(doc)
+            if docidx < 0:
+                continue
+            tags = uprclinit.getTree('tags')
+            if tags is not conntags:
+                if conn:
+                    conn.close()
+                conn = uprcltagscreate.openreadonly()
+                conntags = tags
+            paths = tags.nexttrackpaths(conn, docidx, _maxtracks)
+        except Exception as ex:
+            # No trees yet ?
+            uplog(f"uprclreadahead: can't get the next tracks: {ex}")
+            continue
+        budget = _budget
+        for path in paths:
+            if budget <= 0:
+                break
+            budget -= _prefetch(path, budget)
+
+
+# Read the beginning of a file, up to maxbytes. We also call posix_fadvise() which lets the kernel
+# schedule big reads, but it is not honoured by all file systems (e.g. network ones), and the reads
+# are what actually wakes up a spun-down disk. Returns the byte count.
+def _prefetch(path, maxbytes):
+    total = 0
+    try:
+        with open(path, 'rb', buffering=0) as f:
+            size = min(os.fstat(f.fileno()).st_size, maxbytes)
+            if hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(f.fileno(), 0, size, os.POSIX_FADV_WILLNEED)
+            while total < size:
+                data = f.read(min(_chunksize, size - total))
+                if not data:
+                    break
+                total += len(data)
+    except Exception as ex:
+        uplog(f"uprclreadahead: can't read {path}: {ex}")
+    if not total:
+        return 0
+    with _lock:
+        bpath = _bpath(path)
+        _prefetched[bpath] = True
+        _prefetched.move_to_end(bpath)
+        if len(_prefetched) > _maxremembered:
+            _prefetched.popitem(last=False)
+        _stats["prefetchedbytes"] += total
+    return total
+
+
+# Return a dict of statistics values, for display
+def stats():
+    with _lock:
+        st = dict(_stats)
+    st["enabled"] = _getbudget() > 0
+    st["hitratio"] = st["hits"] / st["tracks"] if st["tracks"] else 0.0
+    return st
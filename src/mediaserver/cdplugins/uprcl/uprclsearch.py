@@ -14,10 +14,13 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 '''Translate an UPnP search string into a Recoll one and run the search. Note that the translation 
-is not exact, we are just making a best effort.'''
+is not exact, we are just making a best effort. If the FTS index is enabled (see uprclfts), the
+searches which can be translated for it run against it instead.'''
 
 import sys
+import os
 import re
+from timeit import default_timer as timer
 
 from recoll import recoll
 
@@ -284,11 +287,213 @@ def _upnpsearchtorecoll(s):
     return " ".join(out)
 
 
-def search(foldersobj, rclconfdir, inobjid, upnps, idprefix, httphp, pathprefix):
-    '''Run UPnP search operation. inobjid is for the container this search is run from.'''
+# FTS index columns for the recoll fields which we can search in it. As for recoll, the title
+# search also looks at the file names.
+_rcltoftscolumns = {
+    'title': '{title filename}',
+    'album': 'album',
+    'artist': 'artist',
+    'composer': 'composer',
+    'genre': 'genre',
+}
+
+# FTS index kinds for the upnp:class values, the first matching prefix is used. This is more precise
+# than the recoll translation, which can only distinguish directories and files.
+_classtoftskinds = (
+    ("object.container.album", "kind:a"),
+    ("object.container.person", "kind:r"),
+    ("object.container", "(kind:d OR kind:a OR kind:r)"),
+    ("object.item", "kind:t"),
+)
+
+# Matches all rows. FTS5 NOT is a binary operator, we use this as left operand for negations.
+_ftsall = "(kind:t OR kind:d OR kind:a OR kind:r)"
+
+
+def _ftsquote(w):
+    return '"' + w.replace('"', '""') + '"'
+
+
+def _ftsappend(out, exp):
+    '''Append a clause or an opening parenthesis. FTS5 has an implicit AND, but not before a
+    parenthesized group, so we make it explicit'''
+    if out and out[-1] != '(' and out[-1] != 'OR':
+        out.append('AND')
+    out.append(exp)
+
+
+def _makeFtsExp(v, field, oper, neg):
+    '''Process data from an UPnP relExp triplet, returning an FTS5 expression, or None if the
+    clause can't be translated.
+    v: terms or phrases out of _parseString, which are all required. The words are matched as
+       prefixes for "contains", as search-as-you-type Control Points send incomplete words.
+    field: FTS column or column set, or 'class'
+    oper: ':' or '='
+    neg: exclusion'''
+    if field == 'class':
+        exp = None
+        if len(v) == 1:
+            for prefix, kinds in _classtoftskinds:
+                if v[0].startswith(prefix):
+                    exp = kinds
+                    break
+        if not exp:
+            return None
+    else:
+        if not v or not field:
+            return None
+        suffix = '*' if oper == ':' else ''
+        exp = field + " : (" + " ".join([_ftsquote(w) + suffix for w in v]) + ")"
+    if neg:
+        exp = "(" + _ftsall + " NOT " + exp + ")"
+    return exp
+
+
+def _upnpsearchtofts(s):
+    '''Translate an UPnP search string into an FTS5 query expression for uprclfts.search(). This
+    works like _upnpsearchtorecoll(). We return an empty string for "*" (everything), and None if
+    the search uses a field which is not in the FTS index.'''
+
+    s = re.sub('[\t\n\r\f ]+', ' ', s)
+    if s.strip() == "*":
+        return ""
+
+    out = []
+    field = ""
+    oper = ""
+    neg = False
+    i = 0
+    while True:
+        i,c = _getchar(s, i)
+        if not c:
+            break
+        if c.isspace():
+            continue
+        if c == '(':
+            _ftsappend(out, c)
+        elif c == ')':
+            out.append(c)
+        elif c == '>' or c == '<' or c == '=':
+            oper += c
+        elif c == '"':
+            i,v = _parsestring(s, i)
+            if oper != 'I':
+                if oper != ':' and oper != '=':
+                    return None
+                exp = _makeFtsExp(v, field, oper, neg)
+                if not exp:
+                    return None
+                _ftsappend(out, exp)
+            field = ""
+            oper = ""
+            neg = False
+        else:
+            i -= 1
+            i,w = _readword(s, i)
+            w = w.lower()
+            if w == 'contains' or w == 'derivedfrom':
+                oper = ':'
+            elif w == 'doesnotcontain':
+                neg = True
+                oper = ':'
+            elif w == 'exists':
+                oper = 'I'
+            elif w == 'true' or w == 'false' or w == 'and':
+                pass
+            elif w == 'or':
+                out.append('OR')
+            elif w == 'upnp:class':
+                field = 'class'
+            else:
+                if w in _fieldaliases:
+                    w = _fieldaliases[w]
+                # The field name from the search was lowercased
+                field = None
+                for upnpfld, rclfld in uprclutils.upnp2rclfields.items():
+                    if upnpfld.lower() == w:
+                        field = _rcltoftscolumns.get(rclfld)
+                        break
+                if not field:
+                    return None
+    if not out:
+        return None
+    return " ".join(out)
+
+
+# The searches produce lists of light weight references to the results, which are sorted and kept in
+# a cache (uprclinit.getSearchCache()), so that we only need to build the entries for the requested
+# window, and the next pages of a search are served without running it again. A reference is a
+# (sortkey, kind, ref) tuple:
+#  - kind is 'a' or 'r' for albums and artists, with the album_id or artist_id as ref (str), or 'd'
+#    for the other results, with the Folders docidx as ref.
+#  - the sort keys order the references like uprclutils.entrysortkey() orders the entries:
+#    containers have the same key, and tracks use their rank (see Folders.docsortkey()).
+_refsize = 150
+
+def _refentry(foldersobj, tags, inobjid, kind, ref):
+    if kind == 'a':
+        return tags.direntryforalbid(ref)
+    elif kind == 'r':
+        return tags.direntryforartid(ref)
+    else:
+        return foldersobj.docentry(foldersobj.objidfordocidx(ref), inobjid, ref)
+
+
+def _ftssearch(foldersobj, tags, inobjid, upnps):
+    '''Run the search with the FTS index, returning a list of result references. Returns None if
+    this can't be done, in which case the caller should use recoll.'''
+    ftss = _upnpsearchtofts(upnps)
+    if ftss is None:
+        return None
+    uplog(f"Search: fts search: <{ftss}>")
+    filterdir = foldersobj.dirpath(inobjid)
+    if filterdir == "/":
+        filterdir = ""
+    try:
+        rows = tags.ftssearch(ftss, filterdir)
+    except Exception as ex:
+        uplog(f"Search: fts query raised: {ex}. Using recoll")
+        return None
+
+    refs = []
+    for kind, ref, title in rows:
+        if kind == 'a' or kind == 'r':
+            refs.append(((0, (title or "").lower()), kind, str(ref)))
+        else:
+            refs.append((foldersobj.docsortkey(ref), 'd', ref))
+    uplog("Search retrieved %d docs" % (len(refs),))
+    return refs
+
+
+def search(foldersobj, rclconfdir, inobjid, upnps, idprefix, httphp, pathprefix, offset=0, count=0):
+    '''Run UPnP search operation. inobjid is for the container this search is run from.
+    Returns (offset, total, entries) for the count results starting at offset, with all the
+    remaining ones if count is 0, like a paged browse.'''
 
     tags = uprclinit.getTree('tags')
 
+    cache = uprclinit.getSearchCache()
+    cachekey = (inobjid, upnps)
+    refs = cache.get(cachekey)
+    if refs is None:
+        if tags.hasftsindex():
+            refs = _ftssearch(foldersobj, tags, inobjid, upnps)
+        if refs is None:
+            refs = _recollsearch(foldersobj, tags, rclconfdir, inobjid, upnps)
+        refs.sort(key=lambda r: r[0])
+        cache.put(cachekey, refs, _refsize * len(refs))
+
+    total = len(refs)
+    window = refs[offset:offset+count] if count > 0 else refs[offset:]
+    entries = []
+    for sortkey, kind, ref in window:
+        e = _refentry(foldersobj, tags, inobjid, kind, ref)
+        if e:
+            entries.append(e)
+    return offset, total, entries
+
+
+def _recollsearch(foldersobj, tags, rclconfdir, inobjid, upnps):
     # Translate UPnP search string to recoll one
     rcls = _upnpsearchtorecoll(upnps)
 
@@ -314,43 +519,74 @@ def search(foldersobj, rclconfdir, inobjid, upnps, idprefix, httphp, pathprefix)
     if rclq.rowcount == 0:
         return []
     
-    entries = []
-    maxcnt = 0
+    refs = []
     while True:
         docs = rclq.fetchmany()
         for doc in docs:
             # The doc is either an actual recollindex product from the
             # FS or a synthetic one from uprcltags creating album
             # entries. Different processing for either
-            e = None
             if doc["rcludi"].find("albid") == 0:
-                albid = doc["rcludi"][5:]
-                #uplog(f"Search: album: {doc['rcludi']} albid {albid}")
-                e = tags.direntryforalbid(albid)
+                #uplog(f"Search: album: {doc['rcludi']}")
+                refs.append(((0, doc["title"].lower()), 'a', doc["rcludi"][5:]))
             elif doc["rcludi"].find("artid") == 0:
-                artid = doc["rcludi"][5:]
-                #uplog(f"Search: artist: {doc['rcludi']} albid {albid}")
-                e = tags.direntryforartid(artid)
-            else:
-                # Objidfordoc uses the path from the url to walk the _dirvec and determine the right
-                # entry if doc is a container. If doc is an item, the returned id is not usable but
-                # still unique (based on the xdocid). We used to return
-                # (0$uprcl$folders$seeyoulater), but this ennoys bubble to no end.  This still
-                # breaks the recommendation for the objids to be consistent and unchanging
-                id = foldersobj.objidfordoc(doc)
-                #uplog("Search: id [%s] for doc udi [%s]\n" % (id, doc["rcludi"]))
-                e = uprclutils.rcldoctoentry(id, inobjid, httphp, pathprefix, doc)
-            #uplog(f"Search: entry: {e}")
-            if e:
-                entries.append(e)
-        if (maxcnt > 0 and len(entries) >= maxcnt) or len(docs) != rclq.arraysize:
+                #uplog(f"Search: artist: {doc['rcludi']}")
+                refs.append(((0, doc["title"].lower()), 'r', doc["rcludi"][5:]))
+            elif doc["mtype"] in uprclutils.audiomtypes:
+                # Find the doc in the folders tree by walking its path, so that we can use the
+                # precomputed sort ranks and entry data and return the tree ids, which stay the
+                # same for a given tree. Docs which are not in the tree (the index was updated
+                # since it was built) are dropped.
+                docidx = foldersobj.docidxfordoc(doc)
+                if docidx >= 0:
+                    refs.append((foldersobj.docsortkey(docidx), 'd', docidx))
+        if len(docs) != rclq.arraysize:
             break
-    uplog("Search retrieved %d docs" % (len(entries),))
+    uplog("Search retrieved %d docs" % (len(refs),))
+    return refs
+
+# Latency comparison between the recoll and FTS searches, run on an existing uprcl cache directory,
+# with a tags db created with uprclftssearch set. Only the queries and result fetching are timed, not
+# the entries creation, which is the same for both. Note that the result counts may differ, as the
+# FTS search matches prefixes and is more precise for upnp:class.
+def _searchbench(confdir, upnps, count=20):
+    import sqlite3
+    import uprclfts
+    import uprcltagscreate
+    rcls = _upnpsearchtorecoll(upnps)
+    ftss = _upnpsearchtofts(upnps)
+    print(f"recoll: <{rcls}>\nfts: <{ftss}>")
+
+    start = timer()
+    for i in range(count):
+        # We connect for each search, as search() does
+        rcldb = recoll.connect(confdir=confdir)
+        rclq = rcldb.query()
+        rclq.execute(rcls)
+        nrcl = 0
+        while True:
+            docs = rclq.fetchmany()
+            nrcl += len(docs)
+            if len(docs) != rclq.arraysize:
+                break
+    rcltime = (timer() - start) / count
+
+    conn = sqlite3.connect(os.path.join(confdir, uprcltagscreate._dbname))
+    start = timer()
+    for i in range(count):
+        rows = uprclfts.search(conn, ftss)
+    ftstime = (timer() - start) / count
+    print(f"recoll: {nrcl} results in {1000*rcltime:.2f} mS. fts: {len(rows)} results in "
+          f"{1000*ftstime:.2f} mS")
 
-    entries.sort(key=uprclutils.cmpentries)
-    return entries
 
 if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == "bench":
+        if len(sys.argv) != 4:
+            print("Usage: uprclsearch.py bench <uprclcachedir> <upnpsearch>", file=sys.stderr)
+            sys.exit(1)
+        _searchbench(sys.argv[2], sys.argv[3])
+        sys.exit(0)
     s = '(upnp:artist derivedFrom  "abc\\"def\\g") or (dc:title:xxx) '
     s = 'upnp:class derivedfrom "object.container.album" and dc:title contains "n"'
     if len(sys.argv) > 1:
@@ -358,3 +594,4 @@ if __name__ == '__main__':
     print("INPUT: %s" % s)
     o = _upnpsearchtorecoll(s)
     print("OUTPUT: %s" % o)
+    print("FTS: %s" % _upnpsearchtofts(s))
@@ -31,14 +31,20 @@ import time
 
 from upmplgutils import uplog, direntry
 import uprclutils
-from uprclutils import rcldoctoentry, cmpentries, cmpitems
 import uprclinit
 import uprcltagscreate
-from uprcltagscreate import _clid, _junctb, recolltosql
+import uprclfts
+from uprcltagscreate import _clid, _junctb, recolltosql, opentagsdb
 
 def _tblst(tabnames):
     return ",".join(tabnames)
 
+# ORDER BY clauses for the track lists, equivalent to sorting the entries with
+# uprclutils.entrysortkey() or itemsortkey(). docidx makes the order of equal keys stable.
+_entryorder = " ORDER BY tracks.sortalbum, tracks.sortdir, tracks.sorttno, tracks.sortfile, " \
+    "tracks.docidx"
+_itemorder = " ORDER BY tracks.sorttitle, tracks.sortalbum, tracks.docidx"
+
 # The browseable object which defines the tree of tracks organized by tags.
 class Tagged(object):
     # We maintain a cache for the total count of query statements
@@ -46,29 +52,28 @@ class Tagged(object):
     # slice (which we currently only do when displaying the top-level
     # items list, so the cache can actually never have more than 1 element...)
     _stmt_cnt_cachesize = 20
+    # Cache for the facet counts (see _facetcounts()). The db never changes during the lifetime of
+    # this object, so the entries stay valid, we just limit the size.
+    _facet_cachesize = 1000
     def __init__(self, rcldocs, httphp, pathprefix):
         self._httphp = httphp
         self._pprefix = pathprefix
         self._conn = None
-        self._init_sqconn()
+        self._init_sqconn(rcldocs)
         self._stmt_cnt_cache = {}
         self._stmt_cnt_cachequeue = []
+        self._facet_cache = {}
         self.hidden = []
-        recolltosql(self._conn, rcldocs)
         
 
-    def _init_sqconn(self):
-        # We use a separate thread for building the db to ensure
-        # responsiveness during this phase.  :memory: handles normally
-        # can't be shared between threads, and different :memory: handles
-        # access different dbs. The following would work, but it needs
-        # python 3.4
-        #self._conn = sqlite3.connect('file:uprcl_db?mode=memory&cache=shared')
-        # As we can guarantee that 2 threads will never access the db at
-        # the same time (the init thread just goes away when it's done),
-        # we just disable the same_thread checking on :memory:
+    def _init_sqconn(self, rcldocs):
+        # The db lives in a file in the cache directory, and is only rebuilt if the recoll data or
+        # the configuration changed since it was created (see opentagsdb()).
+        # We use a separate thread for building the db to ensure responsiveness during this
+        # phase. As we can guarantee that 2 threads will never access the db at the same time (the
+        # init thread just goes away when it's done), we disable the same_thread checking.
         if self._conn is None:
-            self._conn = sqlite3.connect(':memory:', check_same_thread=False)
+            self._conn = opentagsdb(rcldocs)
 
 
     # Create our top-level directories, with fixed entries, and stuff
@@ -85,10 +90,8 @@ class Tagged(object):
         else:
             where = " "
             args = ()
-        c = self._conn.cursor()
-        stmt = f"SELECT COUNT(*) from tracks {where}"
-        c.execute(stmt, args)
-        nitems = str(c.fetchone()[0])
+        ntracks, counts = self._facetcounts(where, ["tracks",], args)
+        nitems = str(ntracks)
         entries.append(direntry(pid + 'items', pid, nitems + ' items'))
         subqs = self._subtreetags(where, ["tracks",], args)
         tagdisplaytag = uprcltagscreate.getTagDisplayTag()
@@ -97,43 +100,63 @@ class Tagged(object):
         return entries
 
 
-    # List all tags which still have multiple values inside this selection level
-    def _subtreetags(self, where, seltables, values):
+    # Compute the number of tracks in the selection, and the number of distinct values inside the
+    # selection for all the index tags which are not already part of it. This is done by a single
+    # statement: the selection is computed once as a common table expression, and the counts for
+    # each tag are computed from it and aggregated with UNION ALL. The results are cached for the
+    # selection.
+    # Returns (ntracks, {tagname: count})
+    def _facetcounts(self, where, seltables, values):
         where = where.strip()
-        #uplog(f"_subtreetags: where: [{where}]")
-        c = self._conn.cursor()
-        tags = []
+        key = (where, tuple(seltables), tuple(values))
+        try:
+            return self._facet_cache[key]
+        except KeyError:
+            pass
         indextags = uprcltagscreate.getIndexTags()
         tagtotable = uprcltagscreate.getTagToTable()
-        if where:
-            conjunct = "AND"
-        else:
-            conjunct = "WHERE"
-        for tt in indextags:
-            tb = tagtotable[tt]
-            if _junctb(tb) in seltables:
-                continue
-            stmt = f"SELECT COUNT(DISTINCT {_junctb(tb)}.{_clid(tb)}) " \
-                f"FROM {_tblst(seltables)},{_junctb(tb)} {where} " \
-                f"{conjunct} tracks.docidx = {_junctb(tb)}.docidx"
-            #uplog(f"subtreetags: executing: {stmt}. Values: {values}")
-            c.execute(stmt, values)
-            cnt = c.fetchone()[0]
-            #uplog(f"subtreetags: {cnt} values for {tb} ({stmt[:200]},{values})")
-            if cnt > 1:
-                tags.append(tt)
-        return tags
+        tags = [tt for tt in indextags if _junctb(tagtotable[tt]) not in seltables]
+        stmt = f"WITH sel(docidx) AS (SELECT tracks.docidx FROM {_tblst(seltables)} {where}) " \
+            "SELECT -1, COUNT(*) FROM sel"
+        for i in range(len(tags)):
+            tb = tagtotable[tags[i]]
+            stmt += f" UNION ALL SELECT {i}, COUNT(DISTINCT {_clid(tb)}) FROM {_junctb(tb)} " \
+                "WHERE docidx IN sel"
+        #uplog(f"_facetcounts: executing: {stmt}. Values: {values}")
+        c = self._conn.cursor()
+        c.execute(stmt, values)
+        ntracks = 0
+        counts = {}
+        for r in c:
+            if r[0] == -1:
+                ntracks = r[1]
+            else:
+                counts[tags[r[0]]] = r[1]
+        if len(self._facet_cache) >= self._facet_cachesize:
+            # Dicts are ordered: evict the oldest entry
+            del self._facet_cache[next(iter(self._facet_cache))]
+        self._facet_cache[key] = (ntracks, counts)
+        return (ntracks, counts)
+
 
+    # List all tags which still have multiple values inside this selection level
+    def _subtreetags(self, where, seltables, values):
+        ntracks, counts = self._facetcounts(where, seltables, values)
+        # Keep the index tags order
+        return [tt for tt in uprcltagscreate.getIndexTags() if counts.get(tt, 0) > 1]
+
+    # Count the rows selected by stmt. The counts are cached, as the Control Points will ask for
+    # successive pages of the same selection.
     def _stmt_total(self, stmt, values):
+        key = (stmt, tuple(values))
         try:
-            total = self._stmt_cnt_cache[stmt]
+            total = self._stmt_cnt_cache[key]
         except:
             c = self._conn.cursor()
-            c.execute(stmt, values)
-            ids = [r[0] for r in c]
-            total = len(ids)
-            self._stmt_cnt_cache[stmt] = total
-            self._stmt_cnt_cachequeue.append(stmt)
+            c.execute(f"SELECT COUNT(*) FROM ({stmt})", values)
+            total = c.fetchone()[0]
+            self._stmt_cnt_cache[key] = total
+            self._stmt_cnt_cachequeue.append(key)
             if len(self._stmt_cnt_cachequeue) > self._stmt_cnt_cachesize:
                 del(self._stmt_cnt_cache[self._stmt_cnt_cachequeue[0]])
                 self._stmt_cnt_cachequeue = self._stmt_cnt_cachequeue[1:]
@@ -142,49 +165,36 @@ class Tagged(object):
     # Build a list of track directory entries for an SQL statement
     # which selects docidxs (SELECT docidx,... FROM tracks WHERE...)
     #
-    # NOTE: setting offset or cnt currently precludes sorting, which
-    # is unavoidable if we don't cache the whole result (which would
-    # use a lot of memory for big collections, around 100MB for 10k
-    # songs, significant on a small SBC). At the moment, we only do
-    # this for the full top-level items list, which is not really
-    # useful anyway.
-    def _trackentriesforstmt(self, stmt, values, pid, offset=0, count=0, key=cmpentries):
+    # The entries are sorted by album, directory, track number (see uprclutils.entrysortkey()), or by
+    # title if items is set. This is done by the query, using the sort key columns of the tracks
+    # table, so that we can return a page of the sorted list if offset or count is set. The result
+    # is then an (offset, total, entries) tuple instead of a list.
+    #
+    # The container entries in pre (if any) are placed before the tracks and are counted in the
+    # paging. Tracks ids are built with idsep ('$i' or '$*i').
+    def _trackentriesforstmt(self, stmt, values, pid, offset=0, count=0, items=False,
+                             pre=[], idsep='$i'):
         #uplog("trackentries: offset %d count %d" % (offset, count))
-        total = 0
-        if offset != 0 or count != 0:
-            total = self._stmt_total(stmt, values)
-        if total < 1000:
-            # Then return the full set: this is acceptable in terms of
-            # performances, and will allow the result to be sorted.
-            # plgwithslave knows how to deal with a full set returned
-            # from a partial request.
-            count = 0
-            offset = 0
-        if count != 0:
-            stmt += " LIMIT %d " % count
-        if offset != 0:
-            stmt += " OFFSET %d " % offset
-        rcldocs = uprclinit.getTree('folders').rcldocs()
-        c = self._conn.cursor()
-        c.execute(stmt, values)
-        entries = [rcldoctoentry(pid + '$i' + str(r[0]),
-                                 pid, self._httphp, self._pprefix,
-                                 rcldocs[r[0]]) for r in c]
+        paged = offset != 0 or count != 0
+        if paged:
+            total = len(pre) + self._stmt_total(stmt, values)
+            tracksoffset = max(0, offset - len(pre))
+            pre = pre[offset:offset+count] if count else pre[offset:]
+            trackscount = count - len(pre) if count else -1
+        stmt += _itemorder if items else _entryorder
+        if paged:
+            stmt += f" LIMIT {trackscount} OFFSET {tracksoffset}"
+        folders = uprclinit.getTree('folders')
+        entries = list(pre)
+        if not paged or trackscount != 0:
+            c = self._conn.cursor()
+            c.execute(stmt, values)
+            entries += [folders.docentry(pid + idsep + str(r[0]), pid, r[0]) for r in c]
         #uplog("trackentries: stmt returns %d entries" % len(entries))
-        if offset != 0 or count != 0:
+        if paged:
             return (offset, total, entries)
         else:
-            return sorted(entries, key=key)
-
-
-    # Return a list of trackids as selected by the current path <selwhere>
-    # <values> holds the corresponding values
-    def _docidsforsel(self, selwhere, seltables, values):
-        c = self._conn.cursor()
-        stmt = f"SELECT tracks.docidx FROM {_tblst(seltables)}  {selwhere}  ORDER BY trackno"
-        #uplog(f"docidsforsel: executing {stmt}. Values: {values}")
-        c.execute(stmt, values)
-        return [r[0] for r in c.fetchall()]
+            return entries
 
 
     # Expand multiple possibly merged albums to real ones. The tracks
@@ -204,6 +214,15 @@ class Tagged(object):
         return rawalbids
     
 
+    # Count the tracks of a possibly merged album
+    def _albumtrackcount(self, albid):
+        rawalbids = self._albids2rawalbids((albid,))
+        c = self._conn.cursor()
+        stmt = f"SELECT COUNT(*) FROM tracks WHERE album_id IN ({','.join('?'*len(rawalbids))})"
+        c.execute(stmt, rawalbids)
+        return c.fetchone()[0]
+
+
     # Expand single possibly merged album into list of ids for component discs
     def _albid2rawalbidssorted(self, albid):
         c = self._conn.cursor()
@@ -215,24 +234,6 @@ class Tagged(object):
             return [r[0] for r in rows]
 
 
-    # Translate albids so that the ones which are part of a merged
-    # album become the merged id. The returned list is same size or
-    # smaller because there maybe duplicate merged ids. Used to show
-    # album lists
-    def _rawalbids2albids(self, rawalbids):
-        albids = set()
-        c = self._conn.cursor()
-        for rawalbid in rawalbids:
-            c.execute('''SELECT album_id, albalb FROM albums WHERE album_id = ?''', (rawalbid,))
-            alb = c.fetchone()
-            if alb[1]:
-                albids.add(alb[1])
-            else:
-                albids.add(alb[0])
-        #
-        return [id for id in albids]
-
-
     # Count albums under file system path. We use albalb because
     # merged albums may come from multiple folders, and have no
     # albfolder. So this returns merged albums for which at least one
@@ -261,7 +262,7 @@ class Tagged(object):
         tracks = []
         for albid in albids:
             stmt = '''SELECT docidx FROM tracks
-            WHERE album_id = ? ORDER BY trackno'''
+            WHERE album_id = ?'''
             tracks += self._trackentriesforstmt(stmt, (albid,), pid)
 
         tno = None
@@ -279,14 +280,15 @@ class Tagged(object):
         return tracks
             
 
-    # Return all albums ids to which any of the selected tracks belong
+    # Return all albums ids to which any of the selected tracks belong. The discs of merged albums
+    # are translated to the merged album id, so the list may be shorter than the raw albums one.
     def _subtreealbums(self, selwhere, seltables, values):
-        stmt = f"SELECT DISTINCT tracks.album_id FROM {_tblst(seltables)} {selwhere}"
+        stmt = f"SELECT DISTINCT COALESCE(albums.albalb, albums.album_id) FROM albums " \
+            f"WHERE albums.album_id IN (SELECT tracks.album_id FROM {_tblst(seltables)} {selwhere})"
         c = self._conn.cursor()
         #uplog(f"subtreealbums: executing {stmt}")
         c.execute(stmt, values)
-        rawalbids = [r[0] for r in c]
-        albids = self._rawalbids2albids(rawalbids)
+        albids = [r[0] for r in c]
         #uplog(f"subtreealbums: returning {albids}")
         return albids
     
@@ -308,9 +310,10 @@ class Tagged(object):
             else:
                 where += ''' AND albtdisc IS NULL'''
 
+        # album_id makes the order of same title albums independant of the index used
         stmt = '''SELECT album_id, albtitle, albarturi, albdate, artist.value
         FROM albums LEFT JOIN artist ON artist.artist_id = albums.artist_id
-        %s ORDER BY albtitle''' % where
+        %s ORDER BY albtitle, album_id''' % where
 
         #uplog("_direntriesforalbums: stmt {stmt}")
         c.execute(stmt, args)
@@ -321,6 +324,40 @@ class Tagged(object):
                                     upnpclass='object.container.album.musicAlbum'))
         return entries
 
+    # Return True if searches can use the FTS index
+    def hasftsindex(self):
+        return uprclfts.enabled() and uprclfts.hasindex(self._conn)
+
+    # Run an FTS search (see uprclfts.search()), returning (kind, ref, title) tuples.
+    def ftssearch(self, matchexp, filterdir=None):
+        return uprclfts.search(self._conn, matchexp, filterdir)
+
+    # Return the paths for the (at most count) tracks following the one with index docidx in its
+    # album (all discs for a merged album), in the album listing order. Used by the streamer
+    # read-ahead, which runs in its own thread, so the queries use the connection it passes
+    # (see uprcltagscreate.openreadonly()), not ours.
+    def nexttrackpaths(self, conn, docidx, count):
+        c = conn.cursor()
+        c.execute('''SELECT albums.albalb FROM tracks JOIN albums
+        ON albums.album_id = tracks.album_id WHERE tracks.docidx = ?''', (docidx,))
+        row = c.fetchone()
+        if not row or row[0] is None:
+            return []
+        c.execute('''SELECT album_id FROM albums WHERE albalb = ? ORDER BY albtdisc''', (row[0],))
+        albids = [r[0] for r in c.fetchall()]
+        paths = []
+        found = False
+        for albid in albids if albids else [row[0]]:
+            c.execute("SELECT docidx, path FROM tracks WHERE album_id = ?" + _entryorder, (albid,))
+            for tdocidx, path in c:
+                if found and path:
+                    paths.append(path)
+                    if len(paths) >= count:
+                        return paths
+                elif tdocidx == docidx:
+                    found = True
+        return paths
+
     # Called when the search finds one of our synthetic album search
     # results. Create a container entry for it
     def direntryforalbid(self, albid):
@@ -372,16 +409,12 @@ class Tagged(object):
             albid = int(qpath[-1])
             rawalbids = self._albids2rawalbids((albid,))
             #uplog(f"_tagsbrowsealbums: albid {albid} rawalbids {rawalbids}")
-            stmt = '''SELECT COUNT(docidx) FROM tracks
-                WHERE album_id IN (%s)''' % ','.join('?'*len(rawalbids))
-            c.execute(stmt, rawalbids)
-            r = c.fetchone()
-            ntracks = int(r[0])
-            docidsl = self._docidsforsel(selwhere, seltables, values)
-            stmt = '''SELECT docidx FROM tracks 
-                WHERE album_id IN (%s) AND docidx IN (%s)''' % \
-            (','.join('?'*len(rawalbids)), ','.join('?'*len(docidsl)))
-            entries = self._trackentriesforstmt(stmt, rawalbids+docidsl, pid)
+            ntracks = self._albumtrackcount(albid)
+            # The selection is used as a subquery, so that its size does not matter
+            stmt = f"SELECT tracks.docidx FROM tracks WHERE tracks.album_id IN " \
+                f"({','.join('?'*len(rawalbids))}) AND tracks.docidx IN " \
+                f"(SELECT tracks.docidx FROM {_tblst(seltables)} {selwhere})"
+            entries = self._trackentriesforstmt(stmt, rawalbids + values, pid)
             if ntracks != len(entries):
                 id = pid + '$' + 'showca'
                 entries = [direntry(id, pid, '>> Complete Album')] + entries
@@ -401,11 +434,8 @@ class Tagged(object):
 
 
     # This is called when an 'items' element is encountered in the selection path.
-    def _tagsbrowseitems(self, pid, qpath, i, selwhere, seltables, values):
+    def _tagsbrowseitems(self, pid, qpath, i, selwhere, seltables, values, offset=0, count=0):
         stmt = f"SELECT tracks.docidx FROM {_tblst(seltables)} {selwhere}"
-        c = self._conn.cursor()
-        rows = c.execute(stmt, values)
-        docids = [r[0] for r in rows]
         albids = self._subtreealbums(selwhere, seltables, values)
         entries = []
         displaytracks = True
@@ -414,10 +444,9 @@ class Tagged(object):
             # already there. If all tracks are there, we display
             # the album entry (with the same id value: show album)
             albid = albids[0]
-            tlist = self._trackentriesforalbum(albid, pid)
             # Replace $items with $albums for the album entry
             id = pid.replace('$items', '$albums') + f"${albid}$showca"
-            if len(tlist) != len(docids):
+            if self._albumtrackcount(albid) != self._stmt_total(stmt, values):
                 entries.append(direntry(id, pid, '>> Complete Album'))
             # We used to show an album entry here, but the album was probably already shown at the
             # level above (because there is only one), and it's better to show the tracks in title
@@ -429,17 +458,15 @@ class Tagged(object):
             #    el[0]['id'] = id
             #    entries.append(el[0])
         if displaytracks:
-            rcldocs = uprclinit.getTree('folders').rcldocs()
-            entries += sorted([rcldoctoentry(pid + '$i' + str(docid),
-                                             pid, self._httphp, self._pprefix,
-                                             rcldocs[docid]) for docid in docids], key=cmpitems)
+            return self._trackentriesforstmt(stmt, values, pid, offset, count, items=True,
+                                             pre=entries)
         return entries
 
 
     # Main browsing routine. Given an objid, translate it into a select
     # statement, plus further processing, and return the corresponding
     # records
-    def _tagsbrowse(self, pid, qpath, flag, path=''):
+    def _tagsbrowse(self, pid, qpath, flag, path='', offset=0, count=0):
         #uplog(f"tagsbrowse. pid {pid} qpath {qpath}")
 
         tagdisplaytag = uprcltagscreate.getTagDisplayTag()
@@ -469,7 +496,8 @@ class Tagged(object):
             if elt == 'albums':
                 return self._tagsbrowsealbums(pid, qpath, i, selwhere, seltables, values)
             elif elt == 'items':
-                return self._tagsbrowseitems(pid, qpath, i, selwhere, seltables, values)
+                return self._tagsbrowseitems(pid, qpath, i, selwhere, seltables, values,
+                                             offset, count)
             
             # '=colname'. Set the current column name, which will be used
             # in different ways depending if this is the last element or
@@ -504,7 +532,8 @@ class Tagged(object):
         if selwhat == "tracks.docidx":
             #uplog(f"tagsbrowse: showing remaining multivalued tags")
             # We are displaying content for a given value of a given tag
-            docids = self._docidsforsel(selwhere, seltables, values)
+            stmt = f"SELECT tracks.docidx FROM {_tblst(seltables)} {selwhere}"
+            ntracks = self._stmt_total(stmt, values)
             albids = self._subtreealbums(selwhere, seltables, values)
             subqs = self._subtreetags(selwhere, seltables, values)
             displaytracks = True
@@ -517,9 +546,8 @@ class Tagged(object):
                 # already there. If all tracks are there, we display
                 # the album entry (with the same id value: show album)
                 albid = albids[0]
-                tlist = self._trackentriesforalbum(albid, pid)
                 id = pid + '$albums$' + str(albid) + '$showca'
-                if len(tlist) != len(docids):
+                if self._albumtrackcount(albid) != ntracks:
                     entries.append(direntry(id, pid, '>> Complete Album'))
                 else:
                     displaytracks = False
@@ -530,18 +558,13 @@ class Tagged(object):
             if subqs:
                 id = pid + '$items'
                 label = '%d items'
-                entries.append(direntry(id, pid, label % len(docids)))
+                entries.append(direntry(id, pid, label % ntracks))
                 for tt in subqs:
                     id = pid + '$=' + tt
                     entries.append(direntry(id, pid, tagdisplaytag[tt]))
             elif displaytracks:
-                rcldocs = uprclinit.getTree('folders').rcldocs()
-                tracks = []
-                for docidx in docids:
-                    id = pid + '$*i' + str(docidx)
-                    tracks.append(
-                        rcldoctoentry(id, pid, self._httphp, self._pprefix, rcldocs[docidx]))
-                entries += sorted(tracks, key=cmpitems)
+                return self._trackentriesforstmt(stmt, values, pid, offset, count, items=True,
+                                                 pre=entries, idsep='$*i')
         else:
             # Showing all values at this point for given column
             # SELECT col.col_id, col.value FROM tracks, col
@@ -583,12 +606,12 @@ class Tagged(object):
         if qpath[0] == 'items':
             args = (folder + '%',) if folder else ()
             folderwhere = ' WHERE tracks.path LIKE ? ' if folder else ' '
-            stmt = 'SELECT docidx FROM tracks' + folderwhere
-            entries = self._trackentriesforstmt(stmt, args, pid, offset, count, key=cmpitems)
+            stmt = 'SELECT tracks.docidx FROM tracks' + folderwhere
+            entries = self._trackentriesforstmt(stmt, args, pid, offset, count, items=True)
         elif qpath[0] == 'albums':
             entries = self._albumsbrowse(pid, qpath, flag, folder)
         elif qpath[0].startswith('='):
-            entries = self._tagsbrowse(pid, qpath, flag, folder)
+            entries = self._tagsbrowse(pid, qpath, flag, folder, offset, count)
         else:
             raise Exception(f"Bad path in tags tree (start): <{qpath}>")
         return entries
@@ -645,33 +668,99 @@ class Tagged(object):
             return self._dobrowse(pid, flag, qpath, folder)
 
         
+    # Check that qpath (the split objid of a container, without our prefix) is a path of the tags tree
+    # which lists tracks, and return (idsep, albid, seltags, selalbid): idsep is the separator used
+    # in the tracks ids ($i or $*i), albid is set for the full album track lists (where the track
+    # numbers are renumbered, see _trackentriesforalbum()), seltags is the list of (table, value_id)
+    # for the tag values selecting the tracks, and selalbid is set if the selection is further
+    # restricted to an album. Returns None if the path does not list tracks.
+    def _trackscontainer(self, qpath):
+        tagtotable = uprcltagscreate.getTagToTable()
+        if qpath == ['items']:
+            return '$i', None, [], None
+        if len(qpath) == 2 and qpath[0] == 'albums':
+            return '$i', int(qpath[1]), [], None
+        seltags = []
+        i = 0
+        while i + 1 < len(qpath) and qpath[i].startswith('='):
+            seltags.append((tagtotable[qpath[i][1:]], int(qpath[i+1])))
+            i += 2
+        if not seltags:
+            return None
+        rest = qpath[i:]
+        if not rest:
+            return '$*i', None, seltags, None
+        elif rest == ['items']:
+            return '$i', None, seltags, None
+        elif len(rest) == 2 and rest[0] == 'albums':
+            return '$i', None, seltags, int(rest[1])
+        elif len(rest) == 3 and rest[0] == 'albums' and rest[2] == 'showca':
+            return '$i', int(rest[1]), [], None
+        return None
+
+
+    # Return the entry for a tag value container (=Tag$value_id), or for an album container
+    # (albums$album_id, possibly under a tag selection), from the table row.
+    def _containermeta(self, objid, qpath):
+        pid = objid[:objid.rfind('$')]
+        if len(qpath) >= 2 and qpath[-2] == 'albums':
+            entries = self._direntriesforalbums(pid, f"WHERE album_id = {int(qpath[-1])}")
+            return entries[:1]
+        if len(qpath) >= 2 and qpath[-2].startswith('='):
+            col = uprcltagscreate.getTagToTable()[qpath[-2][1:]]
+            c = self._conn.cursor()
+            c.execute(f"SELECT value FROM {col} WHERE {_clid(col)} = ?", (int(qpath[-1]),))
+            r = c.fetchone()
+            if r:
+                return [direntry(objid, pid, r[0])]
+        return []
+
+
+    # Very few control points use this, and it is mostly useless because we return the full metadata
+    # in the container entries. We compute the entries for tracks (from the docidx), albums and tag
+    # values (from the table row) directly, without browsing the parent container, after checking
+    # that the parent path is consistent. The other containers return nothing.
     def _browsemeta(self, objid):
-        # very few control points use this, and it is useless because we return the full metadata in
-        # the container entries. This would be too complicated to implement in the tags tree, so we
-        # only do it for items, and in a very brutal way, by browsing the parent and finding the
-        # entry in the result.
         #uplog(f"_browsemeta: objid {objid}")
-        anchorlen = 2
-        ipos = objid.rfind("$i")
-        if ipos == -1:
-            ipos = objid.rfind("$*i")
-            if ipos == -1:
-                return []
-            else:
-                anchorlen = 3
-        if objid[ipos:] == "$items":
+        prefix = uprclinit.getObjPrefix()
+        if not objid.startswith(prefix):
             return []
-        id = objid[ipos+anchorlen:]
         try:
-            iid = int(id)
-        except:
+            ipos = max(objid.rfind("$i"), objid.rfind("$*i"))
+            if ipos == -1 or objid[ipos:] == "$items":
+                return self._containermeta(objid, objid[len(prefix):].split('$'))
+            idsep = "$*i" if objid[ipos+1] == '*' else "$i"
+            docidx = int(objid[ipos+len(idsep):])
+            pid = objid[:ipos]
+            container = self._trackscontainer(pid[len(prefix):].split('$'))
+        except Exception as ex:
+            uplog(f"Tags: _browsemeta: bad objid {objid}: {ex}")
             return []
-        pid = objid[:ipos]
-        entries = self.browse(pid, "children", 0, 0)
-        for e in entries:
-            if e["id"] == objid:
-                return [e,]
-        return []
+        if container is None or container[0] != idsep:
+            return []
+        idsep, albid, seltags, selalbid = container
+        if albid is not None:
+            # Small list, and the track numbers may be changed: use the actual album listing
+            for e in self._trackentriesforalbum(albid, pid):
+                if e["id"] == objid:
+                    return [e,]
+            return []
+        # Check that the track exists and is part of the selection
+        tables = ["tracks",] + [_junctb(col) for col, valueid in seltags]
+        where = ["tracks.docidx = ?",]
+        values = [docidx,]
+        if selalbid is not None:
+            rawalbids = self._albids2rawalbids((selalbid,))
+            where.append(f"tracks.album_id IN ({','.join('?'*len(rawalbids))})")
+            values += rawalbids
+        for col, valueid in seltags:
+            where.append(f"{_junctb(col)}.docidx = tracks.docidx AND {_junctb(col)}.{_clid(col)} = ?")
+            values.append(valueid)
+        c = self._conn.cursor()
+        c.execute(f"SELECT tracks.docidx FROM {_tblst(tables)} WHERE {' AND '.join(where)}", values)
+        if c.fetchone() is None:
+            return []
+        return [uprclinit.getTree('folders').docentry(objid, pid, docidx),]
     
     # Top level browse routine. Handle the special cases and call the
     # appropriate worker routine. idpath is something like 0$uprcl$=tagname$tagvalue...
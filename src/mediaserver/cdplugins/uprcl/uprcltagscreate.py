@@ -15,15 +15,27 @@
 #   51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 #
 
+import hashlib
 import os
+import pathlib
 import time
 import re
+import sqlite3
 from recoll import recoll
 
 from timeit import default_timer as timer
 from uprclutils import audiomtypes, docfolder, uplog
 import uprclutils
 import uprclinit
+import uprclindex
+import uprclfts
+
+# Version of the tags db layout and contents. Bump this when changing the schema or the way the
+# data is computed, so that a persistent db created by a previous version is not reused.
+_dbversion = "4"
+
+# Name of the persistent tags db file, inside the uprcl cache directory.
+_dbname = "tags.sqlite"
 
 # Tags for which we may create auxiliary tag tables for facet descent. 
 #
@@ -109,10 +121,19 @@ def _junctb(table):
 # (the album title is not enough to group tracks, there could be many albums with the same
 # title). Also we do tricks with grouping discs into albums etc.
 #
+# The uprclmeta table holds name/value pairs describing the data the db was built from, which
+# decide if the db can be reused at the next startup.
+#
 # Note: we create all tables even if not all tags are actually used.
 def _createsqdb(conn):
     c = conn.cursor()
 
+    try:
+        c.execute('''DROP TABLE uprclmeta''')
+    except:
+        pass
+    c.execute("CREATE TABLE uprclmeta (name TEXT PRIMARY KEY, value TEXT)")
+
     # Create the albums table
     try:
         c.execute('''DROP TABLE albums''')
@@ -145,8 +166,12 @@ def _createsqdb(conn):
         c.execute('''DROP TABLE tracks''')
     except:
         pass
+    # The fmtime column is used for detecting changed tracks when updating the db. The sort* columns
+    # hold the entries sort keys (see uprclutils.docsortkeys()), so that the track lists can be
+    # sorted and paged by the queries.
     tracksstmt = '''CREATE TABLE tracks 
-                     (docidx INT, album_id INT, trackno INT, title TEXT, path TEXT)'''
+                     (docidx INT, album_id INT, trackno INT, title TEXT, path TEXT, fmtime TEXT,
+                     sorttitle TEXT, sortalbum TEXT, sortdir TEXT, sorttno INT, sortfile TEXT)'''
     c.execute(tracksstmt)
 
     # Create tables for tag values (e.g. all genre values, all composer values, etc.)
@@ -176,24 +201,57 @@ def _createTagTables(cursor, tgnm):
     cursor.execute(stmt)
     
 
-# Augment indextag dict and create tables for a custom field, not part of our predefined set
-def _addCustomTable(conn, indextag):
+# Create the indexes used by the browse queries (see the query plan checks in uprcltags.py). This is
+# called after the bulk load of the tracks when creating the db, which is faster than updating the
+# indexes for each insert. The junction tables get indexes in both directions: docidx->value for
+# joining from a track selection, and value->docidx for selecting the tracks for a tag value. Both
+# are covering indexes for the queries which only need the two columns.
+def _createindexes(conn):
     c = conn.cursor()
+    for tb in set(_alltagtotable.values()):
+        jtb = _junctb(tb)
+        c.execute(f"CREATE INDEX IF NOT EXISTS {jtb}_docidx ON {jtb}(docidx, {_clid(tb)})")
+        c.execute(f"CREATE INDEX IF NOT EXISTS {jtb}_{_clid(tb)} ON {jtb}({_clid(tb)}, docidx)")
+    c.execute("CREATE INDEX IF NOT EXISTS tracks_docidx ON tracks(docidx)")
+    c.execute("CREATE INDEX IF NOT EXISTS tracks_album_id ON tracks(album_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS tracks_path ON tracks(path)")
+    c.execute("CREATE INDEX IF NOT EXISTS tracks_entrysort "
+              "ON tracks(sortalbum, sortdir, sorttno, sortfile, docidx)")
+    c.execute("CREATE INDEX IF NOT EXISTS tracks_itemsort ON tracks(sorttitle, sortalbum, docidx)")
+    c.execute("CREATE INDEX IF NOT EXISTS albums_albalb ON albums(albalb)")
+    c.execute("CREATE INDEX IF NOT EXISTS albums_albtitle ON albums(albtitle, albfolder, albtdisc)")
+
+
+# Open a connection to the db. The folder restrictions use "path LIKE 'prefix%'" clauses, which can
+# only use the path indexes if LIKE is case-sensitive (which is the right thing for file paths
+# anyway).
+def _connect(dbpath):
+    conn = sqlite3.connect(dbpath, check_same_thread=False)
+    conn.execute("PRAGMA case_sensitive_like = ON")
+    return conn
+
+
+# Augment indextag dict and create tables for a custom field, not part of our predefined set. The
+# tables already exist if we are reusing a persistent db.
+def _addCustomTable(conn, indextag, create=True):
     tb = indextag.lower()
     _alltagtotable[indextag] = tb
-    _createTagTables(c, tb)
+    if create:
+        _createTagTables(conn.cursor(), tb)
 
 
 # Peruse the configuration to decide what tags will actually show up
 # in the tree and how they will be displayed.
-def _prepareTags(conn):
+def _prepareTags(conn, create=True):
     global g_tagdisplaytag
     global g_tagtotable
     global g_indextags
 
-    g_indextags = []
-    g_tagdisplaytag = {}
-    g_tagtotable = {}
+    # The globals are only set when done, because the current values may be in use by browse
+    # operations on the previous trees while we are building new ones.
+    indextags = []
+    tagdisplaytag = {}
+    tagtotable = {}
     
     indextagsp = uprclinit.g_minimconfig.getindextags()
     itemtags = uprclinit.g_minimconfig.getitemtags()
@@ -205,51 +263,96 @@ def _prepareTags(conn):
     # Compute the actual list of index tags:
     for v,d in indextagsp:
         if v.lower() == 'none':
-            g_indextags = []
-            g_tagdisplaytag = {}
+            indextags = []
+            tagdisplaytag = {}
             break
-        g_indextags.append(v)
-        g_tagdisplaytag[v] = d if d else v
-    uplog("prepareTags: g_indextags: %s g_tagdisplaytag %s" % (g_indextags, g_tagdisplaytag))
+        indextags.append(v)
+        tagdisplaytag[v] = d if d else v
+    uplog("prepareTags: g_indextags: %s g_tagdisplaytag %s" % (indextags, tagdisplaytag))
     
     # Compute an array of (table name, recoll field) translations for the tags we need to process,
     # as determined by the indexTags property. Most often they are identical. This also determines
     # what fields we create tables for.
     tabtorclfield = []
-    for nm in g_indextags:
+    for nm in indextags:
         if nm not in _alltagtotable:
-            _addCustomTable(conn, nm)
+            _addCustomTable(conn, nm, create)
         tb = _alltagtotable[nm]
-        g_tagtotable[nm] = tb
+        tagtotable[nm] = tb
         rclfld = _coltorclfield[tb] if tb in _coltorclfield else tb
         uplog(f"prepareTags: using rclfield [{rclfld}] for sql [{tb}]")
         tabtorclfield.append((tb, rclfld))
 
     for nm in itemtags:
         if nm not in _alltagtotable:
-            _addCustomTable(conn, nm)
+            _addCustomTable(conn, nm, create)
         tb = _alltagtotable[nm]
         rclfld = _coltorclfield[tb] if tb in _coltorclfield else tb
         uplog(f"prepareTags: using rclfield [{rclfld}] for sql [{tb}]")
         tabtorclfield.append((tb, rclfld))
 
+    g_indextags = indextags
+    g_tagdisplaytag = tagdisplaytag
+    g_tagtotable = tagtotable
     uplog(f"prepareTags: tabtorclfield: {tabtorclfield}")
     return tabtorclfield
 
 
+# In-process caches used while creating the db, avoiding an SQL lookup for each tag value of each
+# track:
+#  - _valueids: for each tag table, maps the values to their ids.
+#  - _albumids: maps (albtitle, albfolder, albtdisc) album keys to album_id. The entry with a None
+#    albtdisc is the first album created for the title and folder, which is what a search without
+#    a disc number finds.
+# The junction tables and tracks records are accumulated in _junctrows and _trackrows and inserted
+# by _flushrows().
+_valueids = {}
+_albumids = {}
+_junctrows = {}
+_trackrows = []
+# Album artists sets, see _updatealbartistlist()
+_albartists = {}
+
+# Initialize the caches from the db contents. There are no albums for the tracks we are going to
+# process (see recolltosqlupdate()), so _albumids starts empty.
+def _initcaches(conn, tables):
+    global _valueids, _albumids, _junctrows, _trackrows, _albartists
+    _valueids = {}
+    _albumids = {}
+    _junctrows = {}
+    _trackrows = []
+    _albartists = {}
+    c = conn.cursor()
+    for tb in set(tables):
+        _valueids[tb] = dict([(r[1], r[0]) for r in c.execute(f"SELECT {_clid(tb)}, value FROM {tb}")])
+
+
+# Insert the accumulated tracks and junction records
+def _flushrows(conn):
+    global _trackrows
+    c = conn.cursor()
+    for tb, rows in _junctrows.items():
+        c.executemany(f"INSERT INTO {_junctb(tb)}(docidx, {_clid(tb)}) VALUES (?, ?)", rows)
+        rows.clear()
+    c.executemany("INSERT INTO tracks(docidx, album_id, trackno, title, path, fmtime, "
+                  "sorttitle, sortalbum, sortdir, sorttno, sortfile) "
+                  "VALUES(?,?,?,?,?,?,?,?,?,?,?)", _trackrows)
+    _trackrows = []
+    
+
 # Insert new value if not existing, return rowid of new or existing row
 def _auxtableinsert(conn, tb, value):
     #uplog("_auxtableinsert [%s] -> [%s]" % (tb, value))
+    ids = _valueids.setdefault(tb, {})
+    try:
+        return ids[value]
+    except KeyError:
+        pass
     c = conn.cursor()
-    stmt = f"SELECT {_clid(tb)} FROM  {tb} WHERE value = ?"
+    stmt = f"INSERT INTO {tb}(value) VALUES(?)"
     c.execute(stmt, (value,))
-    r = c.fetchone()
-    if r:
-        rowid = r[0]
-    else:
-        stmt = f"INSERT INTO {tb}(value) VALUES(?)"
-        c.execute(stmt, (value,))
-        rowid = c.lastrowid
+    rowid = c.lastrowid
+    ids[value] = rowid
     return rowid
 
 
@@ -323,46 +426,47 @@ def _maybecreatealbum(conn, doc):
             discnum = int(m.group(2))
         
     # See if this albumdisc already exists (created for a previous track)
-    stmt = "SELECT album_id, artist_id FROM albums WHERE albtitle = ? AND albfolder = ?"
-    wcols = [album, folder]
-    if discnum:
-        stmt += ' AND albtdisc = ?'
-        wcols.append(discnum)
-    #uplog(f"maybecreatealbum: {stmt} {wcols}")
-    c.execute(stmt, wcols)
-    r = c.fetchone()
-    if r:
-        #uplog("maybecreatealbum: album found")
-        album_id = r[0]
-    else:
-        c.execute('''INSERT INTO 
-        albums(albtitle, albfolder, artist_id, albdate, albtdisc, artists) 
-        VALUES (?,?,?,?,?,?)''',
-                  (album, folder, albartist_id, doc["date"], discnum, ""))
-        album_id = c.lastrowid
-        #uplog(f"New album {album_id} {album} disc {discnum} artist {albartist_id} folder {folder}")
+    key = (album, folder, discnum if discnum else None)
+    try:
+        return _albumids[key]
+    except KeyError:
+        pass
+    c.execute('''INSERT INTO 
+    albums(albtitle, albfolder, artist_id, albdate, albtdisc, artists) 
+    VALUES (?,?,?,?,?,?)''',
+              (album, folder, albartist_id, doc["date"], discnum, ""))
+    album_id = c.lastrowid
+    #uplog(f"New album {album_id} {album} disc {discnum} artist {albartist_id} folder {folder}")
+    _albumids[key] = album_id
+    _albumids.setdefault((album, folder, None), album_id)
 
     return album_id
 
 
 # Add a track's artists set to the album auxiliary "artists" column, used in the end to determine an
-# album artist if none was explicitely set
+# album artist if none was explicitely set. The values are accumulated in _albartists and written
+# by _flushalbartistlists()
 def _updatealbartistlist(conn, album_id, rowids):
     if not rowids:
         return
+    _albartists.setdefault(album_id, []).append(repr(rowids))
+
+
+def _flushalbartistlists(conn):
     c = conn.cursor()
-    addstr = repr(rowids)
-    stmt = f"UPDATE albums SET artists = artists || '|' || ? WHERE album_id = ?"
-    values = (addstr, album_id)
-    c.execute(stmt, values)
+    stmt = f"UPDATE albums SET artists = artists || ? WHERE album_id = ?"
+    c.executemany(stmt, [("|" + "|".join(l), album_id) for album_id, l in _albartists.items()])
+    _albartists.clear()
         
 
 # Setting album covers needs to wait until we have scanned all tracks so that we can select
 # a consistant embedded art (first track in path order), as recoll scanning is in unsorted
-# directory order.
-def _setalbumcovers(conn, rcldocs):
+# directory order. Only the albums with an id greater than minalbid are processed.
+def _setalbumcovers(conn, rcldocs, minalbid=0):
     c = conn.cursor()
-    c.execute('''SELECT album_id,albtitle FROM albums''')
+    c.execute('''SELECT album_id,albtitle FROM albums WHERE album_id > ?''', (minalbid,))
+    # List each folder only once, instead of testing the possible art file names
+    dircache = {}
     for r in c:
         albid = r[0]
         albtitle = r[1]
@@ -373,7 +477,8 @@ def _setalbumcovers(conn, rcldocs):
             docidx = r1[0]
             doc = rcldocs[docidx]
             arturi = uprclutils.docarturi(doc, uprclinit.getHttphp(), uprclinit.getPathPrefix(),
-                                          preferfolder=True, albtitle=albtitle)
+                                          preferfolder=True, albtitle=albtitle,
+                                          dircache=dircache)
             if arturi:
                 cupd = conn.cursor()
                 #uplog(f"Setting albid {albid} albarturi to {arturi}")
@@ -414,45 +519,116 @@ def _setalbumartists(conn):
         c1.execute("UPDATE albums SET artist_id = ? WHERE album_id = ?", (albumartist, r[0]))
 
 
-# Add albums to the recoll index so they can be searched for
-def _albumstorecoll(conn):
-    rcldb = recoll.connect(confdir=uprclinit.getRclConfdir(), writable=True)
+# The albums and artists are added to the recoll index as synthetic docs, so that they can be found
+# by the searches. Their udis are "albid<album_id>" and "artid<artist_id>". As the ids change when
+# the db is rebuilt, and updating the Xapian index is slow, we compare the docs with the ones
+# already in the index after each update and only write the differences (see
+# updaterecolldocs()). The doc contents are hashed into the recoll "sig" field for this.
+
+# Return the synthetic album docs: list of (udi, fields list) pairs
+def _albumsrecolldocs(conn):
+    docs = []
     c = conn.cursor()
-    #                 0        1          2          3         4         5
-    stmt = '''SELECT album_id, albfolder, albtitle, albarturi, albdate, artist.value
+    #                 0        1          2          3
+    stmt = '''SELECT album_id, albfolder, albtitle, artist.value
       FROM albums LEFT JOIN artist ON artist.artist_id = albums.artist_id
       WHERE albtdisc is NULL'''
     c.execute(stmt, ())
     for r in c:
-        udi = "albid" + str(r[0])
-        doc = recoll.Doc()
-        doc["album"] = r[2]
-        doc["title"] = r[2]
-        doc["mtype"] = "inode/directory"
-        if r[5]:
-            doc["albumartist"] = r[5]
-            doc["artist"] = r[5]
-        doc["url"] = "file://" + r[1]
-        # uplog(f"_albumstorecoll: indexing album {doc['album']}")
-        rcldb.addOrUpdate(udi, doc)
+        fields = [("album", r[2]), ("title", r[2]), ("mtype", "inode/directory")]
+        if r[3]:
+            fields += [("albumartist", r[3]), ("artist", r[3])]
+        fields.append(("url", "file://" + r[1]))
+        docs.append(("albid" + str(r[0]), fields))
+    return docs
     
 
-# Add artists to the recoll index so they can be searched for
-def _artiststorecoll(conn):
-    rcldb = recoll.connect(confdir=uprclinit.getRclConfdir(), writable=True)
+# Return the synthetic artist docs
+def _artistsrecolldocs(conn):
+    docs = []
     c = conn.cursor()
-    #                 0         1
-    stmt = "SELECT artist_id, value    FROM artist"
-    c.execute(stmt, ())
+    c.execute("SELECT artist_id, value FROM artist", ())
     for r in c:
-        udi = "artid" + str(r[0])
-        doc = recoll.Doc()
-        doc["title"] = r[1]
-        doc["mtype"] = "inode/directory"
-        doc["url"] = "file://artists/" + r[1] # Not used ever
-        # uplog(f"_artiststorecoll: indexing artist {doc['title']}")
-        rcldb.addOrUpdate(udi, doc)
-    
+        # The url is not used ever
+        fields = [("title", r[1]), ("mtype", "inode/directory"), ("url", "file://artists/" + r[1])]
+        docs.append(("artid" + str(r[0]), fields))
+    return docs
+
+
+def _docsig(fields):
+    md5 = hashlib.md5()
+    for k, v in fields:
+        md5.update(f"{k}={v}\n".encode('utf-8', errors='surrogateescape'))
+    return md5.hexdigest()
+
+
+# Return the synthetic docs currently in the recoll index: dict udi -> sig. They are
+# inode/directory docs, with our udi prefixes.
+def _injecteddocs(rcldb):
+    sigs = {}
+    rclq = rcldb.query()
+    rclq.execute("mime:inode/directory", stemming=0)
+    while True:
+        docs = rclq.fetchmany()
+        for doc in docs:
+            udi = doc["rcludi"]
+            if udi.startswith("albid") or udi.startswith("artid"):
+                sigs[udi] = doc["sig"]
+        if len(docs) != rclq.arraysize:
+            break
+    return sigs
+
+
+# Bring the album and artist docs in the recoll index up to date with the current tags db: add the
+# new or changed ones, and delete the ones which don't exist any more (all of them if we use the FTS
+# index for searching). All the changes are committed together when closing the recoll db.
+#
+# This is called by the index update thread after the new trees are in use, as it is not needed
+# for browsing. It uses its own db connection. The comparison only needs read access to the recoll
+# index. If there are changes, we need the write lock, so the index monitor is stopped if it is
+# running (the caller restarts it). Returns True if the recoll index was modified.
+def updaterecolldocs():
+    start = timer()
+    conn = _connect(os.path.join(uprclinit.getRclConfdir(), _dbname))
+    try:
+        if uprclfts.enabled():
+            docs = []
+        else:
+            docs = _albumsrecolldocs(conn) + _artistsrecolldocs(conn)
+    finally:
+        conn.close()
+
+    oldsigs = _injecteddocs(recoll.connect(confdir=uprclinit.getRclConfdir()))
+    updates = []
+    for udi, fields in docs:
+        sig = _docsig(fields)
+        if oldsigs.pop(udi, None) != sig:
+            updates.append((udi, fields, sig))
+    # What remains in oldsigs is stale
+    if updates or oldsigs:
+        uprclindex.stopmonitor()
+        rcldb = recoll.connect(confdir=uprclinit.getRclConfdir(), writable=True)
+        for udi, fields, sig in updates:
+            doc = recoll.Doc()
+            for k, v in fields:
+                doc[k] = v
+            doc["sig"] = sig
+            rcldb.addOrUpdate(udi, doc)
+        for udi in oldsigs:
+            rcldb.delete(udi)
+        rcldb.close()
+    uplog(f"updaterecolldocs: {len(docs)} docs, {len(updates)} added or updated, {len(oldsigs)} "
+          f"deleted in {timer()-start:.1f} Seconds")
+    return bool(updates or oldsigs)
+
+
+# Build the FTS index if it is enabled, it is then used for all searches. Else, the albums and
+# artists are added to the recoll index later (see updaterecolldocs()).
+def _searchindex(conn, rcldocs):
+    if uprclfts.enabled():
+        uprclfts.createindex(conn, rcldocs)
+        conn.commit()
+
 
 # Check that the numbers are sequential
 def _checkseq(seq):
@@ -576,35 +752,24 @@ def parsedate(dt):
     return dt
 
 
-# Create the db and fill it up with the values we need, taken out of
-# the recoll records list
-def recolltosql(conn, rcldocs):
-    start = timer()
+# No need to include non-audio or non-tagged types
+def _istrack(doc):
+    return doc["mtype"] in audiomtypes and doc["mtype"] != 'inode/directory' and \
+        doc["mtype"] != 'audio/x-mpegurl'
 
-    _createsqdb(conn)
-    tabtorclfield = _prepareTags(conn)
-    #uplog("Tagscreate: tabtorclfield: %s"%tabtorclfield)
 
-    maxcnt = 0
+# Create the tracks table record and the tag values and junction tables records for the docs with
+# indexes in docidxs. The albums are created as needed.
+def _trackstosql(conn, rcldocs, docidxs, tabtorclfield):
     totcnt = 0
-    c = conn.cursor()
-
-    # A generic "Various Artists" tag value to be used for Albumartist if there are multiple artists
-    # and no explicit AlbumArtist value. Set this as global, no need to query for it every time it's
-    # needed.
-    global variousartistsid
-    variousartistsid = _auxtableinsert(conn, "artist", "Various Artists")    
-
-    for docidx in range(len(rcldocs)):
+    for docidx in docidxs:
         doc = rcldocs[docidx]
         totcnt += 1
 
         if totcnt % 1000 == 0:
             time.sleep(0)
         
-        # No need to include non-audio or non-tagged types
-        if doc["mtype"] not in audiomtypes or doc["mtype"] == 'inode/directory' \
-               or doc["mtype"] == 'audio/x-mpegurl':
+        if not _istrack(doc):
             continue
 
         # Album creation ?
@@ -618,11 +783,6 @@ def recolltosql(conn, rcldocs):
             path = ''
 
         # Misc tag values:            
-        # Set base values for column names, values list, placeholders. Done this way because we used
-        # to add to the lists for the tag values (which now use separate junction tables).
-        columns = ['docidx','album_id','trackno','title',      'path']
-        values =  [ docidx,  album_id,  trackno,  doc["title"], path]
-        placehold = ['?',    '?',       '?',      '?',          '?']
         for tb, rclfld in tabtorclfield:
             value = doc[rclfld]
             # Special processing for some fields
@@ -641,29 +801,289 @@ def recolltosql(conn, rcldocs):
             # rclaudio.py concatenates multiple values, using " | " as separator.
             valuelist = value.split(" | ")
             rowids = set()
+            jrows = _junctrows.setdefault(tb, [])
             for value in valuelist:
                 # Possibly insert in appropriate table (if value not already there), and
-                # insert record in junction table for the corresponding field.
+                # record the junction table entry for the corresponding field.
                 rowid = _auxtableinsert(conn, tb, value)
                 rowids.add(rowid)
-                stmt = f"INSERT INTO {_junctb(tb)}(docidx, {_clid(tb)}) VALUES (?, ?)"
-                jvals = [docidx, rowid]
-                # uplog(f"EXECUTING {stmt} values {jvals}")
-                c.execute(stmt, jvals)
+                jrows.append((docidx, rowid))
             if tb == 'artist' and rowids:
                 _updatealbartistlist(conn, album_id, rowids)
         # Create the main record in the tracks table.
-        stmt = "INSERT INTO tracks(" + ",".join(columns) + ") VALUES(" + ",".join(placehold) + ")"
-        c.execute(stmt, values)
+        entrykey, itemkey = uprclutils.docsortkeys(doc)
+        _trackrows.append((docidx, album_id, trackno, doc["title"], path, doc["fmtime"],
+                           itemkey[0]) + entrykey[1:])
+        if len(_trackrows) >= 10000:
+            _flushrows(conn)
+    _flushrows(conn)
+    _flushalbartistlists(conn)
+    return totcnt
+
+
+# Log the time used by each phase of the db creation
+def _logphases(what, phases):
+    uplog(f"{what}: " + " ".join([f"{nm} {t:.2f}S" for nm, t in phases]))
+
 
-    ## End Big doc loop
+# Create the db and fill it up with the values we need, taken out of the recoll records list. All
+# the work is done inside a single transaction.
+def recolltosql(conn, rcldocs):
+    start = timer()
 
+    _createsqdb(conn)
+    tabtorclfield = _prepareTags(conn)
+    #uplog("Tagscreate: tabtorclfield: %s"%tabtorclfield)
+    _initcaches(conn, [t[0] for t in tabtorclfield] + ['artist',])
+
+    # A generic "Various Artists" tag value to be used for Albumartist if there are multiple artists
+    # and no explicit AlbumArtist value. Set this as global, no need to query for it every time it's
+    # needed.
+    global variousartistsid
+    variousartistsid = _auxtableinsert(conn, "artist", "Various Artists")    
+
+    phases = []
+    t0 = timer()
+    totcnt = _trackstosql(conn, rcldocs, range(len(rcldocs)), tabtorclfield)
+    t1 = timer(); phases.append(("tracks", t1 - t0)); t0 = t1
+    _createindexes(conn)
+    t1 = timer(); phases.append(("indexes", t1 - t0)); t0 = t1
     _setalbumartists(conn)
+    t1 = timer(); phases.append(("albumartists", t1 - t0)); t0 = t1
     _setalbumcovers(conn, rcldocs)
+    t1 = timer(); phases.append(("covers", t1 - t0)); t0 = t1
     _createmergedalbums(conn)
     conn.commit()
-    end = timer()
-    _albumstorecoll(conn)
-    _artiststorecoll(conn)
+    end = timer(); phases.append(("merge", end - t0)); t0 = end
+    _searchindex(conn, rcldocs)
+    t1 = timer(); phases.append(("search", t1 - t0))
+    _logphases("recolltosql", phases)
     uplog(f"recolltosql: processed {totcnt} docs in {end-start:.1f} Seconds")
+
+
+# Above this proportion of added or removed tracks, we just rebuild the db from scratch.
+_maxupdateratio = 0.3
+
+# Update an existing db for a new version of the recoll docs array. This returns False without
+# changing anything if the update would be too big, in which case the caller should use
+# recolltosql() instead.
+#
+# We compare the new docs with the tracks table contents (using the url and file modification
+# time) to determine the added and removed tracks. A modified track is removed and added, and so
+# are the tracks with non file:// urls, which have no path in the tracks table.
+#
+# The docidx values for the unchanged tracks are translated to their new values in all tables.
+#
+# Because the album records are built from multiple tracks, and then merged (multiple discs), we
+# can't just update them. Instead, we compute the set of albums which could be affected by the
+# changes: all albums in the folders of the changed tracks and their siblings, as merging only
+# happens between sibling folders. These albums are deleted and recreated by reprocessing all
+# their tracks. Other albums keep their album_id.
+def recolltosqlupdate(conn, rcldocs):
+    start = timer()
+
+    tabtorclfield = _prepareTags(conn, create=False)
+    c = conn.cursor()
+
+    # Current state: url -> (docidx, fmtime, album_id). The tracks table only has the path for
+    # file:// urls, so we can't match the others: they are always removed and recreated.
+    oldtracks = {}
+    nopath = []
+    c.execute("SELECT docidx, path, fmtime, album_id FROM tracks")
+    for docidx, path, fmtime, album_id in c:
+        if path:
+            oldtracks["file://" + path] = (docidx, fmtime, album_id)
+        else:
+            nopath.append((docidx, fmtime, album_id))
+    ntracks = len(oldtracks) + len(nopath)
+
+    docmap = {}
+    added = []
+    for docidx in range(len(rcldocs)):
+        doc = rcldocs[docidx]
+        if not _istrack(doc):
+            continue
+        old = oldtracks.get(doc["url"])
+        if old and old[1] == doc["fmtime"]:
+            del oldtracks[doc["url"]]
+            docmap[old[0]] = docidx
+        else:
+            added.append(docidx)
+    # What remains in oldtracks has been deleted or modified
+    removed = list(oldtracks.values()) + nopath
+    del oldtracks
+
+    uplog(f"recolltosqlupdate: {len(added)} added and {len(removed)} removed tracks")
+    if len(added) + len(removed) > _maxupdateratio * max(ntracks, 1):
+        return False
+
+    # Compute the affected albums: the ones in the folders of the changed tracks, and in sibling
+    # folders, and the merged albums they are part of.
+    folders = set()
+    for docidx in added:
+        folders.add(docfolder(rcldocs[docidx]).decode('utf-8', errors = 'replace'))
+    rmalbids = set([t[2] for t in removed])
+    albums = c.execute("SELECT album_id, albfolder, albalb FROM albums").fetchall()
+    for album_id, albfolder, albalb in albums:
+        if album_id in rmalbids:
+            folders.add(albfolder)
+    parents = set([uprclutils.dirname(f) for f in folders])
+    affected = set()
+    for album_id, albfolder, albalb in albums:
+        if albfolder in folders or uprclutils.dirname(albfolder) in parents:
+            affected.add(album_id)
+            if albalb:
+                affected.add(albalb)
+    for album_id, albfolder, albalb in albums:
+        if albalb in affected:
+            affected.add(album_id)
+    del albums
+
+    # Tracks from the affected albums which are not otherwise changed need to be processed again.
+    redo = []
+    deltracks = [(t[0],) for t in removed]
+    c.execute("CREATE TEMP TABLE deltracks (docidx INTEGER PRIMARY KEY)")
+    c.execute("CREATE TEMP TABLE docmap (olddocidx INTEGER PRIMARY KEY, newdocidx INT)")
+    c.execute("SELECT docidx, album_id FROM tracks")
+    for olddocidx, album_id in c.fetchall():
+        if album_id in affected and olddocidx in docmap:
+            redo.append(docmap[olddocidx])
+            deltracks.append((olddocidx,))
+            del docmap[olddocidx]
+    c.executemany("INSERT INTO deltracks(docidx) VALUES(?)", deltracks)
+    c.executemany("INSERT INTO docmap(olddocidx, newdocidx) VALUES(?,?)", docmap.items())
+
+    # Delete the records for the removed tracks, and for the ones we are going to recreate, then
+    # translate the docidx for the others.
+    tables = ["tracks",] + [_junctb(tb) for tb in set([t[0] for t in tabtorclfield])]
+    for tb in tables:
+        c.execute(f"DELETE FROM {tb} WHERE docidx IN (SELECT docidx FROM deltracks)")
+        c.execute(f"UPDATE {tb} SET docidx = "
+                  f"(SELECT newdocidx FROM docmap WHERE olddocidx = {tb}.docidx)")
+    c.executemany("DELETE FROM albums WHERE album_id = ?", [(a,) for a in affected])
+    c.execute("DROP TABLE deltracks")
+    c.execute("DROP TABLE docmap")
+
+    # Remove the tag values which are not used any more (except for artists used by albums).
+    for tb in set([t[0] for t in tabtorclfield]):
+        stmt = f"DELETE FROM {tb} WHERE {_clid(tb)} NOT IN (SELECT {_clid(tb)} FROM {_junctb(tb)})"
+        if tb == 'artist':
+            stmt += " AND artist_id NOT IN (SELECT artist_id FROM albums WHERE artist_id NOT NULL)"
+        c.execute(stmt)
+
+    # Recreate the tracks and albums. The post-processing passes only look at the new albums.
+    _initcaches(conn, [t[0] for t in tabtorclfield] + ['artist',])
+    global variousartistsid
+    variousartistsid = _auxtableinsert(conn, "artist", "Various Artists")    
+    c.execute("SELECT MAX(album_id) FROM albums")
+    r = c.fetchone()
+    maxalbid = r[0] if r and r[0] else 0
+    totcnt = _trackstosql(conn, rcldocs, sorted(redo + added), tabtorclfield)
+
+    _setalbumartists(conn)
+    _setalbumcovers(conn, rcldocs, maxalbid)
+    _createmergedalbums(conn)
+    conn.commit()
+    end = timer()
+    _searchindex(conn, rcldocs)
+    uplog(f"recolltosqlupdate: recreated {len(affected)} albums, processed {totcnt} docs " \
+          f"in {end-start:.1f} Seconds")
+    return True
  
+
+
+# Compute the stamp for the parameters which determine the db contents apart from the recoll data:
+# db version, Minim configuration, the values used for building the art URIs, and the FTS index
+# option.
+def _configstamp():
+    md5 = hashlib.md5()
+    for v in (_dbversion, uprclinit.g_minimconfig.gethash(),
+              uprclinit.getHttphp(), uprclinit.getPathPrefix(), str(uprclfts.enabled())):
+        md5.update(v.encode('utf-8') + b'\n')
+    return md5.hexdigest()
+
+
+# Compute the stamp for the recoll data: index generation and doc urls. The urls are hashed because
+# the tracks are identified by their index in the doc array, which must not have changed.
+def _datastamp(rcldocs):
+    md5 = hashlib.md5()
+    md5.update(uprclindex.indexgeneration(uprclinit.getRclConfdir()).encode('utf-8') + b'\n')
+    md5.update(str(len(rcldocs)).encode('utf-8') + b'\n')
+    for docidx in range(len(rcldocs)):
+        md5.update(rcldocs[docidx]["url"].encode('utf-8', errors='surrogateescape') + b'\n')
+    return md5.hexdigest()
+
+
+def _getdbstamp(conn, name):
+    c = conn.cursor()
+    c.execute("SELECT value FROM uprclmeta WHERE name = ?", (name,))
+    r = c.fetchone()
+    return r[0] if r else None
+
+
+def _setdbstamp(conn, name, value):
+    c = conn.cursor()
+    c.execute("INSERT OR REPLACE INTO uprclmeta(name, value) VALUES(?,?)", (name, value))
+
+
+# Open a read-only connection to the current tags db, for use by threads other than the browse one
+# (the Tagged connection must not be used by two threads at the same time).
+def openreadonly():
+    dbpath = os.path.join(uprclinit.getRclConfdir(), _dbname)
+    return sqlite3.connect(pathlib.Path(dbpath).as_uri() + "?mode=ro", uri=True)
+
+
+# Open an existing db file, returning None if it does not exist or is not usable.
+def _opendb(dbpath):
+    if not os.path.exists(dbpath):
+        return None
+    try:
+        conn = _connect(dbpath)
+        _getdbstamp(conn, "config")
+        return conn
+    except Exception as ex:
+        uplog(f"opentagsdb: can't use existing db {dbpath}: {ex}")
+        return None
+
+
+# Open the persistent tags db, reusing it if it was built from the same recoll data and
+# configuration, else updating or rebuilding it. If the configuration did not change, we try to
+# only process the differences with the previous recoll data (see recolltosqlupdate()).
+#
+# The new db is built in a temporary file which is then renamed, so that an interrupted build
+# never leaves a db which looks valid, and a connection to the previous db stays usable until it
+# is closed. As the temporary file is discarded on failure, we don't need journaling during the
+# build.
+def opentagsdb(rcldocs):
+    dbpath = os.path.join(uprclinit.getRclConfdir(), _dbname)
+    cfstamp = _configstamp()
+    datastamp = _datastamp(rcldocs)
+
+    oldconn = _opendb(dbpath)
+    if oldconn:
+        if _getdbstamp(oldconn, "config") == cfstamp and \
+           _getdbstamp(oldconn, "data") == datastamp:
+            uplog(f"opentagsdb: reusing up to date db {dbpath}")
+            _prepareTags(oldconn, create=False)
+            return oldconn
+
+    tmppath = dbpath + ".tmp"
+    if os.path.exists(tmppath):
+        os.unlink(tmppath)
+    conn = _connect(tmppath)
+    conn.execute("PRAGMA journal_mode = OFF")
+    conn.execute("PRAGMA synchronous = OFF")
+    updated = False
+    if oldconn:
+        if _getdbstamp(oldconn, "config") == cfstamp:
+            oldconn.backup(conn)
+            updated = recolltosqlupdate(conn, rcldocs)
+        oldconn.close()
+    if not updated:
+        recolltosql(conn, rcldocs)
+    _setdbstamp(conn, "config", cfstamp)
+    _setdbstamp(conn, "data", datastamp)
+    conn.commit()
+    conn.close()
+    os.replace(tmppath, dbpath)
+    return _connect(dbpath)
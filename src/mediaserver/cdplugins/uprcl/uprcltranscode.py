@@ -0,0 +1,377 @@
+# Copyright (C) 2026 J.F.Dockes
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Transcoding for the streamer, following the Minim stream.transcode rules.
+#
+# The stream.transcode value is a comma-separated list of [client@]input:output rules:
+#
+#  - client is the IP address of a renderer. Rules with a client are only used for requests from
+#    this address, and are checked before the others. The first matching rule is used.
+#  - input is a format name (the file extension, e.g. flac, wav, aiff, m4a, or dsd for both dsf
+#    and dff), or * or all for any format. It can be followed by a bit depth and by a ;rate
+#    sample rate (in kHz or Hz): the rule then only applies to files with at least these values.
+#    e.g. flac24 or flac;96.
+#  - output is wav, flac or mp3, possibly followed by 16 or 24 for the bit depth (the default is to
+#    keep 16 bits tracks at 16 bits and use 24 bits for the others), and by a ;rate maximum sample
+#    rate. DSD is converted to 88.2 kHz PCM if no rate is set. e.g. flac24;96 or wav16;48.
+#
+# For example: "dsd:flac24, flac;176:flac;88.2, 192.168.1.20@*:mp3"
+#
+# The transcoding is performed by ffmpeg, and the output is sent as it is produced (chunked), so
+# that playback can start immediately. Range requests can't be honoured for this first transfer
+# (the size is unknown), the whole data is sent. The completed output is also stored in a disk
+# cache ("transcode" subdirectory of the uprcl cache directory), from which the next requests for
+# the track are served, with Range support. The cache size is bounded by uprcltranscodecachemb,
+# the least recently used files are removed first.
+#
+# The rules which apply to all clients are also used for the track entries in the container
+# listings (see fixentry()), so that the Control Points see the format which will be streamed. The
+# client-specific rules are only known to the streamer.
+
+import hashlib
+import os
+import re
+import shutil
+import struct
+import subprocess
+import tempfile
+import time
+
+from upmplgutils import uplog, getOptionValue
+import uprclinit
+import uprclutils
+
+# Output formats: MIME type and file extension
+_outputs = {
+    'wav': ('audio/wav', '.wav'),
+    'flac': ('audio/flac', '.flac'),
+    'mp3': ('audio/mpeg', '.mp3'),
+}
+
+_dsdexts = ('dsf', 'dff')
+
+# Sample rate used for DSD if the rule sets none
+_dsdrate = 88200
+
+_chunksize = 64 * 1024
+
+_fmtre = re.compile(r'^(mp3|m4a|\*|[a-z]+)(16|24|32)?(?:;([0-9]+(?:\.[0-9]+)?))?$')
+
+# What we do for a given file: ffmpeg parameters and output MIME type and extension.
+class Transcoding(object):
+    def __init__(self, output, bits, rate, mtype, ext):
+        self.output = output
+        self.bits = bits
+        self.rate = rate
+        self.mtype = mtype
+        self.ext = ext
+
+    # Used for the cache key
+    def __str__(self):
+        return f"{self.output}:{self.bits}:{self.rate}"
+
+
+# Parse a format spec into (name, bits, rate). Raises an exception if the syntax is bad.
+def _parsefmt(s):
+    m = _fmtre.match(s)
+    if not m:
+        raise Exception(f"bad format [{s}]")
+    name, bits, rate = m.groups()
+    if name == 'all':
+        name = '*'
+    bits = int(bits) if bits else 0
+    if rate:
+        rate = float(rate)
+        # Small values are kHz
+        rate = int(rate * 1000) if rate < 1000 else int(rate)
+    else:
+        rate = 0
+    return name, bits, rate
+
+
+_rules = None
+_hasffmpeg = None
+
+# Return the parsed rules: list of (client, input, output)
+def _getrules():
+    global _rules
+    if _rules is None:
+        _rules = []
+        specs = None
+        try:
+            specs = uprclinit.g_minimconfig.gettranscodingspec()
+        except Exception as ex:
+            uplog(f"uprcltranscode: can't get the transcoding spec: {ex}")
+        for client, input, output in specs if specs else []:
+            try:
+                inspec = _parsefmt(input)
+                outspec = _parsefmt(output)
+                if outspec[0] not in _outputs:
+                    raise Exception(f"unsupported output format [{output}]")
+            except Exception as ex:
+                uplog(f"uprcltranscode: ignoring rule [{input}:{output}]: {ex}")
+                continue
+            _rules.append((client, inspec, outspec))
+        # Client-specific rules first (the sort is stable)
+        _rules.sort(key=lambda r: 0 if r[0] else 1)
+        uplog(f"uprcltranscode: rules: {_rules}")
+    return _rules
+
+
+def _inputmatches(inspec, ext, bits, rate):
+    name, ibits, irate = inspec
+    if name == 'dsd':
+        if ext not in _dsdexts:
+            return False
+    elif name != '*' and name != ext:
+        return False
+    if ibits and bits < ibits:
+        return False
+    if irate and rate < irate:
+        return False
+    return True
+
+
+def _intval(doc, fld):
+    try:
+        return int(doc[fld])
+    except:
+        return 0
+
+
+# Decide if a file should be transcoded for a client. doc is the recoll doc for the file, used for
+# the bit depth and sample rate (can be None). Returns a Transcoding object or None.
+def transcoding(path, doc, clientaddr):
+    global _hasffmpeg
+    rules = _getrules()
+    if not rules:
+        return None
+    if _hasffmpeg is None:
+        _hasffmpeg = shutil.which("ffmpeg") is not None
+        if not _hasffmpeg:
+            uplog("uprcltranscode: transcoding rules are set but ffmpeg is not available")
+    if not _hasffmpeg:
+        return None
+
+    spath = path.decode('utf-8', errors='replace') if isinstance(path, bytes) else path
+    ext = os.path.splitext(spath)[1][1:].lower()
+    if ext == 'aif':
+        ext = 'aiff'
+    bits = _intval(doc, "bits_per_sample") if doc else 0
+    rate = _intval(doc, "sample_rate") if doc else 0
+
+    for client, inspec, outspec in rules:
+        if client and client != clientaddr:
+            continue
+        if not _inputmatches(inspec, ext, bits, rate):
+            continue
+        output, obits, orate = outspec
+        if ext in _dsdexts:
+            bits = 1
+            if not orate:
+                orate = _dsdrate
+        # Never increase the sample rate or bit depth
+        if orate and rate and rate <= orate:
+            orate = 0
+        if obits and 1 < bits <= obits:
+            obits = 0
+        if output == 'mp3':
+            # mp3 is limited to 48 kHz
+            r = orate if orate else rate
+            if r > 48000:
+                orate = 44100 if r % 11025 == 0 else 48000
+        if output == ext and not orate and not obits:
+            # Nothing to do
+            return None
+        if output == 'mp3':
+            obits = 0
+        elif not obits:
+            obits = 16 if 1 < bits <= 16 else 24
+        mtype, oext = _outputs[output]
+        return Transcoding(output, obits, orate, mtype, oext)
+    return None
+
+
+# Adjust a track entry built by uprclutils.rcldoctoentry() for doc to the transcoding performed for
+# all clients: MIME type, and bit depth and sample rate if they are changed. The size and bit rate of
+# the transcoded data are unknown, so we remove them.
+def fixentry(e, doc):
+    if not e or e['tp'] != 'it' or not doc["url"].startswith("file://"):
+        return e
+    tc = transcoding(uprclutils.docpath(doc), doc, None)
+    if not tc:
+        return e
+    e['res:mime'] = tc.mtype
+    if tc.bits:
+        e['res:bitsPerSample'] = str(tc.bits)
+    else:
+        e.pop('res:bitsPerSample', None)
+    if tc.rate:
+        e['res:samplefreq'] = str(tc.rate)
+    e.pop('res:size', None)
+    e.pop('res:bitrate', None)
+    return e
+
+
+def _ffmpegcmd(path, tc):
+    cmd = ["ffmpeg", "-nostdin", "-v", "error", "-i", path, "-map", "0:a:0"]
+    if tc.rate:
+        cmd += ["-ar", str(tc.rate)]
+    if tc.output == 'mp3':
+        cmd += ["-c:a", "libmp3lame", "-b:a", "320k", "-f", "mp3"]
+    elif tc.output == 'wav':
+        cmd += ["-c:a", f"pcm_s{tc.bits}le", "-f", "wav"]
+    else:
+        if tc.bits == 16:
+            cmd += ["-c:a", "flac", "-sample_fmt", "s16"]
+        else:
+            cmd += ["-c:a", "flac", "-sample_fmt", "s32", "-bits_per_raw_sample", "24"]
+        cmd += ["-f", "flac"]
+    cmd.append("pipe:1")
+    return cmd
+
+
+############
+# Disk cache
+
+def _cachedir():
+    return os.path.join(uprclinit.getRclConfdir(), "transcode")
+
+
+_maxbytes = None
+
+def _getmaxbytes():
+    global _maxbytes
+    if _maxbytes is None:
+        try:
+            _maxbytes = int(float(getOptionValue("uprcltranscodecachemb", 1000)) * 1024 * 1024)
+        except Exception as ex:
+            uplog(f"uprcltranscode: bad uprcltranscodecachemb value: {ex}")
+            _maxbytes = 0
+    return _maxbytes
+
+
+def _cachepath(path, tc):
+    st = os.stat(path)
+    bpath = path if isinstance(path, bytes) else path.encode('utf-8', errors='surrogateescape')
+    key = hashlib.sha1(bpath + f":{st.st_mtime_ns}:{st.st_size}:{tc}".encode('ascii')).hexdigest()
+    return os.path.join(_cachedir(), key + tc.ext)
+
+
+# Return the path of the cached transcoded data for the file, or None.
+def cachedpath(path, tc):
+    if not _getmaxbytes():
+        return None
+    cpath = _cachepath(path, tc)
+    try:
+        # Update the mtime, which we use for deciding what to remove from the cache
+        os.utime(cpath)
+        return cpath
+    except Exception:
+        return None
+
+
+# Remove the least recently used files to bring the cache size under the limit. Partial files from
+# the transfers in progress are skipped, except if they are very old (remains of a crash).
+def _trimcache(maxbytes):
+    files = []
+    total = 0
+    for ent in os.scandir(_cachedir()):
+        try:
+            st = ent.stat()
+        except Exception:
+            continue
+        if ent.name.endswith(".part") and st.st_mtime > time.time() - 86400:
+            continue
+        files.append((st.st_mtime, st.st_size, ent.path))
+        total += st.st_size
+    files.sort()
+    for mtime, size, path in files:
+        if total <= maxbytes:
+            break
+        try:
+            os.unlink(path)
+            total -= size
+        except Exception as ex:
+            uplog(f"uprcltranscode: can't remove {path}: {ex}")
+
+
+# The WAV data sizes can't be set by ffmpeg when writing to a pipe. Fix them in the cached file, so
+# that it is seekable by the players.
+def _fixwavheader(path):
+    size = os.path.getsize(path)
+    with open(path, 'r+b') as f:
+        hdr = f.read(12)
+        if len(hdr) != 12 or hdr[:4] != b'RIFF' or hdr[8:12] != b'WAVE':
+            return
+        f.seek(4)
+        f.write(struct.pack('<I', min(size - 8, 0xffffffff)))
+        offs = 12
+        while offs + 8 <= size:
+            f.seek(offs)
+            chunkid, chunksize = struct.unpack('<4sI', f.read(8))
+            if chunkid == b'data':
+                f.seek(offs + 4)
+                f.write(struct.pack('<I', min(size - offs - 8, 0xffffffff)))
+                return
+            offs += 8 + chunksize + (chunksize & 1)
+
+
+# Generator for the transcoded data, which is also written to the cache. If the transfer is
+# interrupted (the client went away), the generator is closed and we kill the transcoder and
+# discard the partial data.
+def stream(path, tc):
+    uplog(f"uprcltranscode: transcoding {path} to {tc}")
+    proc = subprocess.Popen(_ffmpegcmd(path, tc), stdout=subprocess.PIPE)
+    maxbytes = _getmaxbytes()
+    cachef = None
+    if maxbytes:
+        try:
+            cpath = _cachepath(path, tc)
+            os.makedirs(_cachedir(), exist_ok=True)
+            fd, tmppath = tempfile.mkstemp(dir=_cachedir(), suffix=".part")
+            cachef = os.fdopen(fd, "wb")
+        except Exception as ex:
+            uplog(f"uprcltranscode: can't create cache file: {ex}")
+    complete = False
+    try:
+        while True:
+            data = proc.stdout.read1(_chunksize)
+            if not data:
+                break
+            if cachef:
+                cachef.write(data)
+            yield data
+        status = proc.wait()
+        if status:
+            uplog(f"uprcltranscode: ffmpeg exited with status {status} for {path}")
+        complete = status == 0
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+        proc.stdout.close()
+        if cachef:
+            cachef.close()
+            try:
+                if complete:
+                    if tc.output == 'wav':
+                        _fixwavheader(tmppath)
+                    os.replace(tmppath, cpath)
+                    _trimcache(maxbytes)
+                else:
+                    os.unlink(tmppath)
+            except Exception as ex:
+                uplog(f"uprcltranscode: cache update failed: {ex}")
@@ -20,20 +20,22 @@
 # a track not untagged for minim).
 #
 # Initialization filters the untagged tracks and creates a vector of
-# indexes into the global doc vector.
+# indexes into the global doc vector, and the root listing order.
 #
 # Object Id prefix: 0$uprcl$untagged
 # 
 # Obect id inside the section: $u<idx> where <idx> is the document index
 #  inside the global document vector.
 
+from array import array
 import os
 import shlex
 import sys
 
 from upmplgutils import uplog, direntry
-from uprclutils import rcldoctoentry
 import uprclinit
+from uprclutils import audiomtypes
+import uprclutils
 
 class Untagged(object):
     def __init__(self, rcldocs, httphp, pathprefix):
@@ -45,10 +47,15 @@ class Untagged(object):
     # Create the untagged entries static vector by filtering the global
     # doc vector, storing the indexes of all tracks without a title
     # field. We keep a reference to the doc vector.
+    #
+    # We also compute the root listing order once: _sortedidx holds the utidx indexes of the docs
+    # which have an entry, sorted by entry title (the file name as there is no title field, see
+    # rcldoctoentry()), so that the root browse only needs to create the entries for the
+    # requested slice.
     def recoll2untagged(self, rcldocs):
         # The -1 entry is because we use index 0 for our root.
         self.utidx = [-1]
-    
+        keys = []
         for docidx in range(len(rcldocs)):
             doc = rcldocs[docidx]
             if doc["mtype"] == 'inode/directory' or \
@@ -56,6 +63,12 @@ class Untagged(object):
                 continue
             if not doc["title"]:
                 self.utidx.append(docidx)
+                if doc["mtype"] in audiomtypes:
+                    url = doc["url"]
+                    tt = os.path.basename(url[url.find('//')+2:])
+                    keys.append((tt.lower(), len(self.utidx) - 1))
+        keys.sort()
+        self._sortedidx = array('i', [k[1] for k in keys])
 
     # Compute index into our entries vector by 'parsing' the objid.
     def _objidtoidx(self, pid):
@@ -88,7 +101,7 @@ class Untagged(object):
         idx = self._objidtoidx(pid)
 
         entries = []
-        rcldocs = uprclinit.getTree('folders').rcldocs()
+        folders = uprclinit.getTree('folders')
         if idx == 0:
             # Browsing root
             if flag == "meta":
@@ -96,19 +109,14 @@ class Untagged(object):
                 return self.rootentries("0$uprcl$")
             else:
                 # Root children
-                for i in range(len(self.utidx))[1:]:
-                    doc = rcldocs[self.utidx[i]]
-                    #uplog(f"UNTAGGED: {i} -> {doc['url']}")
-                    id = self._idprefix + '$u' + str(i)
-                    e = rcldoctoentry(id, pid, self._httphp, self._pprefix, doc)
-                    if e:
-                        entries.append(e)
+                return uprclutils.pagedentries(
+                    self._sortedidx, offset, count,
+                    lambda i: folders.docentry(self._idprefix + '$u' + str(i), pid, self.utidx[i]))
         else:
             # Non root: only items in there. flag needs to be 'meta'
-            doc = rcldocs[self.utidx[idx]]
             id = self._idprefix + '$u' + str(idx)
-            e = rcldoctoentry(id, pid, self._httphp, self._pprefix, doc)
+            e = folders.docentry(id, pid, self.utidx[idx])
             if e:
                 entries.append(e)
 
-        return sorted(entries, key=lambda entry: entry['tt'].lower())
+        return entries
@@ -17,7 +17,6 @@ from __future__ import print_function
 
 import sys
 from urllib.parse import quote as urlquote, unquote_to_bytes as urlunquotetobytes
-import functools
 import glob
 import io
 import locale
@@ -29,6 +28,7 @@ import xml.sax.saxutils
 
 from recoll import recoll
 from upmplgutils import uplog
+from uprclcache import FolderArtCache
 
 _has_resultstore = False
 def sethasresultstore(v):
@@ -87,7 +87,7 @@ upnp2rclfields = {
 def _httpurl(httphp, path, query=''):
     return "http://%s%s%s" % (httphp, urlquote(path), query)
 
-def rcldoctoentry(id, pid, httphp, pathprefix, doc):
+def rcldoctoentry(id, pid, httphp, pathprefix, doc, arturi=None):
     """
     Transform a Doc object into the format expected by the parent
 
@@ -100,6 +100,8 @@ def rcldoctoentry(id, pid, httphp, pathprefix, doc):
           translating the internal into the real url (for plugins
           based on external-services)
         doc is the Doc object to be translated
+        arturi: the art uri if it was computed in advance (an empty string means no art). If
+          this is None, we look for the art in the file system.
         
     Returns:
         A dict representing an UPnP item, with the
@@ -127,7 +129,8 @@ def rcldoctoentry(id, pid, httphp, pathprefix, doc):
             li[oname] = val
 
     if 'upnp:albumArtURI' not in li:
-        arturi = docarturi(doc, httphp, pathprefix)
+        if arturi is None:
+            arturi = docarturi(doc, httphp, pathprefix)
         if arturi:
             li['upnp:albumArtURI'] = arturi
         
@@ -190,6 +193,18 @@ def waitentry(id, pid, httphp, msg="Initializing..."):
     li['res.mime'] = "audio/mpeg"
     return li
 
+# Return the part of an entries list selected by offset and count (count 0 means all), in the form
+# returned by the trees browse methods: an (offset, total, entries) tuple if a page was requested,
+# else the whole list. If makeentry is set, entries is a list of keys (e.g. doc indexes), and the
+# entries are only created for the returned page, by calling makeentry(key).
+def pagedentries(entries, offset, count, makeentry=None):
+    page = entries[offset:offset+count] if count else entries[offset:]
+    if makeentry:
+        page = [makeentry(e) for e in page]
+    if not offset and not count:
+        return page
+    return (offset, len(entries), page)
+
 # dirname and basename which returns the last element, not null, when
 # the path ends in '/'
 def dirname(path):
@@ -214,9 +229,10 @@ def docpath(doc):
     # them. For reference, minim does not process them at all. At
     # least we're almost there...
     # Cf beethovem/p-s-g/vol1/cd3 path('e)tique
+    # A path without a '%' can't have been urlencoded, no need to look at the file system.
     if _has_resultstore:
         p = doc["url"][7:]
-        if os.path.exists(p):
+        if p.find('%') == -1 or os.path.exists(p):
             bpath = p.encode("utf-8")
         else:
             bpath = urlunquotetobytes(p)
@@ -267,12 +283,6 @@ def tag2fn(s):
 # We return a special uri if the file has embedded image data, else an
 # uri for for the directory cover art (if any).
 
-# We are usually called repeatedly for the same directory, so we cache
-# one result.
-#
-# The doc can come from recoll (track or directory), or be virtual (playlist)
-_foldercache = {}
-
 # All standard cover art file names:
 _artexts = (b'.jpg', b'.png')
 def _artnamegen(base):
@@ -284,12 +294,57 @@ for base in _folderartbases:
     for path in _artnamegen(base):
         _folderartnames.append(path)
 
+# When resolving the art for all the tracks during the tree builds, we don't want to test the
+# candidate file names one by one (this is slow on network file systems). The callers then pass a
+# dircache dict, in which we store, for each folder, the set of file names obtained with a single
+# scandir, and the folder art file name.
+def _dirlisting(folder, dircache):
+    try:
+        return dircache[folder]
+    except KeyError:
+        pass
+    names = set()
+    try:
+        with os.scandir(folder) as it:
+            for ent in it:
+                names.add(ent.name)
+    except:
+        pass
+    artnm = None
+    for fsimple in sorted(names):
+        if fsimple.lower() in _folderartnames:
+            artnm = fsimple
+            break
+    dircache[folder] = (names, artnm)
+    return dircache[folder]
+
+# Look for an appropriate image in a folder. Generating the charcase combinations would be
+# complicated so we list the folder and look for a case-insensitive match. As this is slow, the
+# result is cached in g_folderartcache.
+def _folderartname(folder):
+    try:
+        for fsimple in sorted(os.listdir(folder)):
+            if fsimple.lower() in _folderartnames:
+                return fsimple
+    except:
+        traceback.print_exc()
+    return None
+
+# We are usually called repeatedly for the same directory, so we cache the folder art names. The
+# doc can come from recoll (track or directory), or be virtual (playlist).
+g_folderartcache = FolderArtCache(_folderartname)
+
+def _exists(path, dircache):
+    if dircache is None:
+        return os.path.exists(path)
+    return os.path.basename(path) in _dirlisting(os.path.dirname(path), dircache)[0]
+
 # track-specific art. Sometimes we prefer the folder's
-def _trackarturi(doc, objpath, httphp, bpp):
+def _trackarturi(doc, objpath, httphp, bpp, dircache=None):
     # Check for an image specific to the track file
     base,ext = os.path.splitext(objpath)
     for artpath in _artnamegen(base):
-        if os.path.exists(artpath):
+        if _exists(artpath, dircache):
             return _httpurl(httphp, os.path.join(bpp, artpath))
 
     # Else try to use an embedded img
@@ -301,9 +356,7 @@ def _trackarturi(doc, objpath, httphp, bpp):
     return None
 
 # Return folder-level art uri (e.g. /path/to/folder.jpg) if it exists
-def folderart(doc, httphp, bpp, albtitle=None):
-    global _foldercache
-
+def folderart(doc, httphp, bpp, albtitle=None, dircache=None):
     # If doc is a directory, this returns itself, else the father dir.
     folder = docfolder(doc)
 
@@ -312,51 +365,30 @@ def folderart(doc, httphp, bpp, albtitle=None):
         albtitle = albtitle.encode("UTF-8")
         for fsimple in _artnamegen(albtitle):
             path = os.path.join(folder, fsimple)
-            if os.path.exists(path):
+            if _exists(path, dircache):
                 return _httpurl(httphp, path)
 
-    # Look for an appropriate image in the file folder. Generating the charcase combinations would
-    # be complicated so we list the folder and look for a case-insensitive match. As this is slow,
-    # we cache the result.
-    # TBD: if we support dynamic updates at some point, the caching will have to look at the folder
-    # mtime, or to be reset at each update.
-    if folder not in _foldercache:
-        #uplog(f"folderart: looking at {folder}")
-        _foldercache[folder] = None
-        artnm = None
-        try:
-            for f in sorted(os.listdir(folder)):
-                try:
-                    fsimple = os.path.basename(f)
-                    flowersimple = fsimple.lower()
-                except:
-                    #traceback.print_exc()
-                    continue
-                if flowersimple in _folderartnames:
-                    path = os.path.join(bpp, folder, fsimple)
-                    _foldercache[folder] = _httpurl(httphp, path)
-                    break
-        except:
-            traceback.print_exc()
-            pass
-
-    arturi = _foldercache[folder]
-    if arturi:
-        #uplog("folder %s arturi %s"% (printable(folder), arturi))
-        if doc["mtype"] == 'inode/directory':
-            #uplog("docarturi: external: %s->%s" % (printable(folder), printable(arturi)))
-            pass
+    if dircache is not None:
+        artnm = _dirlisting(os.path.dirname(folder), dircache)[1]
+        if artnm:
+            return _httpurl(httphp, os.path.join(bpp, folder, artnm))
+        return None
 
-    return arturi
+    artnm = g_folderartcache.lookup(folder)
+    if artnm:
+        return _httpurl(httphp, os.path.join(bpp, folder, artnm))
+    return None
 
 
-def docarturi(doc, httphp, pathprefix, preferfolder=False, albtitle=None):
+# Compute the art uri for doc. dircache is set when resolving the art for many docs (see
+# _dirlisting()).
+def docarturi(doc, httphp, pathprefix, preferfolder=False, albtitle=None, dircache=None):
     bpp = pathprefix.encode('utf-8')
     objpath = docpath(doc)
     #uplog("docarturi, looking for cover for %s" % objpath)
 
     if not preferfolder:
-        arturi = _trackarturi(doc, objpath, httphp, bpp)
+        arturi = _trackarturi(doc, objpath, httphp, bpp, dircache)
         if arturi:
             return arturi
 
@@ -365,19 +397,19 @@ def docarturi(doc, httphp, pathprefix, preferfolder=False, albtitle=None):
         base = os.path.join(os.path.dirname(objpath), tag2fn(doc["group"]))
         for artpath in _artnamegen(base):
             #uplog("docarturi: testing %s" % artpath)
-            if os.path.exists(artpath):
+            if _exists(artpath, dircache):
                 return _httpurl(httphp, os.path.join(bpp, artpath))
             
     # TBD Here minimserver would look for album disc before album art (which is taken care of by
     # folderart() with albtitle set)
     # Look for folder level image file (e.g. cover.jpg)
-    arturi = folderart(doc, httphp, bpp, albtitle)
+    arturi = folderart(doc, httphp, bpp, albtitle, dircache)
     if arturi:
         return arturi
 
     # If preferfolder is set, we did not look at the track-specific art, do it last.
     if preferfolder:
-        arturi = _trackarturi(doc, objpath, httphp, bpp)
+        arturi = _trackarturi(doc, objpath, httphp, bpp, dircache)
 
     return arturi
 
@@ -392,98 +424,45 @@ def _logentry(nm, e1):
     uplog("%s tp %s alb %s dir %s tno %s" % (nm, tp,al,dr,tn))
 
 
-# General container sort items comparison method
-def _cmpentries_func(e1, e2):
-    #uplog("cmpentries");_logentry("e1", e1);_logentry("e2", e2)
-    tp1 = e1['tp']
-    tp2 = e2['tp']
-    isct1 = tp1 == 'ct'
-    isct2 = tp2 == 'ct'
-
-    # Containers come before items, and are sorted in alphabetic order
-    ret = -2
-    if isct1 and  not isct2:
-        ret = -1
-    elif not isct1 and isct2:
-        ret = 1
-    elif isct1 and isct2:
-        tt1 = e1['tt']
-        tt2 = e2['tt']
-        if tt1.lower() < tt2.lower():
-            ret = -1
-        elif tt1.lower() > tt2.lower():
-            ret = 1
-        else:
-            ret = 0
-    if ret != -2:
-        #uplog("cmpentries tp1 %s tp2 %s, returning %d"%(tp1,tp2,ret))
-        return ret
-    
-    # Tracks. Sort by album then directory then track number then file name
-    k = 'upnp:album'
-    a1 = e1[k] if k in e1 else ""
-    a2 = e2[k] if k in e2 else ""
-    if a1 < a2:
-        return -1
-    elif a1 > a2:
-        return 1
-
-    a1 = os.path.dirname(e1['uri'])
-    a2 = os.path.dirname(e2['uri'])
-    if a1 < a2:
-        return -1
-    elif a1 > a2:
-        return 1
-    
-    k = 'upnp:originalTrackNumber'
+# General container sort key: containers come before items, and are sorted in case-insensitive
+# alphabetic order. Tracks are sorted by album then directory then track number then file name.
+def entrysortkey(e):
+    if e['tp'] == 'ct':
+        return (0, e['tt'].lower())
     try:
-        a1 = int(e1[k])
+        tno = int(e['upnp:originalTrackNumber'])
     except:
-        a1 = 0
+        tno = 0
+    uri = e['uri']
+    return (1, e.get('upnp:album', ""), os.path.dirname(uri), tno, os.path.basename(uri))
+
+# Special sort key for items lists: we don't want to sort by album but by title instead
+def itemsortkey(e):
+    return (e.get('tt', ""), e.get('upnp:album', ""))
+
+# Compute the entrysortkey() and itemsortkey() values for the entry that rcldoctoentry() would
+# return for a track doc, without building the entry. This is used for sorting all the tracks when
+# building the trees (and the values are stored in the tags db), and must be kept consistent with
+# rcldoctoentry(). The http://host:port part of the uris is the same for all the tracks, so we
+# leave it out.
+def docsortkeys(doc):
+    album = doc["album"]
+    if not album:
+        album = ""
+    path = doc["url"]
+    ssidx = path.find('//')
+    tt = doc["title"]
+    if not tt:
+        tt = os.path.basename(path[ssidx+2:])
     try:
-        a2 = int(e2[k])
+        tno = int(doc["tracknumber"].split('/')[0])
     except:
-        a2 = 0
-    if a1 < a2:
-        return -1
-    elif a1 > a2:
-        return 1
-
-    # Finally: compare file names
-    a1 = os.path.basename(e1['uri'])
-    a2 = os.path.basename(e2['uri'])
-    if a1 < a2:
-        return -1
-    elif a1 > a2:
-        return 1
-
-    return 0
-
-cmpentries=functools.cmp_to_key(_cmpentries_func)
-
-# Special comparison method for items lists: we don't want to sort by album but by title instead
-def _cmpitems_func(e1, e2):
-    
-    # Tracks. Sort by title then album
-    k = 'tt'
-    a1 = e1[k] if k in e1 else ""
-    a2 = e2[k] if k in e2 else ""
-    if a1 < a2:
-        return -1
-    elif a1 > a2:
-        return 1
-
-    k = 'upnp:album'
-    a1 = e1[k] if k in e1 else ""
-    a2 = e2[k] if k in e2 else ""
-    if a1 < a2:
-        return -1
-    elif a1 > a2:
-        return 1
-
-    return 0
-
-cmpitems=functools.cmp_to_key(_cmpitems_func)
+        tno = 0
+    if path.find('file://') == 0:
+        uri = urlquote(docpath(doc))
+    else:
+        uri = path[:ssidx+2] + urlquote(path[ssidx+2:])
+    return (1, album, os.path.dirname(uri), tno, os.path.basename(uri)), (tt, album)
 
 
 # Open embedded image. Returns mtype, size, f